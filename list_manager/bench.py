@@ -0,0 +1,229 @@
+import os
+import sys
+import time
+import random
+import struct
+import asyncio
+import argparse
+import subprocess
+
+# import budget of the top level package, in milliseconds
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", 200))
+
+
+# cumulative import time (us) of each module as reported by python -X importtime
+def import_time(module="list_manager") -> dict[str, int]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+    )
+    times = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def bench_import(modules: list[str], budget_ms=IMPORT_BUDGET_MS) -> bool:
+    ok = True
+    for module in modules:
+        elapsed = import_time(module)[module] / 1000
+        within = elapsed <= budget_ms
+        ok &= within
+        print(f"{module : <40} {elapsed : >8.1f} ms {'' if within else f'over budget of {budget_ms} ms'}")
+    return ok
+
+
+# Local DNS stand-in answering over UDP and TCP: names starting with "nx" are
+# NXDOMAIN, everything else gets an A record. UDP queries are dropped with
+# probability loss and every answer is delayed up to jitter seconds, so TCP
+# responses come back out of order. With rate, each UDP source gets at most
+# that many answers per second, like public resolvers.
+class FakeUpstream:
+    def __init__(self, host="127.0.0.1", port=0, loss=0.0, jitter=0.0, rate=0.0):
+        self.host = host
+        self.port = port
+        self.loss = loss
+        self.jitter = jitter
+        self.rate = rate
+        self.buckets = dict()
+        self.queries = 0
+        self.limited = 0
+        self.udp = None
+        self.tcp = None
+
+    def answer(self, wire: bytes) -> bytes:
+        import dns.message
+        import dns.rcode
+        import dns.rrset
+        self.queries += 1
+        request = dns.message.from_wire(wire)
+        response = dns.message.make_response(request)
+        qname = request.question[0].name
+        if qname.labels[0].startswith(b"nx"):
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        else:
+            response.answer.append(dns.rrset.from_text(qname, 300, "IN", "A", "127.0.0.1"))
+        return response.to_wire()
+
+    # token bucket per source, one second of burst
+    def allowed(self, addr) -> bool:
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        tokens, last = self.buckets.get(addr, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[addr] = (tokens, now)
+            self.limited += 1
+            return False
+        self.buckets[addr] = (tokens - 1, now)
+        return True
+
+    async def delay(self) -> None:
+        if self.jitter:
+            await asyncio.sleep(random.random() * self.jitter)
+
+    async def start(self) -> "FakeUpstream":
+        loop = asyncio.get_running_loop()
+        upstream = self
+
+        class Datagram(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                if random.random() >= upstream.loss and upstream.allowed(addr):
+                    loop.create_task(self.reply(data, addr))
+
+            async def reply(self, data, addr):
+                await upstream.delay()
+                self.transport.sendto(upstream.answer(data), addr)
+
+        async def stream(reader, writer):
+            async def reply(data):
+                await self.delay()
+                answer = self.answer(data)
+                writer.write(struct.pack("!H", len(answer)) + answer)
+
+            try:
+                while True:
+                    (length,) = struct.unpack("!H", await reader.readexactly(2))
+                    loop.create_task(reply(await reader.readexactly(length)))
+            except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+                writer.close()
+
+        self.tcp = await asyncio.start_server(stream, self.host, self.port)
+        self.port = self.tcp.sockets[0].getsockname()[1]
+        self.udp, _ = await loop.create_datagram_endpoint(Datagram, local_addr=(self.host, self.port))
+        return self
+
+    def close(self) -> None:
+        self.udp.close()
+        self.tcp.close()
+
+
+async def bench_dns(transport="tcp", count=2000, concurrency=200, loss=0.0, jitter=0.01, lifetime=2.0) -> dict:
+    upstream = await FakeUpstream(loss=loss, jitter=jitter).start()
+    try:
+        result = await bench_dns_via(f"{transport}://{upstream.host}:{upstream.port}", count, concurrency, lifetime)
+    finally:
+        upstream.close()
+    return {"transport": transport, "queries": upstream.queries, **result}
+
+
+# spreads queries over several tunnels to one rate limited upstream, each tunnel
+# relays from its own source, as egresses would from their own addresses
+async def bench_egress(egresses=3, policy="hash", count=2000, concurrency=200, rate=300.0, lifetime=1.0) -> dict:
+    from .tunnel import MuxTunnel, Relay
+    from .resolver.egress import Egress, EgressRouter
+    upstream = await FakeUpstream(rate=rate).start()
+    relays, tunnels = [], []
+    for _ in range(egresses):
+        relays.append(await Relay(upstream=(upstream.host, upstream.port), port=0).start())
+        tunnels.append(await MuxTunnel(local_port=0, relay=(relays[-1].host, relays[-1].port), canary=False).open())
+    for tunnel in tunnels:
+        await asyncio.wait_for(tunnel.connected.wait(), timeout=5)
+    router = EgressRouter([Egress.from_tunnel(f"egress{i}", t) for i, t in enumerate(tunnels)], policy=policy)
+    try:
+        result = await bench_dns_via(None, count, concurrency, lifetime, router=router)
+    finally:
+        for tunnel in tunnels:
+            await tunnel.close()
+        for relay in relays:
+            relay.close()
+        upstream.close()
+    return {"egresses": egresses, "policy": policy, "limited": upstream.limited, **result, "per_egress": router.stats()}
+
+
+async def bench_dns_via(nameserver: str, count: int, concurrency: int, lifetime: float, router=None) -> dict:
+    from .resolver.processor import AsyncResolveProcessor
+    if nameserver:
+        AsyncResolveProcessor.config_resolver([nameserver])
+    AsyncResolveProcessor.config_egress(router)
+    processor = AsyncResolveProcessor(retries=1, lifetime=lifetime, max_concurrent_tasks=concurrency, batch_size=concurrency)
+    domains = [f"{'nx' if i % 3 == 0 else 'ok'}{i}.example.com" for i in range(count)]
+    start = time.perf_counter()
+    results = [r async for batch in processor.process_batch(domains) for r in batch]
+    elapsed = time.perf_counter() - start
+    await processor.close()
+    outcomes = dict()
+    for e, _ in results:
+        outcomes[str(e)] = outcomes.get(str(e), 0) + 1
+    return {"qps": round(count / elapsed), **outcomes}
+
+
+# resolver -> tunnel udp listener -> tcp stream -> relay -> DNS stand-in, all on loopback
+async def bench_tunnel(count=2000, concurrency=200, jitter=0.01, lifetime=2.0) -> dict:
+    from .tunnel import MuxTunnel, Relay
+    upstream = await FakeUpstream(jitter=jitter).start()
+    relay = await Relay(upstream=(upstream.host, upstream.port), port=0).start()
+    tunnel = await MuxTunnel(local_port=0, relay=(relay.host, relay.port), canary=False).open()
+    await asyncio.wait_for(tunnel.connected.wait(), timeout=5)
+    try:
+        result = await bench_dns_via(f"udp://{tunnel.local_address[0]}:{tunnel.local_address[1]}", count, concurrency, lifetime)
+    finally:
+        await tunnel.close()
+        relay.close()
+        upstream.close()
+    return {"transport": "tunnel", "queries": upstream.queries, **result, **tunnel.stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="list_manager.bench")
+    commands = parser.add_subparsers(dest="command", required=True)
+    imports = commands.add_parser("import", help="measure package import time")
+    imports.add_argument("modules", nargs="*", default=["list_manager", "list_manager.runner"])
+    imports.add_argument("--budget", type=float, default=IMPORT_BUDGET_MS, help="milliseconds per module")
+    dns = commands.add_parser("dns", help="resolve against a local DNS stand-in")
+    dns.add_argument("--transport", choices=["udp", "tcp"], default="tcp")
+    dns.add_argument("--count", type=int, default=2000)
+    dns.add_argument("--concurrency", type=int, default=200)
+    dns.add_argument("--loss", type=float, default=0.0, help="udp drop probability")
+    dns.add_argument("--jitter", type=float, default=0.01, help="max answer delay in seconds")
+    tunnel = commands.add_parser("tunnel", help="resolve through the multiplexed tunnel on loopback")
+    tunnel.add_argument("--count", type=int, default=2000)
+    tunnel.add_argument("--concurrency", type=int, default=200)
+    tunnel.add_argument("--jitter", type=float, default=0.01, help="max answer delay in seconds")
+    egress = commands.add_parser("egress", help="resolve over several loopback tunnels to a rate limited upstream")
+    egress.add_argument("--egresses", type=int, default=3)
+    egress.add_argument("--policy", choices=["hash", "load"], default="hash")
+    egress.add_argument("--count", type=int, default=2000)
+    egress.add_argument("--concurrency", type=int, default=200)
+    egress.add_argument("--rate", type=float, default=300.0, help="answers per second per source")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        sys.exit(0 if bench_import(args.modules, args.budget) else 1)
+    if args.command == "dns":
+        print(asyncio.run(bench_dns(args.transport, args.count, args.concurrency, args.loss, args.jitter)))
+    if args.command == "tunnel":
+        print(asyncio.run(bench_tunnel(args.count, args.concurrency, args.jitter)))
+    if args.command == "egress":
+        print(asyncio.run(bench_egress(args.egresses, args.policy, args.count, args.concurrency, args.rate)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import signal
+import socket
+import hashlib
+import argparse
+import socketserver
+from contextlib import contextmanager
+from threading import Event, RLock, Thread, current_thread, main_thread
+from typing import Optional
+from .runner import Runner
+from .resolver.refresh import QueryPacer, RefreshBudget, RefreshPriority
+from . import log, Utils, Stats
+
+DAEMON_SOCKET = os.environ.get("DAEMON_SOCKET", "list_manager.sock")
+# queries per second of the background refresh
+TRICKLE_RATE = float(os.environ.get("TRICKLE_RATE", 20))
+# seconds between writes of the resolver cache
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", 300))
+# bounds of the adaptive interval a source is checked at
+SOURCE_MIN_INTERVAL = float(os.environ.get("SOURCE_MIN_INTERVAL", 3600))
+SOURCE_MAX_INTERVAL = float(os.environ.get("SOURCE_MAX_INTERVAL", 86400))
+# seconds before a domain that failed again is retried by the background refresh
+TRICKLE_RETRY_AFTER = float(os.environ.get("TRICKLE_RETRY_AFTER", 3600))
+
+
+# When each source is checked next: a source that changed since its last check
+# is checked twice as often, one that did not half as often, within the bounds.
+class SourceSchedule:
+    def __init__(self, min_interval=SOURCE_MIN_INTERVAL, max_interval=SOURCE_MAX_INTERVAL):
+        self.file = Utils.get_create_dir("daemon").joinpath("schedule.json")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.sources: dict[str, dict] = json.loads(self.file.read_bytes()) if self.file.exists() else dict()
+
+    def due(self, urls: list[str], now: float) -> list[str]:
+        return [url for url in urls if self.sources.get(url, {}).get("due", 0) <= now]
+
+    def checked(self, url: str, changed: bool, now: float) -> None:
+        source = self.sources.setdefault(url, {"interval": self.min_interval, "checks": 0, "changes": 0})
+        source["interval"] = min(max(source["interval"] * (0.5 if changed else 2), self.min_interval), self.max_interval)
+        source["due"] = now + source["interval"]
+        source["checks"] += 1
+        source["changes"] += changed
+
+    def next_due(self) -> float:
+        return min((s["due"] for s in self.sources.values()), default=0)
+
+    def save(self) -> None:
+        tmp = self.file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.sources, indent=4), encoding="utf-8")
+        tmp.rename(self.file)
+
+
+# Keeps the runner, with the parsed lists and the resolver cache, in memory.
+# Sources are revalidated on their own schedule and rebuilt incrementally when
+# they change, stale domains are resolved in small waves at a steady paced rate
+# and the cache is checkpointed periodically. Controlled over a unix socket
+# with JSON lines: {"op": "stats" | "rebuild" | "upload" | "checkpoint" | "check" | "stop"}.
+class Daemon:
+    def __init__(self, runner: Optional[Runner] = None, socket_path=DAEMON_SOCKET, rate=TRICKLE_RATE,
+                 checkpoint_interval=CHECKPOINT_INTERVAL, wave_seconds=30.0, schedule: Optional[SourceSchedule] = None):
+        from .resolver.processor import AsyncResolveProcessor
+        self.runner = runner or Runner()
+        self.runner.background_refresh = True
+        self.socket_path = Utils.with_root(socket_path)
+        self.rate = rate
+        self.checkpoint_interval = checkpoint_interval
+        self.wave_seconds = wave_seconds
+        self.schedule = schedule or SourceSchedule()
+        AsyncResolveProcessor.config_pacer(QueryPacer(rate) if rate else None)
+        # pipeline runs, uploads and checkpoints do not overlap
+        self.lock = RLock()
+        self.stopping = Event()
+        # set while an operation waits for the lock the trickle holds
+        self.waiting = Event()
+        self.wave: Optional[RefreshBudget] = None
+        self.server = None
+        self.stats = Stats()
+        self.started = time.time()
+
+    # a running refresh wave is cut short so that an operation gets the lock
+    # within a batch, the trickle resumes with a new wave after it
+    @contextmanager
+    def exclusive(self):
+        self.waiting.set()
+        if self.wave:
+            self.wave.exhaust("daemon operation")
+        with self.lock:
+            self.waiting.clear()
+            yield
+
+    def rebuild(self, force=()) -> dict:
+        with self.exclusive():
+            self.runner.run(force=force)
+            self.stats["rebuilds"] += 1
+        return {"rebuilt": True}
+
+    def upload(self) -> dict:
+        with self.exclusive():
+            report = self.runner.upload()
+            self.stats["uploads"] += 1
+        return {"uploaded": len(report)}
+
+    def checkpoint(self) -> dict:
+        with self.exclusive():
+            self.runner.resolver.write()
+            self.runner.publish_snapshot()
+            self.schedule.save()
+            self.stats["checkpoints"] += 1
+        return {"checkpoint": True}
+
+    # revalidates the sources that are due, a changed one triggers an incremental rebuild
+    def check_sources(self, force=False) -> dict:
+        now = time.time()
+        files = list(self.runner.binder.files_iter())
+        due = {d.url for d in files} if force else set(self.schedule.due([d.url for d in files], now))
+        changed = []
+        for d in files:
+            if d.url not in due:
+                continue
+            try:
+                digest = hashlib.sha256(d.download(refresh=True)).hexdigest()
+            except Exception as e:
+                # backs off like an unchanged source instead of failing again every second
+                log.error(f"checking {d.url}: {e}")
+                self.schedule.checked(d.url, False, now)
+                continue
+            is_changed = digest != self.runner.digests.get(d.url)
+            self.schedule.checked(d.url, is_changed, now)
+            if is_changed:
+                changed.append(d.name)
+        self.stats["source_checks"] += len(due)
+        if changed:
+            log.info(f"sources changed: {changed}, rebuilding")
+            self.rebuild()
+        return {"checked": len(due), "changed": changed}
+
+    # domains the background refresh takes next, most valuable first
+    def pending(self) -> list[str]:
+        resolver = self.runner.resolver
+        retry = time.time() - TRICKLE_RETRY_AFTER
+        pending = {d for d in resolver.refresh_domains() if (resolver.history.last(d) or 0) < retry}
+        return RefreshPriority.from_binder(self.runner.binder, pending).order(resolver, pending)
+
+    # in waves of a few seconds worth of queries, holding the lock so the
+    # cache is not refreshed while a rebuild updates it; operations cut a wave short
+    def trickle(self) -> None:
+        while not self.stopping.is_set():
+            if self.waiting.is_set():
+                self.stopping.wait(0.1)
+                continue
+            with self.lock:
+                wave = self.pending()
+                if self.rate:
+                    wave = wave[:max(1, int(self.rate * self.wave_seconds))]
+                if wave:
+                    self.wave = RefreshBudget()
+                    if self.stopping.is_set():
+                        break
+                    self.runner.resolver.batch_resolve(wave, budget=self.wave, max_concurrent_tasks=60, batch_size=50)
+                    self.stats["trickled"] += self.wave.used
+            if not wave:
+                self.stopping.wait(self.wave_seconds)
+
+    def status(self) -> dict:
+        resolver = self.runner.resolver
+        return {
+            "uptime": round(time.time() - self.started),
+            "daemon": dict(self.stats),
+            "resolver": dict(resolver.stats()),
+            "pending": len(resolver.refresh_domains()),
+            "wave": self.wave and {"used": self.wave.used, "reason": self.wave.reason},
+            "rate": self.rate,
+            "next_source_check": self.schedule.next_due(),
+            "files": {d.name: {k: d.stats.get(k) for k in ("url", "parser", "cache", "prune", "upload")} for d in self.runner.binder.files_iter()},
+        }
+
+    def dispatch(self, request: dict) -> dict:
+        op = request.get("op")
+        if op == "stats":
+            return self.status()
+        if op == "rebuild":
+            return self.rebuild(force=request.get("force", ()))
+        if op == "upload":
+            return self.upload()
+        if op == "checkpoint":
+            return self.checkpoint()
+        if op == "check":
+            return self.check_sources(force=True)
+        if op == "stop":
+            self.stop()
+            return {"stopping": True}
+        return {"error": f"unknown op {op}"}
+
+    def serve(self) -> None:
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        reply = daemon.dispatch(json.loads(line))
+                    except Exception as e:
+                        log.exception(f"control: {e}")
+                        reply = {"error": str(e)}
+                    self.wfile.write(json.dumps(reply, default=str).encode("utf-8") + b"\n")
+                    self.wfile.flush()
+
+        self.socket_path.unlink(missing_ok=True)
+        self.server = socketserver.ThreadingUnixStreamServer(str(self.socket_path), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info(f"control socket {self.socket_path}")
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.wave:
+            self.wave.exhaust("daemon stopping")
+
+    def run(self) -> None:
+        if current_thread() is main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, lambda *_: self.stop())
+
+        self.rebuild()
+        self.serve()
+        trickler = Thread(target=self.trickle, name="trickle")
+        trickler.start()
+        last_checkpoint = time.monotonic()
+        try:
+            while not self.stopping.wait(1.0):
+                try:
+                    self.check_sources()
+                except Exception as e:
+                    log.exception(f"source check failed: {e}")
+                if time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                    self.checkpoint()
+                    last_checkpoint = time.monotonic()
+        finally:
+            self.stop()
+            trickler.join()
+            self.server.shutdown()
+            self.server.server_close()
+            self.socket_path.unlink(missing_ok=True)
+            self.checkpoint()
+            log.info(f"daemon stopped {dict(self.stats)}")
+
+
+def control(request: dict, socket_path=DAEMON_SOCKET, timeout: Optional[float] = None) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(Utils.with_root(socket_path)))
+        with sock.makefile("rwb") as fp:
+            fp.write(json.dumps(request).encode("utf-8") + b"\n")
+            fp.flush()
+            return json.loads(fp.readline())
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="list_manager.daemon")
+    parser.add_argument("--socket", default=DAEMON_SOCKET)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="run the daemon")
+    run.add_argument("--rate", type=float, default=TRICKLE_RATE, help="queries per second of the background refresh")
+    rebuild = commands.add_parser("rebuild", help="run the pipeline now")
+    rebuild.add_argument("--force", action="append", default=[], help="rerun a stage even if unchanged")
+    for command in ("stats", "upload", "checkpoint", "check", "stop"):
+        commands.add_parser(command)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        Daemon(socket_path=args.socket, rate=args.rate).run()
+        return
+    request = {"op": args.command}
+    if args.command == "rebuild":
+        request["force"] = args.force
+    print(json.dumps(control(request, args.socket), indent=4, default=str))
+
+if __name__ == "__main__":
+    main()
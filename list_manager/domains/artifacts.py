@@ -0,0 +1,69 @@
+import os
+from pathlib import Path
+from .binder import Binder
+from .files import DomainsFile
+from .groups import DomainGroup
+from .transfer import Transfer
+from ..table import HostTable
+from .. import log, Utils, Stats
+
+ARTIFACT_PREFIX = os.environ.get("ARTIFACT_PREFIX", "/lists/")
+
+
+# one sorted, deduplicated list per category plus a combined blocklist,
+# so downstream servers fetch a single object instead of every source
+class ArtifactBuilder:
+    def __init__(self, binder: Binder, path_prefix=ARTIFACT_PREFIX, lookup=False):
+        self.binder = binder
+        self.path_prefix = path_prefix
+        self.lookup = lookup
+        self.stats = Stats()
+
+    def key(self, name: str, kind=None, ext="txt") -> str:
+        return f"{self.path_prefix}{name}{f'.{kind}' if kind else ''}.{ext}"
+
+    @staticmethod
+    def group_sets(g: DomainGroup) -> tuple[set[str], set[str]]:
+        domains, patterns = set(), set()
+        for d in g.iter_domain_files():
+            d.check()
+            domains.update(d.payload_domains())
+            patterns.update(d.payload_patterns())
+        return domains, patterns
+
+    def build(self) -> dict[str, bytes]:
+        artifacts = dict()
+        all_domains, all_patterns = set(), set()
+        for g in self.binder.group_iter():
+            domains, patterns = self.group_sets(g)
+            artifacts[self.key(g.category)] = DomainsFile.encode(domains)
+            artifacts[self.key(g.category, "patterns")] = DomainsFile.encode(patterns)
+            self.stats[g.category] = {"domains": len(domains), "patterns": len(patterns)}
+            if not g.wl_type:
+                all_domains.update(domains)
+                all_patterns.update(patterns)
+
+        artifacts[self.key("all")] = DomainsFile.encode(all_domains)
+        artifacts[self.key("all", "patterns")] = DomainsFile.encode(all_patterns)
+        self.stats["all"] = {"domains": len(all_domains), "patterns": len(all_patterns)}
+
+        if self.lookup:
+            artifacts[self.key("all", ext="hosts")] = HostTable.from_hosts(all_domains)
+
+        log.info(f"built {len(artifacts)} artifacts {self.stats}")
+        return artifacts
+
+    def write(self, artifacts: dict[str, bytes] = None) -> Path:
+        artifacts = artifacts or self.build()
+        target = Utils.get_create_dir("artifacts")
+        for key, body in artifacts.items():
+            target.joinpath(key.strip("/").replace("/", "_")).write_bytes(body)
+        return target
+
+    def upload(self, artifacts: dict[str, bytes] = None, **kwargs) -> list[Stats]:
+        artifacts = artifacts or self.build()
+        text = [(body, key) for key, body in artifacts.items() if key.endswith(".txt")]
+        binary = [(body, key) for key, body in artifacts.items() if not key.endswith(".txt")]
+        report = Transfer.upload_lists(text, **kwargs)
+        report += Transfer.upload_lists(binary, content_type="application/octet-stream", **kwargs)
+        return report
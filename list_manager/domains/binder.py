@@ -1,38 +1,165 @@
 import os
-from typing import Generator
+from pathlib import Path
+from threading import Event
+from functools import cached_property
+from typing import Generator, Iterable, Optional
 from .files import DomainsFile
 from .groups import DomainGroup
-from .. import log, JsonFile
+from .index import WhitelistIndex
+from .sketch import overlap_report
+from .. import log, Utils, JsonFile, Stats
 
 class Binder:
     BL_CONFIG_JSON = os.environ.get("BL_CONFIG_JSON", "bl_config.json")
-    
-    def __init__(self):
-        groups = self.load()
-        self.wl_categories = groups["wl_categories"]
-        self.bl_categories = groups["bl_categories"]
-        self.groups = groups
+    # the config and source digests the files on disk were last built from
+    SNAPSHOT_JSON = "bl_config.snapshot.json"
+    KEYS = {"bl_categories": "blackLists", "wl_categories": "whiteLists"}
+
+    @cached_property
+    def snapshot(self) -> dict:
+        snapshot = JsonFile(self.SNAPSHOT_JSON)
+        data = snapshot.read() if snapshot.exists() else dict()
+        data.setdefault("config", {key: dict() for key in self.KEYS})
+        data.setdefault("indexes", dict())
+        data.setdefault("digests", dict())
+        return data
+
+    # bl_config.json is read on first access to the groups
+    @cached_property
+    def groups(self) -> dict[str, list[DomainGroup]]:
+        return self.load()
+
+    @property
+    def wl_categories(self) -> list[DomainGroup]:
+        return self.groups["wl_categories"]
+
+    @property
+    def bl_categories(self) -> list[DomainGroup]:
+        return self.groups["bl_categories"]
 
     @classmethod
-    def load(cls) -> dict[str, list[DomainGroup]]:
+    def read_config(cls) -> dict[str, dict[str, set[str]]]:
         data = JsonFile(cls.BL_CONFIG_JSON, root=False).read()
-        return {
-            "bl_categories": [DomainGroup(cat, url_list) for (cat, url_list) in data["blackLists"].items()],
-            "wl_categories": [DomainGroup(cat, url_list, wl_type=True) for (cat, url_list) in data["whiteLists"].items()],
-        }
-
-    def group_iter(self) -> Generator[DomainGroup, None, None]:
-        for g in self.groups["wl_categories"] + self.groups["bl_categories"]:
-            yield g
+        return {key: {cat: set(urls) for cat, urls in data[name].items()} for key, name in cls.KEYS.items()}
+
+    def load(self) -> dict[str, list[DomainGroup]]:
+        self.config = self.read_config()
+        DomainGroup.recover()
+        return {key: [self.build_group(key, cat, urls) for cat, urls in self.config[key].items()] for key in self.KEYS}
+
+    # renames list files written under their old names
+    def migrate(self) -> None:
+        for d in self.files_iter():
+            d.migrate()
+
+    def build_group(self, key: str, category: str, urls: Iterable[str]) -> DomainGroup:
+        indexes = self.snapshot["indexes"].setdefault(key, dict()).setdefault(category, dict())
+        return DomainGroup(category, urls, wl_type=(key == "wl_categories"), indexes=indexes)
+
+    @classmethod
+    def diff(cls, old: dict, new: dict) -> dict[str, dict[str, set[str]]]:
+        changes = dict()
+        for key in cls.KEYS:
+            before, after = old.get(key, dict()), new.get(key, dict())
+            changes[key] = {
+                "added": set(after) - set(before),
+                "removed": set(before) - set(after),
+                "changed": {cat for cat in set(before) & set(after) if set(before[cat]) != set(after[cat])},
+            }
+        return changes
+
+    # groups whose files must be parsed again: new or edited in the config, a
+    # source whose content changed or was never built. A whitelist change
+    # touches every blacklist, through reduce_wl
+    def dirty_groups(self, digests: dict[str, str]) -> set[DomainGroup]:
+        changes = self.diff(self.snapshot["config"], self.config)
+        dirty = set()
+        for key in self.KEYS:
+            for g in self.groups[key]:
+                if (g.category in changes[key]["added"] | changes[key]["changed"]
+                        or any(not d.exists() or digests.get(d.url) != self.snapshot["digests"].get(d.url) for d in g.iter_domain_files())):
+                    dirty.add(g)
+        wl = changes["wl_categories"]
+        if wl["removed"] or any(g.wl_type for g in dirty):
+            dirty.update(self.bl_categories)
+        return dirty
+
+    # records what the files on disk were built from and drops the files of removed sources
+    def save_snapshot(self, digests: dict[str, str]) -> None:
+        path = Utils.get_create_dir("domains")
+        for key in self.KEYS:
+            before, after = self.snapshot["config"].get(key, dict()), self.config[key]
+            for cat, urls in before.items():
+                for url in set(urls) - set(after.get(cat, ())):
+                    path.joinpath(f"{cat}_{DomainsFile.url_hash(url)}.json").unlink(missing_ok=True)
+                    self.snapshot["digests"].pop(url, None)
+        urls = {d.url for d in self.files_iter()}
+        self.snapshot["digests"].update({url: digest for url, digest in digests.items() if url in urls})
+        self.snapshot["config"] = {key: {cat: sorted(urls) for cat, urls in self.config[key].items()} for key in self.KEYS}
+        JsonFile(self.SNAPSHOT_JSON).write(self.snapshot)
+
+    # swaps in the groups of an edited config, unchanged groups are kept as they are
+    def apply(self, config: dict[str, dict[str, set[str]]]) -> dict[str, dict[str, set[str]]]:
+        changes = self.diff(self.config, config)
+        groups = dict()
+        for key in self.KEYS:
+            current = {g.category: g for g in self.groups[key]}
+            groups[key] = [
+                current[cat] if cat in current and current[cat].urls == urls else self.build_group(key, cat, urls)
+                for cat, urls in config[key].items()
+            ]
+        self.config = config
+        self.groups = groups
+        return changes
+
+    # yields the changes every time bl_config.json is edited, until stopped
+    def watch(self, interval=2.0, stop: Optional[Event] = None) -> Generator[dict, None, None]:
+        stop = stop or Event()
+        path = Path(self.BL_CONFIG_JSON)
+        self.groups  # the current config is the baseline
+        signature = None
+        while not stop.wait(interval):
+            try:
+                stat = path.stat()
+                if (stat.st_mtime_ns, stat.st_size) == signature:
+                    continue
+                config = self.read_config()
+            except (OSError, KeyError, AttributeError) as e:
+                log.error(f"{path}: {e}, keeping the current config")
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            changes = self.apply(config)
+            if any(any(c.values()) for c in changes.values()):
+                log.info(f"{path} changed: {changes}")
+                yield changes
+
+    def group_iter(self, categories=("wl_categories", "bl_categories")) -> Generator[DomainGroup, None, None]:
+        for key in categories:
+            for g in self.groups[key]:
+                yield g
     
-    def files_iter(self)-> Generator[DomainsFile, None, None]:
-        for g in self.group_iter():
+    def files_iter(self, **kwargs)-> Generator[DomainsFile, None, None]:
+        for g in self.group_iter(**kwargs):
             for d in g.iter_domain_files():
                 yield d
  
-    def reduce_wl(self):
-        for bl in self.groups["bl_categories"]:
-            for wl in self.groups["wl_categories"]:
-                bl -= wl
+    # one file after the other: the reduction is set and regex work under the GIL,
+    # threads would only add switching and the index is too large to ship to processes
+    def reduce_wl(self, groups: Optional[Iterable[DomainGroup]] = None):
+        groups = list(self.groups["bl_categories"] if groups is None else groups)
+        index = WhitelistIndex(self.files_iter(categories=["wl_categories"]))
+        for g in groups:
+            for d in g.iter_domain_files():
+                index.reduce(d)
+
+        for bl in groups:
             bl.set_stats("reduce_wl", True)
 
+    # estimated overlaps between the parsed lists from their sketches, no intersection is built
+    def overlap(self, categories=("bl_categories",)) -> dict:
+        files = list(self.files_iter(categories=categories))
+        return overlap_report({d.name: d.sketch for d in files}, {d.name: d.category for d in files})
+
+    # one bounded upload pool across all groups
+    def upload(self, **kwargs) -> list[Stats]:
+        return DomainGroup.upload_files(list(self.files_iter()), **kwargs)
@@ -1,10 +1,12 @@
 from datetime import datetime
-import re
 import copy
+import hashlib
 from pathlib import Path
 from .transfer import Transfer
 from .utils import DomainUtils, FileSet
-from .. import JsonFile, DataSet, Stats
+from .sketch import DomainSketch
+from ..external import ExternalSet, SortedRuns, MEMORY_BUDGET
+from .. import Utils, JsonFile, DataSet, Stats
 
 
 class DomainsFile(JsonFile, DomainUtils, Transfer):
@@ -13,24 +15,43 @@ class DomainsFile(JsonFile, DomainUtils, Transfer):
         self.category = category
         self.url = url
         self.from_cache = False
-        super().__init__(path.joinpath(f"{category}_{idx}_{self.url_hash(url)}.json"))
+        # the url is the identity of a source, idx only names it in stats
+        super().__init__(path.joinpath(f"{category}_{self.url_hash(url)}.json"))
+
+    # files named by position ({category}_{idx}_{hash}.json) are renamed, by the parse
+    # step of the pipeline only so that reading the lists never changes the tree
+    def migrate(self) -> None:
+        if self.file.exists():
+            return
+        suffix = f"_{self.url_hash(self.url)}.json"
+        for legacy in self.file.parent.glob(f"{self.category}_*{suffix}"):
+            if legacy.name[len(self.category) + 1:-len(suffix)].isdigit():
+                legacy.rename(self.file)
+                return
+
+    @property
+    def name(self) -> str:
+        return f"{self.category}_{self.idx}"
 
     def get_set(self, e:FileSet) -> set[str]:
          return self.fileSet[e]
 
+    # the stats first, then the sets
+    def data(self) -> DataSet:
+        return DataSet([('stats', self.stats), *self.fileSet.items()])
+
     def write(self) -> None:
-        self.fileSet['stats'] = self.stats
-        self.fileSet.move_to_end('stats', last=False)
-        super().write(self.fileSet)
-        del self.fileSet['stats']
+        super().write(self.data())
 
     def read(self) -> None:
         self.fileSet = DataSet(super().read())
         self.stats = Stats(self.fileSet['stats'])
         del self.fileSet['stats']
+        self.spill()
 
-        if self.idx != self.stats['idx']:
-            raise (IndexError(f"wrong idx {self.file}"))
+        if self.url != self.stats['url']:
+            raise (IndexError(f"wrong url {self.file}"))
+        self.stats['idx'] = self.idx
 
     @staticmethod
     def decode(data: bytes) -> list[str]:
@@ -38,19 +59,72 @@ class DomainsFile(JsonFile, DomainUtils, Transfer):
 
     @staticmethod
     def encode(domains: set[str]) -> bytes:
-        return "\n".join(domains).encode("utf-8")
+        # sorted so that an unchanged set always hashes to the same digest
+        return "\n".join(sorted(domains)).encode("utf-8")
+
+    # content of the sets, stats left out; tables on disk are streamed in their sorted order
+    def digest(self) -> str:
+        h = hashlib.sha256()
+        for name in sorted(self.fileSet):
+            h.update(f"{name}\0".encode("utf-8"))
+            items = self.fileSet[name]
+            if isinstance(items, ExternalSet):
+                for item in items:
+                    h.update(item.encode("utf-8") + b"\n")
+            else:
+                h.update(self.encode(items))
+            h.update(b"\0")
+        return h.hexdigest()
 
     def parse(self, force=False) -> None:
         raw_data = self.download()
         if force or not self.from_cache or not self.exists():
             self.stats = Stats([('idx', self.idx), ('category', self.category), ('url', self.url)])
             data = self.decode(raw_data)
-            self.fileSet, self.stats['parser'] = self.clean_list(data)
+            # under a memory budget the domains go to disk while parsing, not after
+            self.fileSet, self.stats['parser'] = self.clean_list(data, SortedRuns() if MEMORY_BUDGET else None)
+            self.spill()
+            self.stats['sketch'] = DomainSketch.of(self.get_set(FileSet.domains)).dump()
         else:
             self.read()
 
-        # Compile regex patterns
-        self.compiled_patterns = [re.compile(p) for p in self.get_set(FileSet.patterns)]
+        self.compile()
+
+    # cardinality and MinHash sketches of the parsed domains, computed for lists parsed before they existed
+    @property
+    def sketch(self) -> DomainSketch:
+        if "sketch" not in self.stats:
+            self.stats['sketch'] = DomainSketch.of(self.get_set(FileSet.domains)).dump()
+        return DomainSketch.load(self.stats['sketch'])
+
+    # under a memory budget the domains are moved to a sorted table on disk,
+    # dedup and whitelist reduction then merge tables instead of probing sets
+    def spill(self) -> None:
+        domains = self.get_set(FileSet.domains)
+        if MEMORY_BUDGET and not isinstance(domains, ExternalSet):
+            path = Utils.get_create_dir("external").joinpath(self.file.with_suffix(".domains").name)
+            self.fileSet[FileSet.domains] = ExternalSet.build(path, domains)
+
+    # wildcard prefix rules are matched by looking up the parents of a domain,
+    # only the remaining patterns are compiled
+    def compile(self) -> None:
+        suffixes, regexes = set(), []
+        for p in self.get_set(FileSet.patterns):
+            suffix = self.pattern_suffix(p)
+            if suffix:
+                suffixes.add(suffix)
+            else:
+                regexes.append(self.compile_pattern(p))
+        self.suffixes = frozenset(suffixes)
+        self.compiled_patterns = regexes
+
+    def load(self) -> None:
+        self.read()
+        self.compile()
+
+    @property
+    def loaded(self) -> bool:
+        return hasattr(self, "fileSet")
 
     def check(self):
         if "parser" not in self.stats:
@@ -62,27 +136,60 @@ class DomainsFile(JsonFile, DomainUtils, Transfer):
         if "reduce_wl" not in self.stats:
             raise (ValueError(f"{self.category}_{self.idx} must extract whitelist intersection of list"))
 
-    def download(self) -> bytes:
-        body, self.from_cache = self.download_list(self.url)
+    def download(self, refresh=False) -> bytes:
+        body, self.from_cache = self.download_list(self.url, refresh=refresh)
         return body
 
-    def upload(self, force=False) -> None:
+    def payload_domains(self) -> set[str]:
+        return self.get_set(FileSet.domains).difference(self.get_set(FileSet.dup_domains), self.get_set(FileSet.pruned))
+
+    # drops domains the resolver confirmed unresolvable enough times in a row
+    # from the payload, returns whether that changed it
+    def prune(self, resolver, confirmations: int) -> bool:
+        before = self.get_set(FileSet.pruned)
+        if not confirmations:
+            self.fileSet[FileSet.pruned] = set()
+            self.stats.pop("prune", None)
+            return bool(before)
+
+        # the payload without any pruning, the new set replaces the old one in a
+        # single assignment, so concurrent readers see either of them
+        candidates = self.get_set(FileSet.domains).difference(self.get_set(FileSet.dup_domains))
+        pruned = resolver.get_stably_unresolvable(candidates, confirmations)
+        self.fileSet[FileSet.pruned] = pruned
+        stats = {"confirmations": confirmations, "pruned": len(pruned), "kept": len(candidates) - len(pruned)}
+        changed = pruned != before or self.stats.get("prune") != stats
+        self.stats["prune"] = stats
+        return changed
+
+    def payload_patterns(self) -> set[str]:
+        return self.get_set(FileSet.patterns).difference(self.get_set(FileSet.dup_patterns))
+
+    def payload(self) -> set[str]:
+        return self.payload_domains().union(self.payload_patterns())
+
+    def upload_key(self) -> str:
+        return self.with_url_path(self.url)
+
+    def uploaded(self, result) -> None:
+        if result["status"] == "uploaded":
+            self.stats["upload"] = str(datetime.now())
+
+    def upload(self, **kwargs) -> None:
         self.check()
-        if force or not self.from_cache:
-            payload = self.get_set(FileSet.domains).difference(self.get_set(FileSet.dup_domains)).union(
-                self.get_set(FileSet.patterns).difference(self.get_set(FileSet.dup_patterns)))
-
-            if self.upload_list(self.encode(payload), self.url):
-                    self.stats["upload"] = str(datetime.now())
+        if self.upload_list(self.encode(self.payload()), self.url, **kwargs):
+            self.stats["upload"] = str(datetime.now())
 
     def match_patterns(self, domains) -> set[str]:
         matches = set()
-        matched_patterns = set()
         for domain in domains:
+            if self.suffixes and not self.suffixes.isdisjoint(self.parents(domain)):
+                matches.add(domain)
+                continue
             for pattern in self.compiled_patterns:
                 if pattern.match(domain):
-                    matched_patterns.add((pattern, domain))
                     matches.add(domain)
+                    break
 
         return matches
 
@@ -97,17 +204,17 @@ class DomainsFile(JsonFile, DomainUtils, Transfer):
 
         # match domains with other patterns
         matched = other.match_patterns(self.get_set(FileSet.domains))
-        de_dup[f"{other.category}_{other.idx}_m"] = len(matched)
+        de_dup[f"{other.name}_m"] = len(matched)
         self.get_set(FileSet.dup_domains).update(matched)
 
         # domains string matched by other domains
         intersect = self.get_set(FileSet.domains).intersection(other.get_set(FileSet.domains))
-        de_dup[f"{other.category}_{other.idx}_d"] = len(intersect)
+        de_dup[f"{other.name}_d"] = len(intersect)
         self.get_set(FileSet.dup_domains).update(intersect)
 
         # domains string matched by other patterns
         intersect = self.get_set(FileSet.patterns).intersection(other.get_set(FileSet.patterns))
-        de_dup[f"{other.category}_{other.idx}_p"] = len(intersect)
+        de_dup[f"{other.name}_p"] = len(intersect)
         self.get_set(FileSet.dup_patterns).update(intersect)
         
         self.stats["deDup"] = de_dup
@@ -1,15 +1,28 @@
-from itertools import combinations, product
-from typing import Generator
+from itertools import combinations
+from typing import Generator, Optional
 from .files import DomainsFile
-from .. import log, Utils
+from .index import WhitelistIndex
+from .transfer import Transfer
+from .. import log, Utils, JsonFile, Stats
 
 
 class DomainGroup:
-    def __init__(self, category: str, url_list: list[str], wl_type=False):
-        url_list = sorted(url_list) # required for consistent hash mapping to file name 
-        self.domain_files:list[DomainsFile] = [self._gen(idx, category, url) for idx, url in enumerate(url_list)]
+    # generation of the files in domains, see JsonFile.write_many
+    MANIFEST = "domains/manifest.json"
+
+    # indexes maps url -> idx and is extended in place, so that a source keeps
+    # its idx (and stats name) when others are added to or removed from the group
+    def __init__(self, category: str, url_list: list[str], wl_type=False, indexes: Optional[dict[str, int]] = None):
+        url_list = sorted(url_list)
+        if indexes is None:
+            indexes = dict()
+        for url in url_list:
+            if url not in indexes:
+                indexes[url] = max(indexes.values(), default=-1) + 1
+        self.domain_files:list[DomainsFile] = [self._gen(indexes[url], category, url) for url in url_list]
         self.wl_type = wl_type
         self.category = category
+        self.urls = frozenset(url_list)
 
     @staticmethod
     def _gen(idx, category, url):
@@ -24,19 +37,53 @@ class DomainGroup:
             d.parse(**kwargs)
 
     def write(self) -> None:
+        self.write_files(self.domain_files)
+
+    # all files in one durable generation instead of an fsync each
+    @classmethod
+    def write_files(cls, files: list[DomainsFile]) -> None:
+        JsonFile.write_many([(d, d.data()) for d in files], JsonFile(cls.MANIFEST))
+
+    @classmethod
+    def recover(cls) -> None:
+        JsonFile.recover(JsonFile(cls.MANIFEST))
+
+    def load(self) -> None:
         for d in self.domain_files:
-            d.write()
+            d.load()
 
-    def de_dup(self) -> None:
-       self.domain_files =[ left - right for left, right in list(combinations(self.domain_files, 2))]
+    @property
+    def loaded(self) -> bool:
+        return all(d.loaded for d in self.domain_files)
 
-    def upload(self, **kwargs) -> None:
+    def de_dup(self) -> None:
+        for left, right in combinations(self.domain_files, 2):
+            left -= right
+        # a single file group has nothing to deDup against
         for d in self.domain_files:
+            d.stats.setdefault("deDup", dict())
+
+    def upload(self, **kwargs) -> list[Stats]:
+        return self.upload_files(self.domain_files, **kwargs)
+
+    @classmethod
+    def upload_files(cls, files: list[DomainsFile], **kwargs) -> list[Stats]:
+        pending = []
+        for d in files:
             try:
-                d.upload(**kwargs)
-            except Exception as e:
+                d.check()
+            except ValueError as e:
                 log.error(f"{e}")
                 continue
+            pending.append(d)
+
+        report = Transfer.upload_lists([(d.encode(d.payload()), d.upload_key()) for d in pending], **kwargs)
+        for d, result in zip(pending, report):
+            result["file"] = d.name
+            d.uploaded(result)
+        # the upload time is part of the file stats
+        cls.write_files([d for d, result in zip(pending, report) if result["status"] == "uploaded"])
+        return report
 
     def get_states(self):
         for d in self.domain_files:
@@ -51,7 +98,10 @@ class DomainGroup:
             d.stats[key] = value
 
     def __isub__(self, other):
-        self.domain_files = [left - right for left, right in product(self.domain_files, other.domain_files)]
+        index = WhitelistIndex(other.iter_domain_files())
+        for d in self.domain_files:
+            index.reduce(d)
+        return self
 
     def common(self):
         self.parse()
@@ -0,0 +1,107 @@
+import re
+from collections import Counter
+from types import MappingProxyType
+from typing import Iterable
+from .files import DomainsFile
+from .utils import DomainUtils, FileSet
+from ..external import ExternalSet, merge_intersection
+from .. import log
+
+
+# all whitelist files compiled once, shared read-only by the reducing threads
+class WhitelistIndex(DomainUtils):
+    def __init__(self, files: Iterable[DomainsFile]):
+        exact, suffixes, patterns, regexes = dict(), dict(), dict(), dict()
+        names, external = [], []
+        for f in files:
+            names.append(f.name)
+            domains = f.get_set(FileSet.domains)
+            if isinstance(domains, ExternalSet):
+                external.append((f.name, domains))
+            else:
+                for d in domains:
+                    exact.setdefault(d, []).append(f.name)
+
+            for p in f.get_set(FileSet.patterns):
+                patterns.setdefault(p, []).append(f.name)
+                suffix = self.pattern_suffix(p)
+                if suffix:
+                    suffixes.setdefault(suffix, []).append(f.name)
+                else:
+                    regexes.setdefault(p, []).append(f.name)
+
+        self.sources = tuple(names)
+        # whitelists on disk are merged with each list instead of indexed
+        self.external = tuple(external)
+        self.exact = self._freeze(exact)
+        self.suffixes = self._freeze(suffixes)
+        self.patterns = self._freeze(patterns)
+        self.matchers = tuple(self._compile(regexes))
+        # single pass pre-filter, per source attribution only runs on a hit
+        self.combined = re.compile("|".join(f"(?:{m.pattern})" for m, _ in self.matchers)) if self.matchers else None
+
+    @staticmethod
+    def _freeze(index: dict[str, list[str]]) -> MappingProxyType:
+        return MappingProxyType({k: tuple(v) for k, v in index.items()})
+
+    @classmethod
+    def _compile(cls, regexes: dict[str, list[str]]):
+        for p, names in regexes.items():
+            try:
+                yield cls.compile_pattern(p), tuple(names)
+            except re.error as e:
+                log.error(f"skipping whitelist pattern {p}: {e}")
+
+    def match_patterns(self, domain: str) -> set[str]:
+        matched = set()
+        for parent in self.parents(domain):
+            matched.update(self.suffixes.get(parent, ()))
+
+        if self.combined and self.combined.match(domain):
+            for pattern, names in self.matchers:
+                if pattern.match(domain):
+                    matched.update(names)
+
+        return matched
+
+    def external_matches(self, domains) -> dict[str, tuple[str, ...]]:
+        matches = dict()
+        for name, wl in self.external:
+            found = merge_intersection(domains, wl) if isinstance(domains, ExternalSet) else (d for d in domains if d in wl)
+            for domain in found:
+                matches[domain] = matches.get(domain, ()) + (name,)
+        return matches
+
+    def reduce(self, d: DomainsFile) -> None:
+        if not d.stats["parser"]:
+            raise (ValueError("must parse list before intersection"))
+
+        counts = Counter()
+        dup_domains = set()
+        domains = d.get_set(FileSet.domains)
+        external = self.external_matches(domains) if self.external else None
+        for domain in domains:
+            names = self.exact.get(domain, ())
+            if external:
+                names += external.get(domain, ())
+            matched = self.match_patterns(domain)
+            if names or matched:
+                dup_domains.add(domain)
+            counts.update(f"{n}_d" for n in names)
+            counts.update(f"{n}_m" for n in matched)
+
+        dup_patterns = set()
+        for p in d.get_set(FileSet.patterns):
+            names = self.patterns.get(p, ())
+            if names:
+                dup_patterns.add(p)
+            counts.update(f"{n}_p" for n in names)
+
+        d.get_set(FileSet.dup_domains).update(dup_domains)
+        d.get_set(FileSet.dup_patterns).update(dup_patterns)
+
+        de_dup = d.stats.get("deDup", dict())
+        for name in self.sources:
+            for kind in ("m", "d", "p"):
+                de_dup[f"{name}_{kind}"] = counts[f"{name}_{kind}"]
+        d.stats["deDup"] = de_dup
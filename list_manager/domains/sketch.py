@@ -0,0 +1,147 @@
+import math
+import base64
+import hashlib
+from array import array
+from heapq import nsmallest
+from typing import Iterable, Optional
+
+
+# 64 bit hash of a domain, shared by both sketches
+def hash64(item: str) -> int:
+    return int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+# Cardinality in 2^p one byte registers, about 1.04 / sqrt(2^p) relative error.
+# Registers of lists merge by maximum into the sketch of their union.
+class HyperLogLog:
+    P = 12
+
+    def __init__(self, p=P, registers: Optional[bytearray] = None):
+        self.p = p
+        self.registers = registers if registers is not None else bytearray(1 << p)
+
+    def add(self, h: int) -> None:
+        bits = 64 - self.p
+        idx = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, *others: "HyperLogLog") -> "HyperLogLog":
+        registers = bytearray(self.registers)
+        for other in others:
+            registers = bytearray(map(max, registers, other.registers))
+        return HyperLogLog(self.p, registers)
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        e = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # linear counting while many registers are still empty
+        if e <= 2.5 * m and zeros:
+            e = m * math.log(m / zeros)
+        return round(e)
+
+
+# Bottom-k MinHash: the k smallest hashes of a list. The k smallest hashes of a
+# union are exactly known from the sketches of its parts, and a hash among them
+# is in a list if and only if it is in that list's sketch, so shares of the
+# union (overlaps, hashes only one list has) are estimated without the lists.
+class MinHash:
+    K = 1024
+
+    def __init__(self, k=K, hashes: Iterable[int] = ()):
+        self.k = k
+        self.hashes = frozenset(hashes)
+
+    @classmethod
+    def of(cls, hashes: Iterable[int], k=K) -> "MinHash":
+        return cls(k, nsmallest(k, hashes))
+
+    @staticmethod
+    def union(*sketches: "MinHash") -> list[int]:
+        k = min(s.k for s in sketches)
+        return sorted(set().union(*[s.hashes for s in sketches]))[:k]
+
+
+# Both sketches of a list's domains, kept in its stats as base64 packed integers
+class DomainSketch:
+    def __init__(self, count: int, hll: HyperLogLog, minhash: MinHash):
+        self.count = count
+        self.hll = hll
+        self.minhash = minhash
+
+    @classmethod
+    def of(cls, domains: Iterable[str], p=HyperLogLog.P, k=MinHash.K) -> "DomainSketch":
+        hll = HyperLogLog(p)
+        count = 0
+
+        # one pass over the domains, which may be a table on disk: the hashes
+        # feed the HLL and the bounded heap of nsmallest, they are not kept
+        def hashes():
+            nonlocal count
+            for domain in domains:
+                h = hash64(domain)
+                hll.add(h)
+                count += 1
+                yield h
+
+        minhash = MinHash.of(hashes(), k)
+        return cls(count, hll, minhash)
+
+    def dump(self) -> dict:
+        return {
+            "count": self.count,
+            "p": self.hll.p,
+            "k": self.minhash.k,
+            "hll": base64.b64encode(bytes(self.hll.registers)).decode("ascii"),
+            "minhash": base64.b64encode(array("Q", sorted(self.minhash.hashes)).tobytes()).decode("ascii"),
+        }
+
+    @classmethod
+    def load(cls, data: dict) -> "DomainSketch":
+        hashes = array("Q")
+        hashes.frombytes(base64.b64decode(data["minhash"]))
+        return cls(data["count"], HyperLogLog(data["p"], bytearray(base64.b64decode(data["hll"]))), MinHash(data["k"], hashes))
+
+
+# Estimated overlaps of named sketches: per pair the Jaccard index, the size of
+# the intersection and its share of the smaller list; per list and per category
+# the domains no other list (category) has, what dropping it would lose.
+def overlap_report(sketches: dict[str, DomainSketch], categories: dict[str, str]) -> dict:
+    names = list(sketches)
+    union = HyperLogLog.merge(*[s.hll for s in sketches.values()]).estimate() if sketches else 0
+    sample = MinHash.union(*[s.minhash for s in sketches.values()]) if sketches else []
+    # which lists every sampled hash of the union is in
+    members = [[n for n in names if h in sketches[n].minhash.hashes] for h in sample]
+
+    pairs = dict()
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            sa, sb = sketches[a], sketches[b]
+            pair = MinHash.union(sa.minhash, sb.minhash)
+            jaccard = sum(h in sa.minhash.hashes and h in sb.minhash.hashes for h in pair) / len(pair) if pair else 0.0
+            intersection = jaccard * sa.hll.merge(sb.hll).estimate()
+            smaller = min(sa.count, sb.count)
+            pairs.setdefault(a, dict())[b] = {
+                "jaccard": round(jaccard, 4),
+                "intersection": round(intersection),
+                "overlap": round(min(intersection / smaller, 1.0), 4) if smaller else 0.0,
+            }
+
+    def unique(key) -> dict[str, int]:
+        counts = dict.fromkeys({key(n) for n in names}, 0)
+        for m in members:
+            owners = {key(n) for n in m}
+            if len(owners) == 1:
+                counts[owners.pop()] += 1
+        return {o: round(union * c / len(sample)) if sample else 0 for o, c in counts.items()}
+
+    return {
+        "union": union,
+        "sample": len(sample),
+        "count": {n: s.count for n, s in sketches.items()},
+        "pairs": pairs,
+        "unique": unique(lambda n: n),
+        "unique_category": unique(lambda n: categories[n]),
+    }
@@ -1,13 +1,15 @@
 import os
+import time
+import gzip
+import json
 import hashlib
-from distutils.util import strtobool
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from urllib.parse import urlparse
 import uuid
-from requests_cache import CachedSession
-from boto3 import Session
-from botocore.client import Config
-from botocore.exceptions import BotoCoreError
-from .. import log, Utils
+from datetime import timedelta
+from botocore.exceptions import BotoCoreError, ClientError
+from .. import log, Utils, JsonFile, Stats
 
 
 ACCESS_ID = os.environ.get("ACCESS_ID", "xxxx")
@@ -18,58 +20,182 @@ PATH_PREFIX = os.environ.get("PATH_PREFIX", "blocky")
 ENDPOINT_URL = (
     os.environ.get("ENDPOINT_URL", f"https://{REGION}.digitaloceanspaces.com/")
     + PATH_PREFIX)
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 8))
+UPLOAD_RETRIES = int(os.environ.get("UPLOAD_RETRIES", 3))
+UPLOAD_BACKOFF = float(os.environ.get("UPLOAD_BACKOFF", 0.5))
+UPLOAD_GZIP = Utils.strtobool(os.environ.get("UPLOAD_GZIP", "False"))
+# how to find the digest of the published object: manifest | remote | none
+UPLOAD_CHECK = os.environ.get("UPLOAD_CHECK", "manifest")
 
 class Transfer:
-    # http cache
-    from datetime import timedelta
-    session = CachedSession(
-        Utils.with_root("http_cache"),
-        backend="filesystem",
-        expire_after=timedelta(days=1),
-        serializer="yaml",
-        indent=4,
-    )
-
-    s3_client = Session().client(
-        "s3",
-        config=Config(s3={"addressing_style": "virtual"}),
-        region_name=REGION,
-        endpoint_url=ENDPOINT_URL,
-        aws_access_key_id=ACCESS_ID,
-        aws_secret_access_key=SECRET_KEY,
-    )
-    
+    # heavy clients are created on first use, see get_session / get_s3_client
+    session = None
+    s3_client = None
+    client_lock = Lock()
+
     # monkey patching mock
     if "mock_upload" not in globals():
-         mock_upload = bool(strtobool(os.environ.get("MOCK", "False")))
-    
-    if mock_upload:
-        def put_object(body:bytes, key:str, **_kwargs):
-            with Utils.get_create_dir("mock_upload").joinpath(key.replace('/', '_')).open("w") as fp:
-                fp.write(body.decode("utf-8"))
+         mock_upload = Utils.strtobool(os.environ.get("MOCK", "False"))
+
+    @classmethod
+    def get_session(cls):
+        with cls.client_lock:
+            if cls.session is None:
+                from requests_cache import CachedSession
+                # http cache
+                cls.session = CachedSession(
+                    Utils.with_root("http_cache"),
+                    backend="filesystem",
+                    expire_after=timedelta(days=1),
+                    serializer="yaml",
+                    indent=4,
+                )
+            return cls.session
 
-        s3_client.put_object = put_object
+    @classmethod
+    def get_s3_client(cls):
+        with cls.client_lock:
+            if cls.s3_client is None:
+                from boto3 import Session
+                from botocore.client import Config
+                cls.s3_client = Session().client(
+                    "s3",
+                    config=Config(
+                        s3={"addressing_style": "virtual"},
+                        # one pooled connection per upload worker
+                        max_pool_connections=UPLOAD_WORKERS,
+                        # put_list retries with its own backoff, a failed head only re-uploads
+                        retries={"max_attempts": 1, "mode": "standard"},
+                    ),
+                    region_name=REGION,
+                    endpoint_url=ENDPOINT_URL,
+                    aws_access_key_id=ACCESS_ID,
+                    aws_secret_access_key=SECRET_KEY,
+                )
+                if cls.mock_upload:
+                    log.info("using mock upload")
+                    cls.s3_client.put_object = cls.mock_put_object
+                    cls.s3_client.head_object = cls.mock_head_object
+            return cls.s3_client
 
     @staticmethod
-    def upload_list(body: bytes, url: str, **kwargs) -> bool:
-        key = Transfer.with_url_path(url, **kwargs)
-        try:
-            Transfer.s3_client.put_object(
-                Body=body, Bucket=BUCKET, Key=key, ACL="public-read"
-            )
-            return True
-        except BotoCoreError as e:
-            log.exception(f"upload to {key} failed: {e} {url}")
+    def mock_put_object(Body:bytes, Key:str, Metadata=None, **_kwargs):
+        target = Utils.get_create_dir("mock_upload").joinpath(Key.replace('/', '_'))
+        target.write_bytes(Body)
+        target.with_name(f"{target.name}.meta").write_text(json.dumps(Metadata or {}))
+
+    @staticmethod
+    def mock_head_object(Key:str, **_kwargs):
+        meta = Utils.get_create_dir("mock_upload").joinpath(f"{Key.replace('/', '_')}.meta")
+        return {"Metadata": json.loads(meta.read_text()) if meta.exists() else {}}
+
+    # key -> metadata of the last successful upload
+    manifest_file = JsonFile("upload_manifest.json")
+    manifest_lock = Lock()
+    manifest = None
+
+    @classmethod
+    def get_manifest(cls) -> dict:
+        with cls.manifest_lock:
+            if cls.manifest is None:
+                cls.manifest = cls.manifest_file.read() if cls.manifest_file.exists() else dict()
+            return cls.manifest
+
+    @classmethod
+    def write_manifest(cls) -> None:
+        with cls.manifest_lock:
+            if cls.manifest is not None:
+                cls.manifest_file.write(cls.manifest)
+
+    @classmethod
+    def published_meta(cls, key: str, check=UPLOAD_CHECK) -> dict:
+        if check == "manifest":
+            return cls.get_manifest().get(key, dict())
+        if check == "remote":
+            try:
+                return cls.get_s3_client().head_object(Bucket=BUCKET, Key=key).get("Metadata", dict())
+            except (BotoCoreError, ClientError) as e:
+                log.debug(f"head of {key} failed: {e}")
+        return dict()
+
+    @staticmethod
+    def put_list(body: bytes, key: str, compress=UPLOAD_GZIP, force=False, check=UPLOAD_CHECK,
+                 retries=UPLOAD_RETRIES, backoff=UPLOAD_BACKOFF, content_type="text/plain; charset=utf-8") -> Stats:
+        encoding = "gzip" if compress else "identity"
+        meta = {"sha256": hashlib.sha256(body).hexdigest(), "encoding": encoding}
+        result = Stats([("key", key), ("status", "failed"), ("attempts", 0), ("sha256", meta["sha256"])])
+
+        if not force and Transfer.published_meta(key, check) == meta:
+            result["status"] = "skipped"
+            return result
+
+        extra = {"ContentEncoding": "gzip"} if compress else dict()
+        wire = gzip.compress(body, mtime=0) if compress else body
+        start = time.monotonic()
+        for attempt in range(retries + 1):
+            result["attempts"] = attempt + 1
+            try:
+                Transfer.get_s3_client().put_object(
+                    Body=wire, Bucket=BUCKET, Key=key, ACL="public-read",
+                    ContentType=content_type, Metadata=meta, **extra
+                )
+                result["status"] = "uploaded"
+                result.pop("error", None)
+                break
+            except (BotoCoreError, ClientError) as e:
+                result["error"] = str(e)
+                log.warning(f"upload to {key} failed, attempt {attempt + 1}: {e}")
+                if attempt < retries:
+                    time.sleep(backoff * 2 ** attempt)
+
+        if result["status"] == "uploaded":
+            with Transfer.manifest_lock:
+                if Transfer.manifest is not None:
+                    Transfer.manifest[key] = meta
+
+        result["bytes"] = len(wire)
+        result["raw_bytes"] = len(body)
+        result["elapsed"] = round(time.monotonic() - start, 3)
+        return result
+
+    @staticmethod
+    def upload_list(body: bytes, url: str, path_prefix="/", **kwargs) -> bool:
+        key = Transfer.with_url_path(url, path_prefix)
+        Transfer.get_manifest()
+        result = Transfer.put_list(body, key, **kwargs)
+        Transfer.write_manifest()
+        if result["status"] == "failed":
+            log.error(f"upload to {key} failed: {result['error']} {url}")
             return False
+        return result["status"] == "uploaded"
+
+    # publish (body, key) pairs concurrently, the report keeps the input order
+    @staticmethod
+    def upload_lists(items: list[tuple[bytes, str]], max_workers=UPLOAD_WORKERS, **kwargs) -> list[Stats]:
+        if not items:
+            return []
+
+        Transfer.get_manifest()
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as workers:
+            report = list(workers.map(lambda item: Transfer.put_list(*item, **kwargs), items))
+        Transfer.write_manifest()
+
+        failed = [r["key"] for r in report if r["status"] == "failed"]
+        skipped = sum(1 for r in report if r["status"] == "skipped")
+        log.info(f"uploaded {len(report) - len(failed) - skipped}/{len(report)} lists, {skipped} unchanged")
+        if failed:
+            log.error(f"failed uploads: {failed}")
+        return report
 
     @staticmethod
     def with_url_path(url, path_prefix="/"):
         return f"{path_prefix}{urlparse(url).path}"
     
     @classmethod
-    def download_list(cls, url):
+    # refresh revalidates a cached copy with the server instead of waiting for it to expire
+    def download_list(cls, url, refresh=False):
         try:
-            response = cls.session.get(url, stream=False)
+            response = cls.get_session().get(url, stream=False, refresh=refresh)
             response.raise_for_status()  # Check for any errors
             log.info(f"completed download of {url}")
             return response.content, response.from_cache
@@ -91,17 +217,4 @@ class Transfer:
     @staticmethod
     def url_hash(url) -> str:
         return Transfer.url_hash_uuid(url)
-    
-    
 
-# monkey patching for mock upload
-if globals().get('mock_upload', bool(strtobool(os.environ.get("MOCK", "False")))):
-    def upload_list(body: bytes, url: str, **kwargs) -> bool:
-        key = Transfer.with_url_path(url, **kwargs)
-        with Utils.get_create_dir("mock_upload").joinpath(key.replace('/', '_')).open("w") as fp:
-                fp.write(body.decode("utf-8"))
-        return True
-        
-    log.info("using mock upload")
-    Transfer.upload_list = upload_list
-    
\ No newline at end of file
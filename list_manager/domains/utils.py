@@ -1,6 +1,6 @@
 import re
 from enum import IntEnum
-from tld import get_tld, get_fld
+from typing import Generator, Optional
 from .. import log, DataSet
 
 class FileSet(IntEnum):
@@ -9,15 +9,58 @@ class FileSet(IntEnum):
         invalid = 2
         dup_domains = 3
         dup_patterns = 4
+        # stably unresolvable, left out of the payload when pruning
+        pruned = 5
 
         def __str__(self):
             return f'{self.name}'
 
 class DomainUtils:
+    # ||example.com^ (adblock, AdGuard $important) and address=/example.com/0.0.0.0
+    # (dnsmasq) block a domain and its subdomains, like a plain entry. Only sinkhole
+    # addresses count, and server=/local= without an upstream (answered locally);
+    # entries forwarding to a server or pointing at a real address are not blocks
+    ANCHORS = (
+        re.compile(r"\|\|((?:\*\.)?[\w.-]+)\^(?:\$important)?"),
+        re.compile(r"address=/([\w.-]+)/(?:0\.0\.0\.0|::|#)?"),
+        re.compile(r"(?:server|local)=/([\w.-]+)/"),
+    )
+    # [Adblock Plus 2.0] style list headers
+    HEADER = re.compile(r"\[(?:adblock|adguard|ublock)[^\]]*\]", re.IGNORECASE)
+
+    @classmethod
+    def normalize(cls, entry: str) -> tuple[str, bool]:
+        for anchor in cls.ANCHORS:
+            m = anchor.fullmatch(entry)
+            if m:
+                return m.group(1), True
+        return entry, False
+
     @staticmethod
     def is_pattern(domain) -> bool:
         return re.search(r"[*?^[\]()|$]|(\\.)", domain) is not None
 
+    @staticmethod
+    def compile_pattern(pattern: str) -> re.Pattern:
+        # patterns are kept in blocky /regex/ notation
+        if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+            pattern = pattern[1:-1]
+        return re.compile(pattern)
+
+    @staticmethod
+    def pattern_suffix(pattern: str) -> Optional[str]:
+        # "/.*\.example\.com/" is a plain wildcard-prefix rule, i.e. a suffix
+        m = re.fullmatch(r"/\.\*\\\.((?:[\w-]+\\\.)+[\w-]+)/", pattern)
+        return m.group(1).replace("\\.", ".") if m else None
+
+    @staticmethod
+    def parents(domain: str) -> Generator[str, None, None]:
+        # proper parent suffixes, nearest first
+        idx = domain.find(".")
+        while idx != -1:
+            yield domain[idx + 1:]
+            idx = domain.find(".", idx + 1)
+
     @staticmethod
     def add(d, major, dup=None):
         if d not in major:
@@ -29,18 +72,22 @@ class DomainUtils:
             major.add(f'{d}_{len(major)}')
 
     @staticmethod
-    def clean_list(lines: list[str]) -> tuple[dict[str, set], dict[str, int]]:
-        domains = set()
+    def clean_list(lines: list[str], domains=None) -> tuple[dict[str, set], dict[str, int]]:
+        # domains can be collected in sorted runs on disk instead of a set
+        domains = set() if domains is None else domains
         patterns = set()
         invalid = set()
         comments = 0
+        normalized = 0
         dup_domains = set()
         dup_patterns = set()
+        from tld import get_tld, get_fld
 
         for line in lines:
             line = line.strip()
 
-            if line.startswith("#") or not line:
+            # "!" starts adblock comments
+            if line.startswith(("#", "!")) or not line or DomainUtils.HEADER.fullmatch(line):
                 comments += 1
                 continue
 
@@ -50,8 +97,11 @@ class DomainUtils:
                 raise (ValueError(f"error: empty after split to parts: {line}"))
 
             d = parts[1] if len(parts) > 1 else parts[0]
+            d, anchored = DomainUtils.normalize(d)
+            normalized += anchored
 
-            if "." not in d:
+            # adblock exceptions (@@) allow rather than block
+            if "." not in d or d.startswith("@@"):
                 DomainUtils.add(d, invalid)
                 continue
 
@@ -92,7 +142,8 @@ class DomainUtils:
             'lines': lines_len,
             'processed': processed,
             **lengths,
-            'comments': comments
+            'comments': comments,
+            'normalized': normalized,
         }
 
         return domain_sets, stats
\ No newline at end of file
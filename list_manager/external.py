@@ -0,0 +1,173 @@
+import os
+import heapq
+import tempfile
+from pathlib import Path
+from typing import Generator, Iterable, Optional
+from .table import HostTable
+from . import Utils
+
+# MiB of unsorted strings held before a sorted run is spilled to disk. When set,
+# the domains of parsed lists live in memory mapped sorted tables, not in sets
+MEMORY_BUDGET = int(float(os.environ.get("MEMORY_BUDGET_MB", 0)) * (1 << 20))
+# approximate cost of a str in a set besides its characters
+ENTRY_OVERHEAD = 80
+
+
+def merge_unique(*iterables: Iterable[str]) -> Generator[str, None, None]:
+    last = None
+    for item in heapq.merge(*iterables):
+        if item != last:
+            yield item
+            last = item
+
+
+# items of sorted left also in sorted right
+def merge_intersection(left: Iterable[str], right: Iterable[str]) -> Generator[str, None, None]:
+    right = iter(right)
+    other = next(right, None)
+    for item in left:
+        while other is not None and other < item:
+            other = next(right, None)
+        if other is None:
+            return
+        if other == item:
+            yield item
+
+
+# items of sorted left in none of the sorted others
+def merge_difference(left: Iterable[str], *others: Iterable[str]) -> Generator[str, None, None]:
+    merged = heapq.merge(*others)
+    other = next(merged, None)
+    for item in left:
+        while other is not None and other < item:
+            other = next(merged, None)
+        if other != item:
+            yield item
+
+
+# Collects strings under a memory budget: every time the buffer outgrows it,
+# the buffer is written out sorted, and iterating k-way merges the runs.
+class SortedRuns:
+    def __init__(self, budget=MEMORY_BUDGET, directory: Optional[Path] = None):
+        self.budget = budget
+        self.directory = directory or Utils.get_create_dir("external")
+        self.buffer = set()
+        self.size = 0
+        self.count = 0
+        self.runs: list[Path] = []
+
+    def add(self, item: str) -> None:
+        if item not in self.buffer:
+            self.buffer.add(item)
+            self.count += 1
+            self.size += len(item) + ENTRY_OVERHEAD
+            if self.budget and self.size > self.budget:
+                self.spill()
+
+    def update(self, items: Iterable[str]) -> None:
+        for item in items:
+            self.add(item)
+
+    def spill(self) -> None:
+        fd, name = tempfile.mkstemp(suffix=".run", dir=self.directory)
+        with open(fd, mode="w", encoding="utf-8") as fp:
+            fp.writelines(f"{item}\n" for item in sorted(self.buffer))
+        self.runs.append(Path(name))
+        self.buffer.clear()
+        self.size = 0
+
+    @staticmethod
+    def read_run(path: Path) -> Generator[str, None, None]:
+        with path.open(encoding="utf-8") as fp:
+            for line in fp:
+                yield line[:-1]
+
+    def __iter__(self):
+        return merge_unique(*[self.read_run(p) for p in self.runs], sorted(self.buffer))
+
+    # membership and length only know the buffer: an item repeated in another
+    # run is counted again and merged when iterated
+    def __contains__(self, item: str) -> bool:
+        return item in self.buffer
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        for p in self.runs:
+            p.unlink(missing_ok=True)
+        self.runs.clear()
+        self.buffer.clear()
+
+
+# Read-only set of strings in a memory mapped HostTable, iterated in sorted order.
+# Operations with another ExternalSet are merges, with an in memory set they
+# stream this side and probe the other; results are plain sets.
+class ExternalSet:
+    # written to JSON item by item, see JsonFile.encode_json
+    streamed = True
+
+    def __init__(self, table: HostTable, path: Path):
+        self.table = table
+        self.path = path
+
+    @classmethod
+    def open(cls, path: Path) -> "ExternalSet":
+        return cls(HostTable.open(path), path)
+
+    @classmethod
+    def build(cls, path: Path, items: Iterable[str], budget=MEMORY_BUDGET) -> "ExternalSet":
+        if isinstance(items, (set, frozenset, ExternalSet)):
+            HostTable.write_sorted(path, sorted(items) if isinstance(items, (set, frozenset)) else items)
+            return cls.open(path)
+        # items already collected in runs are written and the runs released
+        runs = items if isinstance(items, SortedRuns) else SortedRuns(budget, path.parent)
+        try:
+            if runs is not items:
+                runs.update(items)
+            HostTable.write_sorted(path, runs)
+        finally:
+            runs.close()
+        return cls.open(path)
+
+    @classmethod
+    def union(cls, path: Path, sets: list[Iterable[str]], budget=MEMORY_BUDGET) -> "ExternalSet":
+        if all(isinstance(s, ExternalSet) for s in sets):
+            HostTable.write_sorted(path, merge_unique(*sets))
+            return cls.open(path)
+        return cls.build(path, (item for s in sets for item in s), budget)
+
+    def close(self) -> None:
+        self.table.close()
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def __contains__(self, item: str) -> bool:
+        return self.table.find(item) is not None
+
+    def __iter__(self):
+        return iter(self.table)
+
+    # immutable, copies of the list files that hold it share it
+    def __deepcopy__(self, memo):
+        return self
+
+    # reopened by path in the worker processes of a bulk write
+    def __reduce__(self):
+        return ExternalSet.open, (self.path,)
+
+    def intersection(self, *others) -> set[str]:
+        result = None
+        for other in others:
+            if isinstance(other, ExternalSet):
+                items = merge_intersection(self if result is None else sorted(result), other)
+            else:
+                items = (item for item in (self if result is None else result) if item in other)
+            result = set(items)
+        return set(self) if result is None else result
+
+    def difference(self, *others) -> set[str]:
+        external = [o for o in others if isinstance(o, ExternalSet)]
+        others = [o for o in others if not isinstance(o, ExternalSet)]
+        return {item for item in merge_difference(self, *external) if not any(item in o for o in others)}
@@ -0,0 +1,248 @@
+import re
+import sys
+import json
+import struct
+import argparse
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Optional
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from .domains.utils import DomainUtils, FileSet
+from .resolver.utils import ResolverSet
+from .table import HostTable
+from . import log, Utils
+
+
+# Read-only answer to "is this domain listed, by which sources, and does it
+# resolve", built from the final parsed, deduplicated and resolved state.
+# Every domain of every source is a key of a memory mapped HostTable whose
+# value points at the sources listing it and holds its resolver status; the
+# sources and the patterns are kept in a JSON sidecar of the same generation.
+# Like blocky, an entry also covers the subdomains of what it lists, and
+# whitelist matches win.
+class LookupIndex(DomainUtils):
+    VALUE = struct.Struct("<IB")  # combination of sources, resolver status
+    UNKNOWN = 0xFF
+    CURRENT = "CURRENT"
+    KEEP = 2
+
+    def __init__(self, table: HostTable, meta: dict):
+        if meta.get("count") != len(table):
+            raise (ValueError("lookup table and sidecar are from different builds"))
+        self.table = table
+        self.meta = meta
+        self.sources = meta["sources"]
+        self.combos = [tuple(map(tuple, c)) for c in meta["combos"]]
+
+        suffixes, regexes = dict(), []
+        for pattern, src, published in meta["patterns"]:
+            suffix = self.pattern_suffix(pattern)
+            if suffix:
+                suffixes.setdefault(suffix, []).append((pattern, src, published))
+                continue
+            try:
+                regexes.append((self.compile_pattern(pattern), pattern, src, published))
+            except re.error as e:
+                log.error(f"skipping pattern {pattern}: {e}")
+        self.suffixes = {k: tuple(v) for k, v in suffixes.items()}
+        self.regexes = tuple(regexes)
+        # single pass pre-filter, per pattern attribution only runs on a hit
+        self.combined = re.compile("|".join(f"(?:{m.pattern})" for m, *_ in regexes)) if regexes else None
+
+    @staticmethod
+    def directory() -> Path:
+        return Utils.get_create_dir("lookup")
+
+    @classmethod
+    def build(cls, binder, resolver=None) -> tuple[bytes, bytes]:
+        sources, listed, patterns = [], dict(), []
+        for g in binder.group_iter():
+            for d in g.iter_domain_files():
+                src = len(sources)
+                sources.append({"name": d.name, "category": g.category, "url": d.url, "whitelist": bool(g.wl_type)})
+                # domains deduplicated or whitelisted away are attributed, but not published
+                published = d.payload_domains()
+                for domain in d.get_set(FileSet.domains):
+                    listed.setdefault(domain, []).append((src, int(domain in published)))
+                published = d.payload_patterns()
+                patterns += [[p, src, int(p in published)] for p in sorted(d.get_set(FileSet.patterns))]
+
+        status = dict()
+        if resolver is not None:
+            for e, domains in resolver.get_sets().items():
+                status.update(dict.fromkeys(domains.intersection(listed), ResolverSet[e].value))
+
+        combos = dict()
+        entries = [
+            (domain, cls.VALUE.pack(combos.setdefault(tuple(srcs), len(combos)), status.get(domain, cls.UNKNOWN)))
+            for domain, srcs in listed.items()
+        ]
+        meta = {
+            "built": str(datetime.now()),
+            "count": len(entries),
+            "sources": sources,
+            "combos": [list(map(list, c)) for c in combos],
+            "patterns": patterns,
+        }
+        log.info(f"lookup index: {len(entries)} domains, {len(patterns)} patterns, {len(sources)} sources, {len(combos)} source combinations")
+        return HostTable.build(entries, cls.VALUE.size), json.dumps(meta).encode("utf-8")
+
+    # every build is a new generation of table and sidecar, then the CURRENT pointer
+    # is swapped by rename, so a reader opens either the old or the new pair
+    @classmethod
+    def write(cls, binder, resolver=None, directory: Optional[Path] = None) -> Path:
+        directory = directory or cls.directory()
+        table, meta = cls.build(binder, resolver)
+        current = cls.current(directory)
+        generation = current["generation"] + 1 if current else 1
+        names = {"table": f"lookup.{generation:08d}.hosts", "meta": f"lookup.{generation:08d}.json"}
+        HostTable.write(directory.joinpath(names["meta"]), meta)
+        HostTable.write(directory.joinpath(names["table"]), table)
+        HostTable.write(directory.joinpath(cls.CURRENT), json.dumps({"generation": generation, **names}).encode("utf-8"))
+
+        for old in [*directory.glob("lookup.*.hosts"), *directory.glob("lookup.*.json")]:
+            if int(old.name.split(".")[1]) <= generation - cls.KEEP:
+                old.unlink(missing_ok=True)
+        return directory
+
+    @classmethod
+    def current(cls, directory: Path) -> Optional[dict]:
+        path = directory.joinpath(cls.CURRENT)
+        return json.loads(path.read_bytes()) if path.exists() else None
+
+    # a build between reading the pointer and opening its files is retried
+    @classmethod
+    def open(cls, directory: Optional[Path] = None, retries=3) -> "LookupIndex":
+        directory = directory or cls.directory()
+        for _ in range(retries):
+            current = cls.current(directory)
+            if current is None:
+                raise (FileNotFoundError(f"no lookup index in {directory}"))
+            try:
+                meta = json.loads(directory.joinpath(current["meta"]).read_bytes())
+                return cls(HostTable.open(directory.joinpath(current["table"])), {**meta, "generation": current["generation"]})
+            except FileNotFoundError:
+                continue
+        raise (FileNotFoundError(f"lookup index in {directory} kept changing"))
+
+    def close(self) -> None:
+        self.table.close()
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def source(self, src: int, published: int, **extra) -> dict:
+        s = self.sources[src]
+        return {**extra, "source": s["name"], "category": s["category"], "whitelist": s["whitelist"], "published": bool(published)}
+
+    def listed(self, domain: str) -> tuple[Optional[int], tuple]:
+        i = self.table.find(domain)
+        if i is None:
+            return None, ()
+        combo, status = self.VALUE.unpack(self.table.value(i))
+        return status, self.combos[combo]
+
+    def lookup(self, domain: str) -> dict:
+        domain = domain.strip().rstrip(".").lower()
+        status, exact = self.listed(domain)
+        matches = [self.source(src, pub, match="exact") for src, pub in exact]
+
+        for parent in self.parents(domain):
+            _, srcs = self.listed(parent)
+            matches += [self.source(src, pub, match="suffix", entry=parent) for src, pub in srcs]
+            matches += [self.source(src, pub, match="pattern", entry=p) for p, src, pub in self.suffixes.get(parent, ())]
+
+        if self.combined and self.combined.match(domain):
+            matches += [self.source(src, pub, match="pattern", entry=p) for m, p, src, pub in self.regexes if m.match(domain)]
+
+        whitelisted = any(m["whitelist"] for m in matches)
+        return {
+            "domain": domain,
+            "blocked": not whitelisted and any(m["published"] and not m["whitelist"] for m in matches),
+            "whitelisted": whitelisted,
+            "categories": sorted({m["category"] for m in matches}),
+            "status": None if status in (None, self.UNKNOWN) else ResolverSet(status).name,
+            "matches": matches,
+        }
+
+    def lookup_many(self, domains: Iterable[str]) -> list[dict]:
+        return [self.lookup(d) for d in domains if d.strip()]
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    index: LookupIndex = None
+
+    def reply(self, code: int, body) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # GET /lookup?domain=a&domain=b
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/lookup":
+            return self.reply(200, self.index.lookup_many(parse_qs(url.query).get("domain", [])))
+        if url.path == "/health":
+            return self.reply(200, {"count": len(self.index), "built": self.index.meta["built"]})
+        self.reply(404, {"error": "not found"})
+
+    # POST /lookup with a JSON list or one domain per line
+    def do_POST(self):
+        if urlparse(self.path).path != "/lookup":
+            return self.reply(404, {"error": "not found"})
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        try:
+            domains = json.loads(body) if body.lstrip().startswith("[") else body.splitlines()
+        except json.JSONDecodeError as e:
+            return self.reply(400, {"error": str(e)})
+        self.reply(200, self.index.lookup_many(domains))
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def serve(index: LookupIndex, host="127.0.0.1", port=8954) -> ThreadingHTTPServer:
+    handler = type("Handler", (LookupHandler,), {"index": index})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="list_manager.lookup")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("build", help="build the index from the parsed lists and the resolver cache")
+    query = commands.add_parser("query", help="look domains up, from the arguments or stdin")
+    query.add_argument("domains", nargs="*")
+    server = commands.add_parser("serve", help="answer lookups over http")
+    server.add_argument("--host", default="127.0.0.1")
+    server.add_argument("--port", type=int, default=8954)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        from .domains import Binder
+        from .resolver import AsyncResolver
+        binder = Binder()
+        binder.groups  # loads the lists
+        log.info(f"lookup index written to {LookupIndex.write(binder, AsyncResolver())}")
+        return
+
+    index = LookupIndex.open()
+    if args.command == "query":
+        for result in index.lookup_many(args.domains or sys.stdin):
+            print(json.dumps(result))
+    if args.command == "serve":
+        httpd = serve(index, args.host, args.port)
+        log.info(f"lookup endpoint on http://{args.host}:{args.port}/lookup")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            index.close()
+
+if __name__ == "__main__":
+    main()
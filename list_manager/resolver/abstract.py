@@ -1,6 +1,25 @@
 from abc import ABC, abstractmethod
+from functools import wraps
+from threading import Lock, RLock
 import asyncio
 
+
+# guards the one time creation of the instance locks
+_synchronized_create = Lock()
+
+
+# serializes method calls per instance, the lock is created on the first call
+def synchronized(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        lock = self.__dict__.get("_synchronized_lock")
+        if lock is None:
+            with _synchronized_create:
+                lock = self.__dict__.setdefault("_synchronized_lock", RLock())
+        with lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
 class SingletonInst(ABC):
     _instance = None
 
@@ -26,21 +45,64 @@ class SemaphoreDecorator:
 
 class AsyncBatchWriter(ABC, SemaphoreDecorator):
     def __init__(self):
-        self.write_batch = self.wrap(asyncio.Semaphore(1))(self.write_batch)
+        self.persist = self.wrap(asyncio.Semaphore(1))(self.persist)
 
+    # merge a batch into the in memory state
     @abstractmethod
-    async def write_batch(self, batch, **kwargs):
+    def apply_batch(self, batch, **kwargs):
+        pass
+
+    # write the in memory state out
+    @abstractmethod
+    async def persist(self):
         pass
 
+    async def write_batch(self, batch, **kwargs):
+        self.apply_batch(batch, **kwargs)
+        await self.persist()
+
 class AsyncBatchProcessor(ABC, SemaphoreDecorator):
+    # up/down signal of the path items are processed over (see tunnel.health)
+    health = None
+
     def __init__(self, max_concurrent_tasks=5, batch_size=10):
         self.batch_size = batch_size     
         self.process = self.wrap(asyncio.Semaphore(max_concurrent_tasks))(self.process)
+        self.requeued = 0
         
     @abstractmethod
     async def process(self, item):
         pass
 
+    # runs step once health is up. a step still in flight when it goes down is
+    # cancelled, and a transient result produced while it is down is dropped;
+    # either way the step reruns after health comes back
+    async def when_up(self, step, transient=lambda result: False):
+        while True:
+            if self.health is None:
+                return await step()
+
+            await self.health.wait_up()
+            task = asyncio.ensure_future(step())
+            down = asyncio.ensure_future(self.health.wait_down())
+            await asyncio.wait({task, down}, return_when=asyncio.FIRST_COMPLETED)
+            down.cancel()
+            if task.done():
+                result = task.result()
+                if self.health.is_up or not transient(result):
+                    return result
+            else:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            self.requeued += 1
+
+    async def close(self):
+        pass
+
+    # results for items accepted but not finished when processing stops early
+    def abandon(self) -> list:
+        return []
+
     # process items in smaller batches
     async def process_batch(self, items):
         self.batch_size = min(self.batch_size, len(items))
@@ -0,0 +1,115 @@
+import os
+from time import time
+from threading import RLock
+from typing import Optional
+import dns.message
+import dns.rdatatype
+from .utils import ResolverSet
+from .. import log, JsonFile
+
+NEGATIVE_TTL = int(os.environ.get("NEGATIVE_TTL", 300))
+# days a hop is kept after it was last seen in an answer, for alias grouping in later runs
+CNAME_RETENTION = float(os.environ.get("CNAME_RETENTION_DAYS", 30)) * 86400
+
+
+# Shared by the processor threads: every CNAME hop seen in an answer
+# (alias -> target) and the outcome of the name each chain ends at, both with
+# the TTL of their records and when they were first and last seen. A name whose
+# chain reaches an outcome within its TTL is settled without another query.
+# Persisted for CNAME_RETENTION, so later runs can tell which list entries are
+# aliases of one another long after the records expired.
+class CnameCache:
+    settled_sets = {ResolverSet.resolvable, ResolverSet.unresolvable}
+
+    def __init__(self, json_file="dns_cname_chains.json"):
+        self.file = JsonFile(json_file)
+        self.lock = RLock()
+        self.entries: Optional[dict[str, dict]] = None
+        self.hits = 0
+
+    def load(self) -> dict[str, dict]:
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.file.read() if self.file.exists() else dict()
+            return self.entries
+
+    def write(self) -> None:
+        with self.lock:
+            if self.entries is not None:
+                oldest = time() - CNAME_RETENTION
+                # entries from before first/last seen were kept expire by their ttl
+                self.entries = {k: v for k, v in self.entries.items() if v.get("last_seen", v["expires"]) > oldest}
+                self.file.write(self.entries)
+
+    @staticmethod
+    def chain(domain: str, response: dns.message.Message) -> tuple[list[tuple[str, str, int]], str, int]:
+        hops, name, ttl = [], domain.rstrip(".").lower(), None
+        cnames = {rrset.name.to_text(omit_final_dot=True).lower(): rrset
+                  for rrset in response.answer if rrset.rdtype == dns.rdatatype.CNAME}
+        while name in cnames and len(hops) < 16:
+            rrset = cnames.pop(name)
+            target = rrset[0].target.to_text(omit_final_dot=True).lower()
+            hops.append((name, target, rrset.ttl))
+            name = target
+
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.A:
+                ttl = rrset.ttl if ttl is None else min(ttl, rrset.ttl)
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                ttl = min(rrset.ttl, rrset[0].minimum)
+        return hops, name, NEGATIVE_TTL if ttl is None else ttl
+
+    def record(self, domain: str, response: Optional[dns.message.Message], outcome: ResolverSet) -> None:
+        if response is None or outcome not in self.settled_sets:
+            return
+
+        hops, target, ttl = self.chain(domain, response)
+        if not hops:
+            return
+
+        now = time()
+        # loaded under the lock, a concurrent write replaces the entries
+        with self.lock:
+            entries = self.load()
+            for alias, next_hop, hop_ttl in hops:
+                self.seen(entries, alias, {"target": next_hop}, now, hop_ttl)
+            self.seen(entries, target, {"outcome": str(outcome)}, now, ttl)
+
+    # first seen is kept while the hop (or outcome) stays the same
+    @staticmethod
+    def seen(entries: dict[str, dict], name: str, value: dict, now: float, ttl: int) -> None:
+        entry = entries.get(name, dict())
+        same = all(entry.get(k) == v for k, v in value.items())
+        entries[name] = {**value, "expires": now + ttl, "first_seen": entry.get("first_seen", now) if same else now, "last_seen": now}
+
+    def settle(self, domain: str) -> Optional[ResolverSet]:
+        entries = self.load()
+        name, now = domain.rstrip(".").lower(), time()
+        for _ in range(16):
+            entry = entries.get(name)
+            if entry is None or entry["expires"] <= now:
+                return None
+            if "outcome" in entry:
+                self.hits += 1
+                return ResolverSet[entry["outcome"]]
+            name = entry["target"]
+        return None
+
+    # chain end -> every name that is an alias of it
+    def aliases(self) -> dict[str, set[str]]:
+        entries = self.load()
+        groups = dict()
+        for name, entry in entries.items():
+            if "target" not in entry:
+                continue
+            target = entry["target"]
+            for _ in range(16):
+                if "target" not in entries.get(target, ()):
+                    break
+                target = entries[target]["target"]
+            groups.setdefault(target, set()).add(name)
+        return groups
+
+    def log(self) -> None:
+        log.info(f"cname cache: {len(self.load())} entries, {self.hits} settled without a query")
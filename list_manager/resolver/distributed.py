@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import argparse
+import itertools
+from collections import deque
+from functools import partial
+from threading import Lock
+from typing import Optional
+from .abstract import AsyncBatchWriter
+from .executer import ThreadedAsyncExecuter, FLUSH_INTERVAL
+from .utils import ResolverSet
+from .. import log, Stats
+
+# workers on other hosts reach the coordinator through a tunnel or a trusted network
+COORDINATOR_ADDRESS = os.environ.get("COORDINATOR_ADDRESS", "127.0.0.1:8853")
+COORDINATOR_TOKEN = os.environ.get("COORDINATOR_TOKEN", "")
+# seconds a worker holds a chunk without reporting before it is handed out again
+LEASE_TTL = float(os.environ.get("LEASE_TTL", 120))
+LINE_LIMIT = 1 << 24
+
+
+def parse_address(value: str) -> tuple[str, int]:
+    host, _, port = value.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class Lease:
+    def __init__(self, lease_id: int, domains: list[str], worker: str, ttl: float):
+        self.id = lease_id
+        self.remaining = set(domains)
+        self.worker = worker
+        self.ttl = ttl
+        self.renew()
+
+    def renew(self) -> None:
+        self.expires = time.monotonic() + self.ttl
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() > self.expires
+
+
+# Hands out the domains to resolve in leased chunks over a JSON lines protocol
+# and merges the results streamed back into the writer (the resolver cache).
+# A domain is merged once, by the first result for it, so results of a chunk
+# that was reissued after its lease expired are harmless. Requests:
+#   {"op": "lease", "worker": name} -> {"lease", "domains", "ttl"} | {"wait": s} | {"done": true}
+#   {"op": "results", "lease": id, "results": [[domain, set], ...]} -> {"merged": n}, renews the lease
+#   {"op": "complete", "lease": id} -> {"ok": true}
+class Coordinator:
+    def __init__(self, writer: AsyncBatchWriter, domains: set[str], chunk_size=500, lease_ttl=LEASE_TTL,
+                 address=COORDINATOR_ADDRESS, token=COORDINATOR_TOKEN, flush_interval=FLUSH_INTERVAL, linger=5.0):
+        self.writer = writer
+        self.outstanding = set(domains)
+        ordered = sorted(self.outstanding)
+        self.pending = deque(ordered[i:i + chunk_size] for i in range(0, len(ordered), chunk_size))
+        self.lease_ttl = lease_ttl
+        self.address = parse_address(address)
+        self.token = token
+        self.flush_interval = flush_interval
+        # workers asking after the last result still learn that the work is done
+        self.linger = linger
+        self.leases: dict[int, Lease] = dict()
+        self.ids = itertools.count(1)
+        self.stats = Stats()
+        self.dirty = False
+        self.finished: Optional[asyncio.Event] = None
+
+    def lease(self, worker: str) -> dict:
+        while self.pending:
+            domains = [d for d in self.pending.popleft() if d in self.outstanding]
+            if domains:
+                lease = Lease(next(self.ids), domains, worker, self.lease_ttl)
+                self.leases[lease.id] = lease
+                self.stats["leased"] += 1
+                return {"lease": lease.id, "domains": domains, "ttl": self.lease_ttl}
+        if self.outstanding:
+            return {"wait": 1.0}
+        return {"done": True}
+
+    def merge(self, lease_id: int, results: list[list[str]]) -> int:
+        lease = self.leases.get(lease_id)
+        if lease:
+            lease.renew()
+        batch = []
+        for domain, name in results:
+            if domain in self.outstanding:
+                self.outstanding.discard(domain)
+                batch.append((ResolverSet[name], domain))
+            else:
+                self.stats["duplicates"] += 1
+            if lease:
+                lease.remaining.discard(domain)
+        if batch:
+            self.writer.apply_batch(batch)
+            self.dirty = True
+            self.stats["merged"] += len(batch)
+        self.check_finished()
+        return len(batch)
+
+    def complete(self, lease_id: int) -> None:
+        lease = self.leases.pop(lease_id, None)
+        if lease:
+            self.requeue(lease)
+        self.check_finished()
+
+    def requeue(self, lease: Lease) -> None:
+        remaining = lease.remaining & self.outstanding
+        if remaining:
+            self.pending.append(sorted(remaining))
+            self.stats["requeued"] += len(remaining)
+
+    def expire(self) -> None:
+        for lease in [lease for lease in self.leases.values() if lease.expired]:
+            log.warning(f"lease {lease.id} of {lease.worker} expired, reissuing {len(lease.remaining)} domains")
+            del self.leases[lease.id]
+            self.stats["expired"] += 1
+            self.requeue(lease)
+
+    def check_finished(self) -> None:
+        if not self.outstanding:
+            self.finished.set()
+
+    def dispatch(self, request: dict) -> dict:
+        if request.get("token", "") != self.token:
+            return {"error": "bad token"}
+        op = request.get("op")
+        if op == "lease":
+            return self.lease(request.get("worker", "?"))
+        if op == "results":
+            return {"merged": self.merge(request["lease"], request["results"])}
+        if op == "complete":
+            self.complete(request["lease"])
+            return {"ok": True}
+        return {"error": f"unknown op {op}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername")
+        try:
+            while line := await reader.readline():
+                reply = self.dispatch(json.loads(line))
+                writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+                await writer.drain()
+                if "error" in reply:
+                    log.error(f"worker {peer}: {reply['error']}")
+                    break
+        except (ConnectionError, json.JSONDecodeError, KeyError, ValueError) as e:
+            log.error(f"worker {peer}: {e}")
+        finally:
+            writer.close()
+
+    # expires leases and persists merged results at most once per flush interval
+    async def maintain(self) -> None:
+        while True:
+            await asyncio.sleep(min(1.0, self.flush_interval))
+            self.expire()
+            if self.dirty and time.monotonic() - self.last_flush >= self.flush_interval:
+                await self.flush()
+
+    async def flush(self) -> None:
+        self.dirty = False
+        self.last_flush = time.monotonic()
+        await self.writer.persist()
+        log.info(f"coordinator: {len(self.outstanding)} outstanding, {len(self.leases)} leases, {dict(self.stats)}")
+
+    async def serve(self) -> None:
+        self.finished = asyncio.Event()
+        self.last_flush = time.monotonic()
+        self.check_finished()
+        server = await asyncio.start_server(self.handle, *self.address, limit=LINE_LIMIT)
+        self.address = server.sockets[0].getsockname()[:2]
+        log.info(f"coordinator on {self.address[0]}:{self.address[1]}, {len(self.outstanding)} domains in {len(self.pending)} chunks")
+        maintain = asyncio.create_task(self.maintain())
+        try:
+            await self.finished.wait()
+            await asyncio.sleep(self.linger)
+        finally:
+            maintain.cancel()
+            server.close()
+            await self.flush()
+
+    def run(self) -> None:
+        asyncio.run(self.serve())
+
+
+class LeaseClient:
+    def __init__(self, address: tuple[str, int], token=COORDINATOR_TOKEN):
+        self.token = token
+        self.sock = socket.create_connection(address)
+        self.file = self.sock.makefile("rwb")
+        self.lock = Lock()
+
+    def request(self, message: dict) -> dict:
+        with self.lock:
+            self.file.write(json.dumps({**message, "token": self.token}).encode("utf-8") + b"\n")
+            self.file.flush()
+            line = self.file.readline()
+        if not line:
+            raise (ConnectionResetError("coordinator closed the connection"))
+        reply = json.loads(line)
+        if "error" in reply:
+            raise (RuntimeError(f"coordinator: {reply['error']}"))
+        return reply
+
+    def close(self) -> None:
+        self.file.close()
+        self.sock.close()
+
+
+# the executer writes into this instead of the cache, every persist sends the
+# results gathered so far to the coordinator, which also renews the lease
+class LeaseWriter(AsyncBatchWriter):
+    def __init__(self, client: LeaseClient, lease_id: int):
+        super().__init__()
+        self.client = client
+        self.lease_id = lease_id
+        self.buffer = []
+        self.lock = Lock()
+
+    def apply_batch(self, batch):
+        with self.lock:
+            self.buffer.extend((domain, str(e)) for e, domain in batch)
+
+    async def persist(self):
+        await asyncio.to_thread(self.flush)
+
+    def flush(self) -> None:
+        with self.lock:
+            results, self.buffer = self.buffer, []
+        if results:
+            self.client.request({"op": "results", "lease": self.lease_id, "results": results})
+
+
+# leases chunks from a coordinator and resolves them with the usual processor threads
+class ResolveWorker(ThreadedAsyncExecuter):
+    def __init__(self, address=COORDINATOR_ADDRESS, token=COORDINATOR_TOKEN, name=None, give_up=30.0, **kwargs):
+        super().__init__(**kwargs)
+        self.address = parse_address(address)
+        self.token = token
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        # seconds without reaching the coordinator before stopping
+        self.give_up = give_up
+        self.stats = Stats()
+
+    def run(self, health=None, **kwargs) -> None:
+        from .processor import AsyncResolveProcessor
+        processor_factory = partial(AsyncResolveProcessor, **kwargs)
+        client = None
+        unreachable_since = None
+        while True:
+            try:
+                client = client or LeaseClient(self.address, self.token)
+                unreachable_since = None
+                reply = client.request({"op": "lease", "worker": self.name})
+                if reply.get("done"):
+                    break
+                if "wait" in reply:
+                    time.sleep(reply["wait"])
+                    continue
+
+                writer = LeaseWriter(client, reply["lease"])
+                self.execute(reply["domains"], processor_factory=processor_factory, writer=writer,
+                             flush_interval=min(FLUSH_INTERVAL, reply["ttl"] / 4), health=health)
+                writer.flush()
+                client.request({"op": "complete", "lease": reply["lease"]})
+                self.stats["leases"] += 1
+                self.stats["domains"] += len(reply["domains"])
+            except (ConnectionError, OSError) as e:
+                if client:
+                    client.close()
+                    client = None
+                unreachable_since = unreachable_since or time.monotonic()
+                if time.monotonic() - unreachable_since > self.give_up:
+                    log.error(f"worker {self.name}: coordinator unreachable, giving up: {e}")
+                    break
+                log.warning(f"worker {self.name}: {e}, reconnecting")
+                time.sleep(1)
+        if client:
+            client.close()
+        log.info(f"worker {self.name} done {dict(self.stats)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="list_manager.resolver.distributed")
+    parser.add_argument("--address", default=COORDINATOR_ADDRESS)
+    commands = parser.add_subparsers(dest="command", required=True)
+    coordinator = commands.add_parser("coordinator", help="serve the cache refresh to workers")
+    coordinator.add_argument("--chunk-size", type=int, default=500)
+    coordinator.add_argument("--lease-ttl", type=float, default=LEASE_TTL)
+    worker = commands.add_parser("worker", help="resolve chunks leased from a coordinator")
+    worker.add_argument("--name")
+    worker.add_argument("--nameserver", action="append", help="udp://host:port or tcp://host:port")
+    worker.add_argument("--max-workers", type=int)
+    worker.add_argument("--concurrency", type=int, default=60)
+    args = parser.parse_args()
+
+    if args.command == "coordinator":
+        from .resolver import AsyncResolver
+        AsyncResolver().coordinate_refresh(chunk_size=args.chunk_size, lease_ttl=args.lease_ttl, address=args.address)
+    if args.command == "worker":
+        if args.nameserver:
+            from .processor import AsyncResolveProcessor
+            AsyncResolveProcessor.config_resolver(args.nameserver)
+        kwargs = {"max_workers": args.max_workers} if args.max_workers else {}
+        ResolveWorker(args.address, name=args.name, **kwargs).run(max_concurrent_tasks=args.concurrency, batch_size=50)
+
+if __name__ == "__main__":
+    main()
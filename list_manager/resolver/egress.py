@@ -0,0 +1,115 @@
+import bisect
+import hashlib
+from threading import Lock
+from typing import Optional
+from ..tunnel.health import TunnelHealth
+from .. import log, Stats
+
+
+# One way out: the nameservers reached over a tunnel, optionally from the local
+# address of its interface, and the health of that tunnel.
+class Egress:
+    def __init__(self, name: str, nameservers: list[str], source: Optional[str] = None,
+                 health: Optional[TunnelHealth] = None, weight=1.0):
+        self.name = name
+        self.nameservers = nameservers
+        self.source = source
+        self.health = health
+        self.weight = weight
+        self.inflight = 0
+        self.latency = 0.05  # seconds, moving average
+        self.stats = Stats()
+
+    @property
+    def is_up(self) -> bool:
+        return self.health is None or self.health.is_up
+
+    # DNS goes to the local udp end of a MuxTunnel or SSHUDPTunnel
+    @classmethod
+    def from_tunnel(cls, name: str, tunnel, **kwargs) -> "Egress":
+        host, port = tunnel.local_address[:2] if hasattr(tunnel, "local_address") else ("127.0.0.1", tunnel.local_port)
+        return cls(name, [f"udp://{host}:{port}"], health=tunnel.health, **kwargs)
+
+    # DNS is routed through the WireGuard interface by binding to its address,
+    # known once the manager has written its config
+    @classmethod
+    def from_wireguard(cls, name: str, manager, nameservers=("8.8.8.8", "8.8.4.4"), **kwargs) -> "Egress":
+        return cls(name, list(nameservers), source=manager.address, health=manager.health, **kwargs)
+
+
+# Spreads queries over several egress paths, so that per source rate limits of
+# public resolvers apply to each path separately. "hash" keeps a domain on the
+# same egress (consistent hashing, a lost egress only moves its own share),
+# "load" sends it to the egress with the fewest queries in flight per weight,
+# scaled by its observed latency. Egresses that are down are skipped.
+class EgressRouter:
+    policies = ("hash", "load")
+    smoothing = 0.1
+
+    def __init__(self, egresses: list[Egress], policy="hash", replicas=160):
+        if policy not in self.policies:
+            raise (ValueError(f"unknown egress policy {policy}"))
+        if len({e.name for e in egresses}) != len(egresses):
+            raise (ValueError("egress names must be unique"))
+        self.egresses = egresses
+        self.policy = policy
+        self.lock = Lock()
+        ring = sorted((self.hash(f"{e.name}#{i}"), n) for n, e in enumerate(egresses) for i in range(max(1, round(replicas * e.weight))))
+        self.ring_keys = [k for k, _ in ring]
+        self.ring = [n for _, n in ring]
+        # up while any egress is
+        self.health = TunnelHealth("egress", up=any(e.is_up for e in egresses))
+        for e in egresses:
+            if e.health:
+                e.health.subscribe(self.on_health)
+
+    @staticmethod
+    def hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def on_health(self, up: bool, reason: str) -> None:
+        available = [e.name for e in self.egresses if e.is_up]
+        if available:
+            self.health.set_up(f"{len(available)}/{len(self.egresses)} egresses up")
+        else:
+            self.health.set_down("no egress up")
+
+    def candidates(self, exclude: set[str]) -> list[Egress]:
+        candidates = [e for e in self.egresses if e.name not in exclude and e.is_up]
+        # every egress was tried or is down: better another try than none
+        return candidates or [e for e in self.egresses if e.name not in exclude] or self.egresses
+
+    def route(self, domain: str, exclude: set[str] = frozenset()) -> Egress:
+        candidates = self.candidates(exclude)
+        if self.policy == "load":
+            with self.lock:
+                return min(candidates, key=lambda e: (e.inflight + 1) * e.latency / e.weight)
+
+        allowed = {e.name for e in candidates}
+        start = bisect.bisect(self.ring_keys, self.hash(domain))
+        for i in range(len(self.ring)):
+            egress = self.egresses[self.ring[(start + i) % len(self.ring)]]
+            if egress.name in allowed:
+                return egress
+        return candidates[0]
+
+    def begin(self, egress: Egress) -> None:
+        with self.lock:
+            egress.inflight += 1
+            egress.stats["queries"] += 1
+
+    # outcome: answered, timeout or error
+    def end(self, egress: Egress, outcome: str, elapsed: float) -> None:
+        with self.lock:
+            egress.inflight -= 1
+            egress.stats[outcome] += 1
+            if outcome == "answered":
+                egress.latency += self.smoothing * (elapsed - egress.latency)
+
+    def stats(self) -> dict[str, dict]:
+        with self.lock:
+            return {e.name: {**e.stats, "latency_ms": round(e.latency * 1000, 1), "up": e.is_up} for e in self.egresses}
+
+    def log_stats(self) -> None:
+        for name, stats in self.stats().items():
+            log.info(f"egress {name}: {stats}")
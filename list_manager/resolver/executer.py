@@ -1,77 +1,127 @@
-import time
+import os
 import signal
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-from threading import Lock, Thread, get_ident
+from threading import Event, Thread, get_ident, current_thread, main_thread
 import multiprocessing as mp
-from .utils import RuntimeEstimator
+from .abstract import AsyncBatchWriter
+from .utils import RuntimeEstimator, ResultChannel
 from .. import log
 
+# seconds between persisting the writer state (group commit)
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 5))
+
+
 class ThreadedAsyncExecuter:
     def __init__(self, min_worker_share=100, max_workers=round(mp.cpu_count()*1.7)):
         self.max_workers = max(max_workers, 2)
         self.min_worker_share = min_worker_share
 
-    def execute(self, items, processor_factory, async_writer):
-        
+    # budget: RefreshBudget, processors stop after their current batch once it is spent
+    def execute(self, items, processor_factory, writer: AsyncBatchWriter, flush_interval=FLUSH_INTERVAL, channel_size=64,
+                health=None, budget=None):
+
         if not items:
             return
 
         writer_loop = asyncio.new_event_loop()
         estimator = RuntimeEstimator(total_items=len(items))
-        results_queue = asyncio.Queue()
-        processing_completed = asyncio.Event()  # New event for completion
-        
+        channel = ResultChannel(maxsize=channel_size)
+        stop_processing = budget.stop if budget else Event()
+
         from rich.progress import Progress
         def writer_thread_factory():
-            nonlocal writer_loop, estimator, results_queue, processing_completed
-            
+            nonlocal writer_loop, estimator, channel
+
+            # group commit: every pending batch is merged and applied at once,
+            # the state is persisted at most once per flush interval
             async def writer_wrapper():
-                # progress_bar = self.get_progress_bar()
-                bar = progress.add_task("[green]Resolving...", total=len(items))
-               
-                while not processing_completed.is_set():
-                     with Progress() as progress:
-                        try:
-                            results = await asyncio.wait_for(results_queue.get(), timeout=1.0)
-                            await async_writer(results)
+                channel.open()
+                dirty = False
+                last_flush = writer_loop.time()
+                with Progress() as progress:
+                    bar = progress.add_task("[green]Resolving...", total=len(items))
+
+                    # processors pause by themselves, the bar shows it
+                    def on_health(up, reason):
+                        description = "[green]Resolving..." if up else f"[yellow]Paused, {health.name} down"
+                        progress.update(bar, description=description)
+
+                    unsubscribe = health.subscribe(on_health) if health else None
+                    if health and not health.is_up:
+                        on_health(False, health.reason)
+
+                    async for results in channel.drain(timeout=flush_interval):
+                        if results:
+                            writer.apply_batch(results)
                             progress.update(bar, advance=len(results))
+                            estimator.update(0, len(results))
+                            dirty = True
+                            if budget:
+                                budget.spend(len(results))
+
+                        if dirty and writer_loop.time() - last_flush >= flush_interval:
+                            await writer.persist()
                             estimator.log()
-                        except asyncio.TimeoutError:
-                            # Timeout occurred, no item in the queue
-                            continue
-            
+                            dirty = False
+                            last_flush = writer_loop.time()
+
+                    if unsubscribe:
+                        unsubscribe()
+
+                if dirty:
+                    await writer.persist()
+
             def writer_loop_wrapper():
                 asyncio.set_event_loop(writer_loop)
                 try:
                     writer_loop.run_until_complete(writer_wrapper())
+                except Exception as e:
+                    log.exception(f"writer loop error: {e}")
                 finally:
+                    # producers blocked on a put, or about to put, fail instead of hanging
+                    channel.fail("writer loop exited")
                     # Cancel all pending tasks
                     for task in asyncio.all_tasks(writer_loop):
                         task.cancel()
                     writer_loop.run_until_complete(writer_loop.shutdown_asyncgens())
-                
+                    # unblock producers waiting on a dead writer
+                    stop_processing.set()
+
             return Thread(target=writer_loop_wrapper)
 
+        if budget:
+            budget.start()
+
         # Start the writer thread
         writer_thread = writer_thread_factory()
         writer_thread.start()
-        time.sleep(0.5)
+        channel.ready.wait()
 
         def processor_thread_factory(segment):
-            nonlocal writer_loop, estimator, results_queue
-  
+            nonlocal channel
+
             async def processor_wrapper():
                 ident = get_ident()
+                batch_processor = None
                 try:
                     batch_processor = processor_factory()
+                    if health:
+                        batch_processor.health = health
                     async for batch_results in batch_processor.process_batch(segment):
-                        await results_queue.put(batch_results)
-                        estimator.update(ident, len(batch_results))
-                        if processing_completed.is_set():
+                        await channel.put(batch_results)
+                        if stop_processing.is_set():
                             break  # Exit loop gracefully
+                    abandoned = batch_processor.abandon()
+                    if abandoned:
+                        await channel.put(abandoned)
                 except Exception as e:
                     log.exception(f"thread {ident} error in processor_wrapper: {e}")
+                finally:
+                    if batch_processor:
+                        await batch_processor.close()
+                        if batch_processor.requeued:
+                            log.info(f"thread {ident} requeued {batch_processor.requeued} items while {health.name} was down")
 
             processor_loop = asyncio.new_event_loop()
             def loop_wrapper():
@@ -92,45 +142,25 @@ class ThreadedAsyncExecuter:
                     log.info(f"thread {ident} processor loop closed")
 
             return loop_wrapper
-        
+
         # not less than min_worker_share items per thread.
         # if needed max threads shall be reduced accordingly
-        max_workers = max(1, min(len(items)/self.min_worker_share, self.max_workers))
+        max_workers = max(1, min(len(items) // self.min_worker_share, self.max_workers))
         workers = ThreadPoolExecutor(max_workers=max_workers)
-        shutdown_lock = Lock()
-         
-        def terminate(from_signal=False):
-            nonlocal workers, writer_loop
-            
-            with shutdown_lock:
-                if processing_completed.is_set():
-                   return
-                
-            writer_loop.call_soon_threadsafe(processing_completed.set)
-            log.info("writer & processor loops signaled to shutdown")
-            
-            if from_signal:
-                log.info("waiting for thread pool to finish")       
-                workers.shutdown(wait=True)
-                log.info("thread pool shutdown")
-
-            writer_thread.join()
-            log.info("writer thread shutdown")
-            
-            writer_loop.close()
-            log.info("writer loop shutdown")
-
-        # Register signal handlers
+
+        # processors stop after their current batch, the writer drains what was produced
         def handler(__signal, __frame):
-            terminate(from_signal=True)
-                
-        signals_to_handle = [signal.SIGINT, signal.SIGTERM]
-        for sig in signals_to_handle:
-            signal.signal(sig, handler)
+            log.info("processors signaled to shutdown")
+            stop_processing.set()
+
+        # signal handlers can only be installed from the main thread
+        if current_thread() is main_thread():
+            signals_to_handle = [signal.SIGINT, signal.SIGTERM]
+            for sig in signals_to_handle:
+                signal.signal(sig, handler)
 
         # Divide items into max_workers segments
         log.info(f'workers: {max_workers}, items: {len(items)}')
-        # with workers as ex:
         acc = 0
         for segment in [items[i::max_workers] for i in range(max_workers)]:
             processor_thread = processor_thread_factory(segment=segment)
@@ -138,6 +168,14 @@ class ThreadedAsyncExecuter:
             seg_len = len(segment)
             acc += seg_len
             log.info(f"thread items: {seg_len}, accumulated: {acc}")
-        
+
         workers.shutdown(wait=True)
-        terminate()
\ No newline at end of file
+        log.info("thread pool shutdown")
+
+        if writer_thread.is_alive():
+            channel.close()
+        writer_thread.join()
+        writer_loop.close()
+        if budget:
+            budget.cancel()
+        log.info("writer loop shutdown")
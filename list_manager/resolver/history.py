@@ -0,0 +1,61 @@
+import json
+from time import time
+from threading import Lock
+from typing import Optional
+from .utils import AsyncJsonFileWriter, ResolverSet
+
+
+# Per domain: when it was last resolved, to what, and how many results in a
+# row were that same outcome. Kept next to the cache, which only holds the
+# latest outcome. Entries are [time, ResolverSet value, streak] lists, so the
+# file is read without JsonFile's list to set conversion.
+class ResolveHistory(AsyncJsonFileWriter):
+    def __init__(self, json_file="dns_resolver_history.json"):
+        super().__init__(json_file=json_file)
+        self.lock = Lock()
+        self._entries: Optional[dict[str, list[int]]] = None
+
+    @property
+    def entries(self) -> dict[str, list[int]]:
+        with self.lock:
+            if self._entries is None:
+                self._entries = json.loads(self.file.read_bytes()) if self.file.exists() else dict()
+            return self._entries
+
+    def record(self, batch: list[tuple[ResolverSet, str]]) -> None:
+        entries = self.entries
+        now = int(time())
+        with self.lock:
+            for e, domain in batch:
+                last = entries.get(domain)
+                streak = last[2] + 1 if last and last[1] == e.value else 1
+                entries[domain] = [now, e.value, streak]
+
+    def last(self, domain: str) -> Optional[int]:
+        entry = self.entries.get(domain)
+        return entry[0] if entry else None
+
+    # consecutive results of the given outcome up to the latest one
+    def streak(self, domain: str, e: ResolverSet) -> int:
+        entry = self.entries.get(domain)
+        return entry[2] if entry and entry[1] == e.value else 0
+
+    def forget(self, keep: set[str]) -> None:
+        entries = self.entries
+        with self.lock:
+            self._entries = {k: v for k, v in entries.items() if k in keep}
+
+    def dump(self) -> str:
+        entries = self.entries
+        with self.lock:
+            return json.dumps(entries)
+
+    def save(self) -> None:
+        if self._entries is not None:
+            tmp = self.file.with_suffix(".tmp")
+            tmp.write_text(self.dump(), encoding="utf-8")
+            tmp.rename(self.file)
+
+    async def persist(self) -> None:
+        if self._entries is not None:
+            await self.write_dump(self.dump())
@@ -1,63 +1,187 @@
 import asyncio
+from collections import deque
+from time import monotonic
 import dns.resolver
-from dns.asyncresolver import Resolver
 from .abstract import AsyncBatchProcessor
+from .cname import CnameCache
+from .retry import RetryQueue, AttemptOutcomes
+from .transport import make_upstream, resolve
 from .utils import ResolverSet
 from list_manager import log
 
 class AsyncResolveProcessor(AsyncBatchProcessor):
-    resolver = Resolver()
-    resolver.nameservers = ["8.8.8.8", "8.8.4.4"]
-    resolver.rotate = True
+    # "8.8.8.8" or "udp://host:port" send datagrams,
+    # "tcp://host:port" pipelines queries over a few persistent connections
+    nameservers = ["8.8.8.8", "8.8.4.4"]
+    rotate = True
+    tcp_connections = 2
+    transient_sets = {ResolverSet.timeout, ResolverSet.nameServerError, ResolverSet.error}
+    # shared by all processor threads
+    cnames = CnameCache()
+    # EgressRouter when queries leave over several tunnels, nameservers are then per egress
+    router = None
+    pacer = None
+    # a retry avoids the upstream (or egress) that timed out
+    retry_elsewhere = True
+    outcomes = AttemptOutcomes()
 
-    def __init__(self, retries=3, lifetime=6, **kwargs):
+    # a timed out domain is retried after backoff * (retry - 1) seconds, with a
+    # lifetime of lifetime * (retry + 1), without holding a concurrency slot
+    def __init__(self, retries=3, lifetime=6, backoff=1.0, **kwargs):
         self.lifetime = lifetime
-        self.tcp = False
         self.retries = retries
+        self.backoff = backoff
+        self.retry_queue = RetryQueue()
+        # per domain in flight: attempts made, egresses and last upstream tried
+        self.attempts: dict[str, int] = dict()
+        self.tried: dict[str, set[str]] = dict()
+        self.last_upstream: dict[str, object] = dict()
+        # created per processor, connections belong to the loop of its thread
+        self.upstreams = [make_upstream(ns, connections=self.tcp_connections) for ns in self.nameservers]
+        self.egress_upstreams = {
+            e.name: [make_upstream(ns, source=e.source, connections=self.tcp_connections) for ns in e.nameservers]
+            for e in (self.router.egresses if self.router else ())
+        }
+        self.next_upstream = 0
         super().__init__(**kwargs)
 
     @classmethod
-    def config_resolver(cls, nameservers:list==["8.8.8.8", "8.8.4.4"], rotate=True):
-        cls.resolver.nameservers = nameservers
-        cls.resolver.rotate = rotate
-        
-    async def process(self, domain: str) -> (ResolverSet, str):
-        lifetime = self.resolver.lifetime
-        retries = 0
-        delay = 0
-
-        while retries <= self.retries:
-            try:
-                _ = await self.resolver.resolve(domain, "A", lifetime=lifetime, tcp=self.tcp)
-                log.info(f"{domain} resolved")
-                return (ResolverSet.resolvable, domain)
-            except dns.resolver.NXDOMAIN as e:
-                log.debug(f"{e}")
-                return (ResolverSet.unresolvable, domain)
-            except dns.resolver.NoAnswer as e:
-                log.debug(f"{e}")
-                return (ResolverSet.unresolvable, domain)  # No answer from server, consider as deprecated
-            except dns.resolver.NoNameservers as e:
-                log.debug(f"{e}")
-                return (ResolverSet.nameServerError, domain)  # No non-broken nameservers are available to answer the question.
-            except dns.resolver.LifetimeTimeout as e:
-                log.debug(f"{e}")
-               
-                if retries == self.retries:
-                    log.error(f"retries exhausted for domain {domain}")
-                    return (ResolverSet.timeout, domain)
+    def config_resolver(cls, nameservers:list[str]=["8.8.8.8", "8.8.4.4"], rotate=True, tcp_connections=2, retry_elsewhere=True):
+        cls.nameservers = nameservers
+        cls.rotate = rotate
+        cls.tcp_connections = tcp_connections
+        cls.retry_elsewhere = retry_elsewhere
+
+    @classmethod
+    def config_egress(cls, router=None):
+        cls.router = router
+
+    # QueryPacer every query of every processor waits on, None for full speed
+    @classmethod
+    def config_pacer(cls, pacer=None):
+        cls.pacer = pacer
+
+    # round robin when rotating, otherwise fail over to the next upstream on retry
+    def pick_upstream(self, retries: int, egress=None, avoid=None):
+        upstreams = self.egress_upstreams[egress.name] if egress else self.upstreams
+        if not self.rotate:
+            return upstreams[retries % len(upstreams)]
+        self.next_upstream = (self.next_upstream + 1) % len(upstreams)
+        if upstreams[self.next_upstream] is avoid and len(upstreams) > 1:
+            self.next_upstream = (self.next_upstream + 1) % len(upstreams)
+        return upstreams[self.next_upstream]
+
+    async def close(self) -> None:
+        for upstream in [*self.upstreams, *sum(self.egress_upstreams.values(), [])]:
+            await upstream.close()
+
+    # one query, over the egress the router picks, a retry avoids the ones already tried
+    async def attempt(self, domain: str, retries: int, tried: set[str], lifetime: float) -> dns.resolver.Answer:
+        if self.pacer:
+            await self.pacer.acquire()
+        if self.router is None:
+            upstream = self.pick_upstream(retries, avoid=self.last_upstream.get(domain) if self.retry_elsewhere else None)
+            self.last_upstream[domain] = upstream
+            return await resolve(upstream, domain, "A", lifetime=lifetime)
+
+        egress = self.router.route(domain, exclude=tried if self.retry_elsewhere else frozenset())
+        tried.add(egress.name)
+        self.router.begin(egress)
+        started = monotonic()
+        outcome = "error"
+        try:
+            answer = await resolve(self.pick_upstream(retries, egress), domain, "A", lifetime=lifetime)
+            outcome = "answered"
+            return answer
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            outcome = "answered"
+            raise
+        except dns.resolver.LifetimeTimeout:
+            outcome = "timeout"
+            raise
+        finally:
+            self.router.end(egress, outcome, monotonic() - started)
 
-                await asyncio.sleep(delay)
-                delay += 1
-                retries += 1
-                lifetime *= delay
+    # batches are filled with the retries that are due first, then new domains.
+    # A timeout with retries left goes to the retry queue, its slot is free at once
+    async def process_batch(self, items):
+        pending = deque(items)
+        while pending or self.retry_queue:
+            now = monotonic()
+            batch = self.retry_queue.due(now, self.batch_size)
+            while pending and len(batch) < self.batch_size:
+                batch.append(pending.popleft())
+            if not batch:
+                await asyncio.sleep(self.retry_queue.next_deadline() - now)
                 continue
-            except dns.exception.DNSException as e:
-                log.debug(f"{e}")
-                return (ResolverSet.dnsError, domain)
-            except Exception as e:
-                log.debug(f"{e}")
-                return (ResolverSet.error, domain) # Other errors, consider as deprecated
-
-        # should not get here
-        return (ResolverSet.none, domain)
\ No newline at end of file
+
+            results = []
+            for e, domain in await asyncio.gather(*(self.process(d) for d in batch)):
+                # counted once accepted, a step when_up reruns is not an attempt
+                retry = self.attempts.get(domain, 0)
+                self.outcomes.record(retry + 1, e)
+                if e == ResolverSet.timeout and retry < self.retries:
+                    self.attempts[domain] = retry + 1
+                    self.retry_queue.push(monotonic() + self.backoff * retry, domain)
+                    continue
+                if e == ResolverSet.timeout and self.retries:
+                    log.error(f"retries exhausted for domain {domain}")
+                self.forget(domain)
+                results.append((e, domain))
+            if results:
+                yield results
+
+    def forget(self, domain: str) -> None:
+        self.attempts.pop(domain, None)
+        self.tried.pop(domain, None)
+        self.last_upstream.pop(domain, None)
+
+    # domains still waiting for a retry when processing stops early, reported as timed out
+    def abandon(self) -> list[tuple[ResolverSet, str]]:
+        domains = self.retry_queue.drain()
+        for domain in domains:
+            self.forget(domain)
+        return [(ResolverSet.timeout, domain) for domain in domains]
+
+    async def process(self, domain: str) -> (ResolverSet, str):
+        settled = self.cnames.settle(domain)
+        if settled is not None:
+            log.debug(f"{domain} settled by its cname chain")
+            return (settled, domain)
+
+        # outcomes a dead tunnel produces, redone once it is back
+        return await self.when_up(lambda: self.query(domain), transient=lambda r: r[0] in self.transient_sets)
+
+    # a single attempt, the retry of a timeout is scheduled by process_batch
+    async def query(self, domain: str) -> (ResolverSet, str):
+        retries = self.attempts.get(domain, 0)
+        e = await self.query_once(domain, retries, self.tried.setdefault(domain, set()), self.lifetime * (retries + 1))
+        return (e, domain)
+
+    async def query_once(self, domain: str, retries: int, tried: set[str], lifetime: float) -> ResolverSet:
+        try:
+            answer = await self.attempt(domain, retries, tried, lifetime)
+            log.info(f"{domain} resolved")
+            self.cnames.record(domain, answer.response, ResolverSet.resolvable)
+            return ResolverSet.resolvable
+        except dns.resolver.NXDOMAIN as e:
+            log.debug(f"{e}")
+            for response in e.kwargs.get("responses", dict()).values():
+                self.cnames.record(domain, response, ResolverSet.unresolvable)
+            return ResolverSet.unresolvable
+        except dns.resolver.NoAnswer as e:
+            log.debug(f"{e}")
+            self.cnames.record(domain, e.kwargs.get("response"), ResolverSet.unresolvable)
+            return ResolverSet.unresolvable  # No answer from server, consider as deprecated
+        except dns.resolver.NoNameservers as e:
+            log.debug(f"{e}")
+            return ResolverSet.nameServerError  # No non-broken nameservers are available to answer the question.
+        except dns.resolver.LifetimeTimeout as e:
+            log.debug(f"{e}")
+            return ResolverSet.timeout
+        except dns.exception.DNSException as e:
+            log.debug(f"{e}")
+            return ResolverSet.dnsError
+        except Exception as e:
+            log.debug(f"{e}")
+            return ResolverSet.error # Other errors, consider as deprecated
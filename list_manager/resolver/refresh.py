@@ -0,0 +1,128 @@
+import asyncio
+from time import time, monotonic
+from threading import Event, Lock, Timer
+from typing import Iterable, Optional
+from .utils import ResolverSet
+from .. import log
+
+
+# Wall clock and/or query limit of a refresh. Running out sets stop, processors
+# finish the batch they are in and the writer persists what was resolved, so the
+# cache is consistent and the rest simply stays pending for the next run.
+class RefreshBudget:
+    def __init__(self, seconds: Optional[float] = None, queries: Optional[int] = None):
+        self.seconds = seconds
+        self.queries = queries
+        self.used = 0
+        self.reason = "done"
+        self.stop = Event()
+        self.timer = None
+
+    def start(self) -> "RefreshBudget":
+        self.started = monotonic()
+        if self.seconds is not None:
+            self.timer = Timer(self.seconds, self.exhaust, args=(f"{self.seconds}s time budget spent",))
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def exhaust(self, reason: str) -> None:
+        if not self.stop.is_set():
+            self.reason = reason
+            log.info(f"refresh stopping: {reason}")
+            self.stop.set()
+
+    # one query per resolved domain, retries not counted
+    def spend(self, count: int) -> None:
+        self.used += count
+        if self.queries is not None and self.used >= self.queries:
+            self.exhaust(f"{self.queries} query budget spent")
+
+    def cancel(self) -> None:
+        if self.timer:
+            self.timer.cancel()
+
+
+# Orders pending domains by the value of refreshing them: listed by more sources
+# and categories, in a blacklist (published) rather than only a whitelist, never
+# resolved before rather than failed, and not tried for long.
+class RefreshPriority:
+    SOURCE = 1.0
+    MAX_SOURCES = 5
+    CATEGORY = 2.0
+    BLACKLIST = 4.0
+    STATUS = {
+        ResolverSet.none: 3.0,
+        ResolverSet.timeout: 2.0,
+        ResolverSet.nameServerError: 1.0,
+        ResolverSet.dnsError: 1.0,
+        ResolverSet.error: 1.0,
+    }
+    AGE = 1.0  # per day since the last result
+    MAX_AGE = 7
+
+    def __init__(self):
+        self.sources: dict[str, int] = dict()
+        self.categories: dict[str, int] = dict()  # bit per category
+        self.blacklisted: set[str] = set()
+
+    # listing of the pending domains in the lists of a binder
+    @classmethod
+    def from_binder(cls, binder, domains: set[str]) -> "RefreshPriority":
+        from ..domains.utils import FileSet
+        priority = cls()
+        bits = dict()
+        for g in binder.group_iter():
+            bit = bits.setdefault(g.category, 1 << len(bits))
+            for d in g.iter_domain_files():
+                listed = domains.intersection(d.get_set(FileSet.domains))
+                priority.add(listed, bit, blacklist=not g.wl_type)
+        return priority
+
+    def add(self, domains: Iterable[str], category_bit: int, blacklist=True) -> None:
+        for domain in domains:
+            self.sources[domain] = self.sources.get(domain, 0) + 1
+            self.categories[domain] = self.categories.get(domain, 0) | category_bit
+            if blacklist:
+                self.blacklisted.add(domain)
+
+    def score(self, domain: str, status: Optional[ResolverSet], last: Optional[int], now: float) -> float:
+        age = self.MAX_AGE if last is None else min((now - last) / 86400, self.MAX_AGE)
+        return (self.SOURCE * min(self.sources.get(domain, 0), self.MAX_SOURCES)
+                + self.CATEGORY * bin(self.categories.get(domain, 0)).count("1")
+                + self.BLACKLIST * (domain in self.blacklisted)
+                + self.STATUS.get(status, 0.0)
+                + self.AGE * age)
+
+    def order(self, resolver, domains: Iterable[str]) -> list[str]:
+        now = time()
+        status = dict()
+        for e in resolver.get_refresh_sets():
+            status.update(dict.fromkeys(resolver.get_set(e).intersection(domains), e))
+        history = resolver.history
+        return sorted(domains, key=lambda d: (-self.score(d, status.get(d), history.last(d), now), d))
+
+
+# Shared by the processor threads of every loop: each query takes a token, so
+# queries leave at a steady rate instead of in bursts that trip rate limits.
+# A token taken ahead is a debt the query waits off.
+class QueryPacer:
+    def __init__(self, rate: float, burst=1.0):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.stamp = monotonic()
+        self.lock = Lock()
+
+    def reserve(self) -> float:
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            return max(-self.tokens / self.rate, 0.0)
+
+    async def acquire(self) -> None:
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
@@ -1,11 +1,21 @@
+import os
+from time import time
 from functools import partial
+from typing import Optional
 from .abstract import SingletonInst
 from .executer import ThreadedAsyncExecuter
 from .utils import ResolverSet
 from .writer import AsyncResolverCacheWriter
-from .processor import AsyncResolveProcessor
+from .sampling import StratifiedSample
+from .refresh import RefreshBudget, RefreshPriority
 from .. import log, DataSet, Stats
 
+# results in a row a domain must be unresolvable before it is left out of the
+# published lists, 0 publishes every domain
+PRUNE_CONFIRMATIONS = int(os.environ.get("PRUNE_CONFIRMATIONS", 0))
+# confirmed domains are resolved again once their last result is this old, so a revived one is published again
+PRUNE_RECHECK = float(os.environ.get("PRUNE_RECHECK_DAYS", 30)) * 86400
+
 
 class AsyncResolver(AsyncResolverCacheWriter, ThreadedAsyncExecuter, SingletonInst):
     resolvable = {ResolverSet.resolvable, ResolverSet.timeout, ResolverSet.none}
@@ -15,13 +25,81 @@ class AsyncResolver(AsyncResolverCacheWriter, ThreadedAsyncExecuter, SingletonIn
         AsyncResolverCacheWriter.__init__(self)
         ThreadedAsyncExecuter.__init__(self, **kwargs)
 
-    def refresh_cache(self, **kwargs):
+    def refresh_domains(self) -> set[str]:
         domains = set.union(*[self.get_set(e) for e in self.get_refresh_sets()])
-        self.batch_resolve(domains, **kwargs)
+        # unresolvable domains are resolved again until confirmed for pruning
+        if PRUNE_CONFIRMATIONS > 1:
+            domains.update(self.get_unconfirmed(PRUNE_CONFIRMATIONS))
+        if PRUNE_CONFIRMATIONS:
+            domains.update(self.get_expired(PRUNE_CONFIRMATIONS, PRUNE_RECHECK))
+        return domains
+
+    def get_unconfirmed(self, confirmations: int) -> set[str]:
+        return {d for d in self.get_set(ResolverSet.unresolvable) if self.history.streak(d, ResolverSet.unresolvable) < confirmations}
+
+    # confirmed unresolvable, last resolved more than max_age seconds ago
+    def get_expired(self, confirmations: int, max_age: float) -> set[str]:
+        oldest = time() - max_age
+        return {d for d in self.get_stably_unresolvable(self.get_set(ResolverSet.unresolvable), confirmations)
+                if (self.history.last(d) or 0) < oldest}
+
+    # unresolvable in at least the given number of results in a row
+    def get_stably_unresolvable(self, domains: set[str], confirmations: int) -> set[str]:
+        candidates = self.get_set(ResolverSet.unresolvable).intersection(domains)
+        return {d for d in candidates if self.history.streak(d, ResolverSet.unresolvable) >= confirmations}
+
+    # with a budget (seconds and/or queries) the most valuable domains go first and
+    # the refresh stops once it is spent; priority defaults to status and age only
+    def refresh_cache(self, seconds=None, queries=None, priority: Optional[RefreshPriority] = None, **kwargs):
+        domains = self.refresh_domains()
+        if seconds is None and queries is None:
+            return self.batch_resolve(domains, **kwargs)
+
+        ordered = (priority or RefreshPriority()).order(self, domains)
+        budget = RefreshBudget(seconds, queries)
+        self.batch_resolve(ordered, budget=budget, **kwargs)
+        log.info(f"budgeted refresh: {budget.used} of {len(ordered)} domains, {budget.reason}")
+
+    # the refresh is resolved by ResolveWorker processes, possibly on other hosts
+    def coordinate_refresh(self, **kwargs):
+        from .distributed import Coordinator
+        Coordinator(self, self.refresh_domains(), **kwargs).run()
         
-    def batch_resolve(self, domains: set[str], **kwargs):
+    # health: up/down signal of the tunnel queries go through, processors pause while it is down
+    def batch_resolve(self, domains: set[str], health=None, budget=None, **kwargs):
+        # dnspython is only imported once there is something to resolve
+        from .processor import AsyncResolveProcessor
+        router = AsyncResolveProcessor.router
+        if health is None and router:
+            health = router.health
         processor_factory = partial(AsyncResolveProcessor, **kwargs)
-        self.execute(list(domains), processor_factory=processor_factory, async_writer=self.write_batch)
+        self.execute(list(domains), processor_factory=processor_factory, writer=self, health=health, budget=budget)
+        if router:
+            router.log_stats()
+        AsyncResolveProcessor.outcomes.log()
+        AsyncResolveProcessor.cnames.log()
+        AsyncResolveProcessor.cnames.write()
+
+    # estimates the share of dead domains of a list from a stratified sample into
+    # its stats; sampled domains without a settled state are resolved into the cache
+    def sample(self, d, size=400, confidence=0.95, seed=None, **kwargs) -> dict:
+        from ..domains.utils import FileSet
+        sample = StratifiedSample(d.get_set(FileSet.domains), size, seed)
+        settled = {*ResolverSet} - self.get_refresh_sets()
+        pending = {domain for domain in sample if self.find_set(domain) not in settled}
+        if pending:
+            self.batch_resolve(pending, **kwargs)
+        outcomes = {domain: self.find_set(domain) for domain in sample}
+        # resolvable is 0, so no "or"
+        outcomes = {domain: ResolverSet.none if e is None else e for domain, e in outcomes.items()}
+        d.stats["sample"] = sample.estimate(outcomes, confidence)
+        log.info(f"{d.name}: {len(pending)} of {len(sample)} sampled domains resolved, {d.stats['sample']['estimates']}")
+        return d.stats["sample"]
+
+    # cname chain end -> names of the cache that alias it
+    def aliases(self) -> dict[str, set[str]]:
+        from .processor import AsyncResolveProcessor
+        return AsyncResolveProcessor.cnames.aliases()
 
     def intersect_sets(self, domains: set[str]) -> dict[str, set[str]]:
         return DataSet([(e, domains.intersection(s)) for e, s in self.get_sets().items()])
@@ -0,0 +1,53 @@
+from heapq import heappush, heappop
+from itertools import count
+from threading import Lock
+from typing import Optional
+from .utils import ResolverSet
+from .. import log, Stats
+
+
+# Timed out domains waiting out their backoff, outside of any concurrency slot.
+# The processor takes the due ones ahead of new domains in its next batch.
+class RetryQueue:
+    def __init__(self):
+        self.heap: list[tuple[float, int, str]] = []
+        self.order = count()
+
+    def push(self, deadline: float, domain: str) -> None:
+        heappush(self.heap, (deadline, next(self.order), domain))
+
+    def due(self, now: float, limit: int) -> list[str]:
+        domains = []
+        while self.heap and self.heap[0][0] <= now and len(domains) < limit:
+            domains.append(heappop(self.heap)[2])
+        return domains
+
+    def drain(self) -> list[str]:
+        domains = [domain for _, _, domain in sorted(self.heap)]
+        self.heap.clear()
+        return domains
+
+    def next_deadline(self) -> Optional[float]:
+        return self.heap[0][0] if self.heap else None
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+
+# Shared by the processor threads: outcome of every query by attempt number,
+# "1:timeout", "2:resolvable", ..., showing how often a retry pays off.
+class AttemptOutcomes:
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = Stats()
+
+    def record(self, attempt: int, outcome: ResolverSet) -> None:
+        with self.lock:
+            self.counts[f"{attempt}:{outcome}"] += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return Stats(sorted(self.counts.items()))
+
+    def log(self) -> None:
+        log.info(f"query attempts: {dict(self.stats())}")
@@ -0,0 +1,97 @@
+import random
+from datetime import datetime
+from statistics import NormalDist
+from typing import Iterable, Optional
+from .utils import ResolverSet
+
+# strata allocated fewer sampled domains than this are pooled, a variance needs two
+MIN_STRATUM = 2
+POOLED = "*"
+
+
+# Stratified random sample of the domains of a list: strata are public suffixes
+# (TLDs), allocated in proportion to their size. Within a stratum domains are
+# ordered by registrable domain and picked systematically from a random start,
+# so every registrable domain gets its share of the sample instead of one with
+# thousands of subdomains dominating it by chance.
+class StratifiedSample:
+    def __init__(self, domains: Iterable[str], size=400, seed: Optional[int] = None):
+        self.rng = random.Random(seed)
+        strata = dict()
+        for domain in domains:
+            tld, fld = self.registrable(domain)
+            strata.setdefault(tld, []).append((fld, domain))
+        self.population = sum(len(s) for s in strata.values())
+        self.strata = self.pool(strata, min(size, self.population))
+        self.domains = {tld: self.pick(members, n) for tld, (members, n) in self.strata.items()}
+
+    @staticmethod
+    def registrable(domain: str) -> tuple[str, str]:
+        from tld import get_tld
+        try:
+            res = get_tld(domain, fix_protocol=True, as_object=True)
+            return res.tld, res.fld
+        except Exception:
+            return POOLED, domain
+
+    @staticmethod
+    def allocate(sizes: dict[str, int], size: int) -> dict[str, int]:
+        # proportional, rounded by largest remainder
+        total = sum(sizes.values())
+        quotas = {k: size * n / total for k, n in sizes.items()}
+        allocation = {k: int(q) for k, q in quotas.items()}
+        for k in sorted(quotas, key=lambda k: quotas[k] - allocation[k], reverse=True)[:size - sum(allocation.values())]:
+            allocation[k] += 1
+        return allocation
+
+    def pool(self, strata: dict[str, list], size: int) -> dict[str, tuple[list, int]]:
+        allocation = self.allocate({k: len(v) for k, v in strata.items()}, size) if size else dict()
+        pooled = [m for k, v in strata.items() if allocation.get(k, 0) < MIN_STRATUM for m in v]
+        kept = {k: v for k, v in strata.items() if allocation.get(k, 0) >= MIN_STRATUM}
+        if pooled:
+            kept[POOLED] = pooled
+        allocation = self.allocate({k: len(v) for k, v in kept.items()}, size) if size else dict()
+        return {k: (v, allocation.get(k, 0)) for k, v in kept.items()}
+
+    def pick(self, members: list[tuple[str, str]], n: int) -> list[str]:
+        if not n:
+            return []
+        members.sort()
+        step = len(members) / n
+        start = self.rng.random() * step
+        return [members[int(start + i * step)][1] for i in range(n)]
+
+    def __iter__(self):
+        for domains in self.domains.values():
+            yield from domains
+
+    def __len__(self) -> int:
+        return sum(len(d) for d in self.domains.values())
+
+    # outcomes: domain -> ResolverSet of every sampled domain
+    def estimate(self, outcomes: dict[str, ResolverSet], confidence=0.95,
+                 reported=(ResolverSet.resolvable, ResolverSet.unresolvable, ResolverSet.timeout)) -> dict:
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        names = {str(e) for e in reported} | {str(e) for e in outcomes.values()}
+        estimates = dict()
+        for name in sorted(names, key=lambda n: ResolverSet[n].value):
+            p, variance = 0.0, 0.0
+            for tld, domains in self.domains.items():
+                size, n = len(self.strata[tld][0]), len(domains)
+                if not n:
+                    continue
+                weight = size / self.population
+                share = sum(str(outcomes[d]) == name for d in domains) / n
+                p += weight * share
+                if n > 1:
+                    variance += weight ** 2 * (1 - n / size) * share * (1 - share) / (n - 1)
+            margin = z * variance ** 0.5
+            estimates[name] = {"p": round(p, 4), "low": round(max(p - margin, 0.0), 4), "high": round(min(p + margin, 1.0), 4)}
+        return {
+            "sampled": str(datetime.now()),
+            "population": self.population,
+            "size": len(self),
+            "strata": len(self.domains),
+            "confidence": confidence,
+            "estimates": estimates,
+        }
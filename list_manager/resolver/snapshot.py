@@ -0,0 +1,153 @@
+import os
+import json
+import argparse
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Optional
+from .utils import ResolverSet
+from ..table import HostTable
+from .. import log, Utils, DataSet, Stats
+
+# publish a snapshot whenever the pipeline has written the resolver cache
+RESOLVER_SNAPSHOT = Utils.strtobool(os.environ.get("RESOLVER_SNAPSHOT", "False"))
+
+
+# Immutable copy of the resolver cache for other processes: a memory mapped
+# HostTable of every domain with its ResolverSet as a one byte value. Readers
+# map it zero copy through the page cache instead of each parsing the JSON
+# cache. Every publish writes a new generation and then swaps the CURRENT
+# pointer by rename, so a reader sees either the old or the new table, never
+# a partial one; the previous generations are kept for readers still on them.
+class ResolverSnapshot:
+    CURRENT = "CURRENT"
+    KEEP = 2
+
+    def __init__(self, table: HostTable, meta: dict, directory: Path):
+        if meta.get("count") != len(table):
+            raise (ValueError("resolver snapshot table and pointer are from different generations"))
+        self.table = table
+        self.meta = meta
+        self.directory = directory
+
+    @staticmethod
+    def default_directory() -> Path:
+        return Utils.get_create_dir("resolver_snapshot")
+
+    @classmethod
+    def current(cls, directory: Path) -> Optional[dict]:
+        path = directory.joinpath(cls.CURRENT)
+        return json.loads(path.read_bytes()) if path.exists() else None
+
+    @classmethod
+    def publish(cls, sets: dict[str, set[str]], directory: Optional[Path] = None) -> dict:
+        directory = directory or cls.default_directory()
+        current = cls.current(directory)
+        generation = current["generation"] + 1 if current else 1
+        values = {e: bytes((ResolverSet[e].value,)) for e in sets}
+        data = HostTable.build(((domain, values[e]) for e, domains in sets.items() for domain in domains), value_size=1)
+
+        name = f"resolver.{generation:08d}.hosts"
+        HostTable.write(directory.joinpath(name), data)
+        meta = {
+            "generation": generation,
+            "table": name,
+            "published": str(datetime.now()),
+            "count": HostTable(data).count,
+            "stats": {e: len(domains) for e, domains in sets.items()},
+        }
+        HostTable.write(directory.joinpath(cls.CURRENT), json.dumps(meta, indent=4).encode("utf-8"))
+
+        for old in directory.glob("resolver.*.hosts"):
+            if int(old.name.split(".")[1]) <= generation - cls.KEEP:
+                old.unlink(missing_ok=True)
+        log.info(f"resolver snapshot generation {generation}: {meta['count']} domains")
+        return meta
+
+    # a publish between reading the pointer and opening the table is retried
+    @classmethod
+    def attach(cls, directory: Optional[Path] = None, retries=3) -> "ResolverSnapshot":
+        directory = directory or cls.default_directory()
+        for _ in range(retries):
+            meta = cls.current(directory)
+            if meta is None:
+                raise (FileNotFoundError(f"no resolver snapshot in {directory}"))
+            try:
+                return cls(HostTable.open(directory.joinpath(meta["table"])), meta, directory)
+            except FileNotFoundError:
+                continue
+        raise (FileNotFoundError(f"resolver snapshot in {directory} kept changing"))
+
+    # moves to the latest generation, returns whether there was a newer one
+    def refresh(self) -> bool:
+        meta = self.current(self.directory)
+        if meta is None or meta["generation"] == self.meta["generation"]:
+            return False
+        latest = self.attach(self.directory)
+        self.close()
+        self.table, self.meta = latest.table, latest.meta
+        return True
+
+    def close(self) -> None:
+        self.table.close()
+
+    @property
+    def generation(self) -> int:
+        return self.meta["generation"]
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def find_set(self, domain: str) -> Optional[ResolverSet]:
+        value = self.table.get(domain)
+        return None if value is None else ResolverSet(value[0])
+
+    def get_set(self, e: ResolverSet) -> set[str]:
+        e = ResolverSet[str(e)]
+        return {domain for domain, value in zip(self.table, self.table.values()) if value == e}
+
+    def stats(self) -> dict[str, int]:
+        return Stats(self.meta["stats"])
+
+    def intersect_sets(self, domains: Iterable[str]) -> dict[str, set[str]]:
+        sets = DataSet([(e, set()) for e in ResolverSet])
+        for domain in domains:
+            e = self.find_set(domain)
+            if e is not None:
+                sets[e].add(domain)
+        return sets
+
+    def intersect_stats(self, domains: Iterable[str]) -> dict[str, int]:
+        counts = Stats([(e, 0) for e in ResolverSet])
+        for domain in domains:
+            e = self.find_set(domain)
+            if e is not None:
+                counts[e] += 1
+        return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="list_manager.resolver.snapshot")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("publish", help="publish the resolver cache as a new snapshot generation")
+    commands.add_parser("stats", help="print the current generation")
+    find = commands.add_parser("find", help="resolver status of domains, from the arguments")
+    find.add_argument("domains", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        from . import AsyncResolver
+        print(json.dumps(AsyncResolver().publish_snapshot(), indent=4))
+        return
+    snapshot = ResolverSnapshot.attach()
+    try:
+        if args.command == "stats":
+            print(json.dumps(snapshot.meta, indent=4))
+        if args.command == "find":
+            for domain in args.domains:
+                e = snapshot.find_set(domain)
+                print(json.dumps({"domain": domain, "status": None if e is None else str(e)}))
+    finally:
+        snapshot.close()
+
+if __name__ == "__main__":
+    main()
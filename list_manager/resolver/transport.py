@@ -0,0 +1,183 @@
+import asyncio
+import random
+import struct
+from typing import Optional
+from urllib.parse import urlparse
+import dns.asyncquery
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+from .. import log
+
+
+# one DNS query per datagram, falls back to a one shot TCP query on truncation
+class UDPUpstream:
+    def __init__(self, host: str, port=53, source: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.source = source
+        self.name = f"udp://{host}:{port}"
+
+    async def query(self, request: dns.message.Message, timeout: float) -> dns.message.Message:
+        response = await dns.asyncquery.udp(request, self.host, timeout=timeout, port=self.port, source=self.source)
+        if response.flags & dns.flags.TC:
+            response = await dns.asyncquery.tcp(request, self.host, timeout=timeout, port=self.port, source=self.source)
+        return response
+
+    async def close(self) -> None:
+        pass
+
+
+# a long lived TCP connection carrying many length prefixed queries at once,
+# responses are matched back to their query by id and may arrive out of order (RFC 7766)
+class TCPConnection:
+    LENGTH = struct.Struct("!H")
+
+    def __init__(self, host: str, port: int, source: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.source = source
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.pending: dict[int, asyncio.Future] = dict()
+        # queries taken by this connection, including those waiting for it to connect
+        self.inflight = 0
+        self.connect_lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self) -> None:
+        async with self.connect_lock:
+            if self.connected:
+                return
+            local_addr = (self.source, 0) if self.source else None
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, local_addr=local_addr)
+            self.read_task = asyncio.create_task(self.read_loop(self.reader))
+            log.debug(f"connected to tcp://{self.host}:{self.port}")
+
+    async def read_loop(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                (length,) = self.LENGTH.unpack(await reader.readexactly(self.LENGTH.size))
+                response = dns.message.from_wire(await reader.readexactly(length))
+                future = self.pending.get(response.id)
+                if future and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError, dns.exception.DNSException) as e:
+            log.debug(f"tcp://{self.host}:{self.port} closed: {e}")
+        finally:
+            self.fail_pending(ConnectionResetError(f"tcp://{self.host}:{self.port} closed"))
+            if self.writer:
+                self.writer.close()
+
+    def fail_pending(self, error: Exception) -> None:
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def next_id(self) -> int:
+        while True:
+            qid = random.getrandbits(16)
+            if qid not in self.pending:
+                return qid
+
+    async def query(self, request: dns.message.Message, timeout: float) -> dns.message.Message:
+        self.inflight += 1
+        try:
+            if not self.connected:
+                await self.connect()
+            return await self.send(request, timeout)
+        finally:
+            self.inflight -= 1
+
+    async def send(self, request: dns.message.Message, timeout: float) -> dns.message.Message:
+        request.id = self.next_id()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request.id] = future
+        try:
+            wire = request.to_wire()
+            self.writer.write(self.LENGTH.pack(len(wire)) + wire)
+            await self.writer.drain()
+            if self.read_task.done():
+                raise (ConnectionResetError(f"tcp://{self.host}:{self.port} closed"))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            del self.pending[request.id]
+
+    async def close(self) -> None:
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        if self.read_task:
+            self.read_task.cancel()
+
+
+# a few persistent connections to one upstream, queries go to the one with the fewest
+# in flight, so they spread over the pool while it is still connecting.
+# a dropped connection is reopened on the next query and its queries are retried once
+class TCPPipelineTransport:
+    def __init__(self, host: str, port=53, connections=2, source: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.name = f"tcp://{host}:{port}"
+        self.connections = [TCPConnection(host, port, source) for _ in range(connections)]
+
+    async def query(self, request: dns.message.Message, timeout: float) -> dns.message.Message:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        for attempt in range(2):
+            connection = min(self.connections, key=lambda c: (c.inflight, not c.connected))
+            try:
+                return await connection.query(request, max(deadline - loop.time(), 0.001))
+            except (ConnectionError, OSError) as e:
+                if attempt:
+                    raise
+                log.debug(f"{self.name} reconnecting: {e}")
+
+    async def close(self) -> None:
+        for c in self.connections:
+            await c.close()
+
+
+# "8.8.8.8", "udp://8.8.8.8:53" or "tcp://8.8.8.8:53"
+def make_upstream(spec: str, source: Optional[str] = None, connections=2):
+    url = urlparse(spec if "://" in spec else f"udp://{spec}")
+    port = url.port or 53
+    if url.scheme == "tcp":
+        return TCPPipelineTransport(url.hostname, port, connections=connections, source=source)
+    if url.scheme == "udp":
+        return UDPUpstream(url.hostname, port, source=source)
+    raise (ValueError(f"unsupported upstream {spec}"))
+
+
+# query an upstream and raise the same exceptions dns.asyncresolver does
+async def resolve(upstream, domain: str, rdtype="A", lifetime=6.0) -> dns.resolver.Answer:
+    qname = dns.name.from_text(domain)
+    rdtype = dns.rdatatype.from_text(rdtype)
+    request = dns.message.make_query(qname, rdtype)
+    try:
+        response = await upstream.query(request, timeout=lifetime)
+    except (asyncio.TimeoutError, dns.exception.Timeout) as e:
+        raise dns.resolver.LifetimeTimeout(timeout=lifetime, errors=[(upstream.name, False, None, e, None)])
+
+    rcode = response.rcode()
+    if rcode == dns.rcode.NXDOMAIN:
+        raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+    if rcode != dns.rcode.NOERROR:
+        raise dns.resolver.NoNameservers(request=request, errors=[(upstream.name, False, None, dns.rcode.to_text(rcode), response)])
+
+    answer = dns.resolver.Answer(qname, rdtype, dns.rdataclass.IN, response)
+    if answer.rrset is None:
+        raise dns.resolver.NoAnswer(response=response)
+    return answer
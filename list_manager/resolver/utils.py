@@ -2,9 +2,10 @@ from time import time
 import json
 from collections import Counter
 from enum import IntEnum
+from threading import Event, Lock
+from typing import Optional
 import asyncio
-import aiofiles
-from humanfriendly import format_timespan
+import concurrent.futures
 from .. import log, JsonFile
 
 
@@ -25,7 +26,10 @@ class AsyncJsonFileWriter(JsonFile):
         super().__init__(*args, **kwargs)
 
     async def write(self, data: dict) -> None:
-        dump = json.dumps(data, default=list, indent=4)
+        await self.write_dump(json.dumps(data, default=list, indent=4))
+
+    async def write_dump(self, dump: str) -> None:
+        import aiofiles
         async with aiofiles.open(self.file.with_suffix('.tmp'), 'w') as afp:
             await afp.write(dump)
             await afp.flush()
@@ -34,8 +38,8 @@ class AsyncJsonFileWriter(JsonFile):
 
 
 class RuntimeEstimator:
-    def __init__(self, start_time=time(), total_items:int=0):
-        self.start_time=start_time
+    def __init__(self, start_time=None, total_items:int=0):
+        self.start_time=start_time or time()
         self.total_items = total_items
         self.counters = Counter()
 
@@ -54,6 +58,7 @@ class RuntimeEstimator:
             return [remaining, estimated_remaining_time, processed, estimated_total_time]
 
     def log(self):
+        from humanfriendly import format_timespan
         estimate =  self.estimate()
         log.info(
             f"Remaining: {estimate[0]}, estimated time to finish: {format_timespan(estimate[1])}")
@@ -65,5 +70,101 @@ class RuntimeEstimator:
             if completion.is_set():
                 break
 
-                 
 
+class ChannelClosed(RuntimeError):
+    pass
+
+
+# Multi producer handoff of result batches into the consumer (writer) loop.
+# Producers on other threads and loops await put() on their own loop while the
+# actual queue operation runs on the consumer loop; the queue is bounded, so a
+# slow consumer applies backpressure to the producers. Once the consumer is
+# gone (fail), puts raise ChannelClosed instead of waiting on a dead loop.
+class ResultChannel:
+    CLOSED = object()
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.loop = None
+        self.queue = None
+        self.ready = Event()
+        self.lock = Lock()
+        self.failed: Optional[str] = None
+        self.pending: set[concurrent.futures.Future] = set()
+
+    # called from the consumer loop
+    def open(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.ready.set()
+
+    # called by the consumer as it exits, puts waiting on it are released
+    def fail(self, reason: str) -> None:
+        with self.lock:
+            self.failed = reason
+            pending, self.pending = self.pending, set()
+        for future in pending:
+            future.cancel()
+
+    def check(self) -> None:
+        if self.failed is not None:
+            raise (ChannelClosed(f"result channel closed: {self.failed}"))
+
+    def submit(self, batch) -> concurrent.futures.Future:
+        with self.lock:
+            self.check()
+            future = asyncio.run_coroutine_threadsafe(self.queue.put(batch), self.loop)
+            self.pending.add(future)
+        future.add_done_callback(lambda f: self.pending.discard(f))
+        return future
+
+    async def put(self, batch) -> None:
+        if asyncio.get_running_loop() is self.loop:
+            self.check()
+            await self.queue.put(batch)
+            return
+        try:
+            await asyncio.wrap_future(self.submit(batch))
+        except asyncio.CancelledError:
+            self.check()
+            raise
+
+    # from a thread without a loop
+    def put_sync(self, batch) -> None:
+        try:
+            self.submit(batch).result()
+        except concurrent.futures.CancelledError:
+            self.check()
+            raise
+
+    # queued after every batch already put, nothing to close once the consumer is gone
+    def close(self) -> None:
+        if self.failed is None:
+            try:
+                self.put_sync(self.CLOSED)
+            except ChannelClosed:
+                pass
+
+    # merges everything pending into one list, [] when nothing arrived within timeout
+    async def drain(self, timeout=1.0):
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield []
+                continue
+
+            merged, closed = [], False
+            while True:
+                if item is self.CLOSED:
+                    closed = True
+                    break
+                merged.extend(item)
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+
+            yield merged
+            if closed:
+                return
@@ -1,19 +1,36 @@
+import json
 from typing import Optional
 from itertools import groupby
 from operator import itemgetter
 from itertools import combinations
-from wrapt import synchronized
-from .abstract import AsyncBatchWriter
+from threading import Lock
+from .abstract import AsyncBatchWriter, synchronized
 from .utils import AsyncJsonFileWriter, ResolverSet
-from .. import log, DataSet, Stats
+from .history import ResolveHistory
+from .. import log, JsonFile, DataSet, Stats
 
 
 class AsyncResolverCacheWriter(AsyncBatchWriter, AsyncJsonFileWriter):
     def __init__(self):
         AsyncJsonFileWriter.__init__(self, json_file='dns_resolver_cache.json')
         AsyncBatchWriter.__init__(self)
-        self.domain_sets:dict[str, set[str]] = DataSet(self.read() if self.file.exists() else ())
-        del self.domain_sets['stats']
+        self._domain_sets = None
+        self.load_lock = Lock()
+        self.history = ResolveHistory()
+
+    # the cache file is only read on first use
+    @property
+    def domain_sets(self) -> dict[str, set[str]]:
+        if self._domain_sets is None:
+            with self.load_lock:
+                if self._domain_sets is None:
+                    domain_sets = DataSet(self.read() if self.file.exists() else ())
+                    domain_sets.pop('stats', None)
+                    # DataSet does not store missing keys, updates to them would be lost
+                    for e in ResolverSet:
+                        domain_sets.setdefault(e.name, set())
+                    self._domain_sets = domain_sets
+        return self._domain_sets
         
     def sanity(self):
         for left, right in list(combinations([*ResolverSet], 2)):
@@ -36,10 +53,15 @@ class AsyncResolverCacheWriter(AsyncBatchWriter, AsyncJsonFileWriter):
     def update(self, domains) -> None:
         self.domain_sets[str(ResolverSet.none)].update(self.difference(domains))
  
+    # domains may be an ExternalSet, which is probed rather than copied into a set
     @synchronized
     def intersection_update(self, domains: set[str]):
         for s in self.get_sets().values():
-            s.intersection_update(domains)
+            if isinstance(domains, set):
+                s.intersection_update(domains)
+            else:
+                s.difference_update([d for d in s if d not in domains])
+        self.history.forget(domains)
 
     def difference(self, domains:set[str]) -> set[str]:
         return domains.difference(*self.get_sets().values())
@@ -65,18 +87,36 @@ class AsyncResolverCacheWriter(AsyncBatchWriter, AsyncJsonFileWriter):
     def write(self):
         self.domain_sets['stats'] = self.stats()
         self.domain_sets.move_to_end('stats', last=False)
-        super(AsyncJsonFileWriter,).write(self.domain_sets)
+        JsonFile.write(self, self.domain_sets)
         del self.domain_sets['stats']
+        self.history.save()
+
+    # immutable copy other processes attach to, see ResolverSnapshot
+    @synchronized
+    def publish_snapshot(self, directory=None) -> dict:
+        from .snapshot import ResolverSnapshot
+        return ResolverSnapshot.publish(self.get_sets(), directory)
 
-    async def write_batch(self, batch:list[(ResolverSet, str)]):
-        for e, g in groupby(batch, itemgetter(0)):
+    @synchronized
+    def apply_batch(self, batch:list[(ResolverSet, str)]):
+        for e, g in groupby(sorted(batch, key=itemgetter(0)), itemgetter(0)):
             res = set(map(itemgetter(1),g))
             for s in self.get_sets([e], exclude=True).values():
                 s.difference_update(res)
             self.get_set(e).update(res)
-                
+        self.history.record(batch)
+
+    # serialized under the lock, the sets may be updated from other threads
+    @synchronized
+    def dump(self) -> str:
         # add stats at the beginning
         self.domain_sets['stats'] = self.stats()
         self.domain_sets.move_to_end('stats', last=False)
-        await super().write(self.domain_sets)
-        del self.domain_sets['stats']
\ No newline at end of file
+        try:
+            return json.dumps(self.domain_sets, default=list, indent=4)
+        finally:
+            del self.domain_sets['stats']
+
+    async def persist(self):
+        await self.write_dump(self.dump())
+        await self.history.persist()
\ No newline at end of file
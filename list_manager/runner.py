@@ -1,55 +1,314 @@
+import json
+import hashlib
+import argparse
+from datetime import datetime
+from functools import cached_property
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Optional
 from .domains import Binder
+from .domains.groups import DomainGroup
+from .domains.utils import FileSet
 from .resolver import AsyncResolver
-from . import log
+from .resolver.resolver import PRUNE_CONFIRMATIONS
+from .resolver.snapshot import RESOLVER_SNAPSHOT
+from .external import ExternalSet, MEMORY_BUDGET
+from . import log, Utils, JsonFile
+
+
+class Stage:
+    def __init__(self, name: str, run: Callable[[], dict], after=(), restore: Optional[Callable[[], None]] = None, always=False):
+        self.name = name
+        self.run = run
+        self.after = tuple(after)
+        # rebuilds the in memory state of a skipped stage for the stages that follow it
+        self.restore = restore
+        # stages that look outside the checkpoint (e.g. remote sources) never skip
+        self.always = always
+
+    def checkpoint(self) -> JsonFile:
+        return JsonFile(Utils.get_create_dir("pipeline").joinpath(f"{self.name}.json"))
+
+
+class Pipeline:
+    def __init__(self, stages: list[Stage], max_workers=2):
+        self.stages = {s.name: s for s in stages}
+        self.max_workers = max_workers
+        self.restore_lock = Lock()
+        self.restored = set()
+        self.skipped = set()
+
+    @staticmethod
+    def digest(data) -> str:
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=sorted).encode("utf-8")).hexdigest()
+
+    def fingerprint(self, stage: Stage, outputs: dict[str, str]) -> str:
+        return self.digest({"stage": stage.name, "inputs": {dep: outputs[dep] for dep in stage.after}})
+
+    def restore(self, stage: Stage) -> None:
+        with self.restore_lock:
+            for dep in self.upstream(stage):
+                if dep.name in self.skipped and dep.restore and dep.restore not in self.restored:
+                    log.info(f"restoring state of skipped stage {dep.name}")
+                    dep.restore()
+                    self.restored.add(dep.restore)
+
+    def upstream(self, stage: Stage) -> list[Stage]:
+        seen = dict()
+        def visit(s: Stage):
+            for dep in s.after:
+                visit(self.stages[dep])
+                seen.setdefault(dep, self.stages[dep])
+        visit(stage)
+        return list(seen.values())
+
+    def run_stage(self, stage: Stage, outputs: dict[str, str], force: set[str]) -> str:
+        fingerprint = self.fingerprint(stage, outputs)
+        checkpoint = stage.checkpoint()
+        state = checkpoint.read() if checkpoint.exists() else dict()
+
+        if (not stage.always and stage.name not in force
+                and state.get("fingerprint") == fingerprint and "output" in state):
+            log.info(f"stage {stage.name} unchanged, skipping")
+            self.skipped.add(stage.name)
+            return state["output"]
+
+        self.restore(stage)
+        log.info(f"stage {stage.name} starting")
+        output = self.digest(stage.run())
+        checkpoint.write({"fingerprint": fingerprint, "output": output, "finished": str(datetime.now())})
+        log.info(f"stage {stage.name} done")
+        return output
+
+    # runs every stage once its dependencies are done, independent stages concurrently.
+    # a failed stage leaves no checkpoint, so the next run resumes from it
+    def run(self, force=()) -> None:
+        force = set(force)
+        self.restored.clear()
+        self.skipped.clear()
+        outputs = dict()
+        pending = dict(self.stages)
+        running = dict()
+        failed = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as workers:
+            while pending or running:
+                if failed is None:
+                    for name, stage in list(pending.items()):
+                        if all(dep in outputs for dep in stage.after):
+                            del pending[name]
+                            running[workers.submit(self.run_stage, stage, dict(outputs), force)] = stage
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        outputs[stage.name] = future.result()
+                    except Exception as e:
+                        log.exception(f"stage {stage.name} failed: {e}")
+                        failed = failed or e
+
+        if failed is not None:
+            raise failed
+        if pending:
+            raise (ValueError(f"stages never became ready: {list(pending)}"))
+
 
 class Runner:
-    resolver = AsyncResolver()
-    binder = Binder()
-    
-    def update_resolver(self) -> None:
+    # created on first use so that importing or building a Runner stays cheap
+    @cached_property
+    def resolver(self) -> AsyncResolver:
+        return AsyncResolver()
+
+    @cached_property
+    def binder(self) -> Binder:
+        return Binder()
+
+    def __init__(self):
+        self.pipeline = Pipeline([
+            Stage("download", self.download, always=True),
+            Stage("parse", self.parse, after=["download"], restore=self.load),
+            Stage("dedup", self.dedup, after=["parse"], restore=self.load),
+            Stage("reduce_wl", self.reduce_wl, after=["dedup"], restore=self.load),
+            Stage("update_resolver", self.update_resolver, after=["reduce_wl"]),
+            # ttls expire with time, the refresh has work even when no list changed
+            Stage("resolve", self.resolve, after=["update_resolver"], always=True),
+            # published flags depend on what prune left out
+            Stage("lookup", self.lookup, after=["resolve", "prune"]),
+            # prunes on the results of this resolve, and does not read the cache
+            # while the resolve writes it; the cache changes between runs, so it always runs
+            Stage("prune", self.prune, after=["resolve"], restore=self.load, always=True),
+            Stage("upload", self.upload, after=["reduce_wl", "prune"]),
+        ])
+
+    def write(self, groups=None) -> None:
+        DomainGroup.write_files([d for g in (self.binder.group_iter() if groups is None else groups) for d in g.iter_domain_files()])
+
+    def load(self) -> None:
+        for g in self.binder.group_iter():
+            if not g.loaded:
+                g.load()
+
+    # groups to rebuild, against the snapshot of the last finished reduce_wl
+    @property
+    def dirty(self) -> set:
+        return self.binder.dirty_groups(self.digests)
+
+    def download(self) -> dict:
+        files = list(self.binder.files_iter())
+        self.digests = {d.url: hashlib.sha256(d.download()).hexdigest() for d in files}
+        # keyed by file, so that moving a source to another category also reruns parse
+        return {d.file.name: self.digests[d.url] for d in files}
+
+    def parse(self) -> dict:
+        self.binder.migrate()
+        dirty = self.dirty
+        log.info(f"parsing {len(dirty)} of {len(self.binder.groups['bl_categories']) + len(self.binder.groups['wl_categories'])} groups")
+        for g in self.binder.group_iter():
+            if g in dirty:
+                g.parse(force=True)
+            elif not g.loaded:
+                g.load()
+        self.write(dirty)
+        return self.content_output()
+
+    # digests of the sets, a list whose content changed with the same counts changes it too
+    def content_output(self) -> dict:
+        return {d.name: d.digest() for d in self.binder.files_iter()}
+
+    def dedup(self) -> dict:
+        dirty = self.dirty
+        for g in dirty:
+            g.de_dup()
+        self.write(dirty)
+        return self.content_output()
+
+    def reduce_wl(self) -> dict:
+        dirty = self.dirty
+        self.binder.reduce_wl(groups=[g for g in dirty if not g.wl_type])
+        # whitelists are not reduced, they are final once deduped
+        for g in dirty:
+            if g.wl_type:
+                g.set_stats("reduce_wl", True)
+        self.write(dirty)
+        self.binder.save_snapshot(self.digests)
+        return self.content_output()
+
+    def update_resolver(self) -> dict:
         for d in self.binder.files_iter():
             self.resolver.update(d.fileSet['domains'])
             d.stats['cache'] = self.resolver.intersect_stats(d.fileSet['domains'])
             assert(sum(d.stats['cache'].values()) == len(d.fileSet['domains']) == d.stats['parser']['domains'])
+        self.resolver.write()
+        self.write()
+        self.publish_snapshot()
+        return self.resolver.stats()
+
+    # 0 confirmations puts pruned domains back
+    def prune(self) -> dict:
+        DomainGroup.write_files([d for d in self.binder.files_iter() if d.prune(self.resolver, PRUNE_CONFIRMATIONS)])
+        # the pruned domains themselves, lookup reruns when they change at the same count
+        return {d.name: hashlib.sha256(d.encode(d.get_set(FileSet.pruned))).hexdigest() for d in self.binder.files_iter()}
+
+    # a budget for the refresh, seconds and/or queries, e.g. to fit a maintenance window
+    refresh_budget = dict()
+    # set by the daemon, which trickles the refresh instead
+    background_refresh = False
+
+    def resolve(self) -> dict:
+        if self.background_refresh:
+            return self.resolver.stats()
+        priority = None
+        if self.refresh_budget:
+            from .resolver.refresh import RefreshPriority
+            priority = RefreshPriority.from_binder(self.binder, self.resolver.refresh_domains())
+        self.resolver.refresh_cache(**self.refresh_budget, priority=priority, max_concurrent_tasks=60, batch_size=50)
+        self.publish_snapshot()
+        return self.resolver.stats()
+
+    def publish_snapshot(self) -> None:
+        if RESOLVER_SNAPSHOT:
+            self.resolver.publish_snapshot()
+
+    def lookup(self) -> dict:
+        from .lookup import LookupIndex
+        index = LookupIndex.open(LookupIndex.write(self.binder, self.resolver))
+        index.close()
+        return {"count": index.meta["count"], "built": index.meta["built"]}
+
+    def upload(self) -> dict:
+        report = self.binder.upload()
+        failed = [r["key"] for r in report if r["status"] == "failed"]
+        if failed:
+            raise (RuntimeError(f"failed uploads: {failed}"))
+        return {r["key"]: r["sha256"] for r in report}
+
+    # liveness estimate of lists, by file name (category_idx) or url, without resolving them in full
+    def sample(self, names: list[str], size=400, seed=None) -> dict:
+        self.load()
+        report = dict()
+        sampled = [d for d in self.binder.files_iter() if d.name in names or d.url in names]
+        for d in sampled:
+            report[d.name] = self.resolver.sample(d, size, seed=seed, max_concurrent_tasks=60, batch_size=50)
+        DomainGroup.write_files(sampled)
+        self.resolver.write()
+        return report
+
+    # estimated redundancy between sources, from the sketches taken while parsing
+    def overlap(self) -> dict:
+        self.load()
+        return self.binder.overlap()
 
     def compact_resolver(self):
-        all_domains = set()
-        for d in self.files_iter():
-            all_domains.update(d.fileSet['domains'])
+        lists = [d.fileSet['domains'] for d in self.binder.files_iter()]
+        if MEMORY_BUDGET:
+            # k-way merge of the sorted lists instead of their union in memory
+            all_domains = ExternalSet.union(Utils.get_create_dir("external").joinpath("all.domains"), lists)
+        else:
+            all_domains = set().union(*lists)
         try:
             assert(len(self.resolver.difference(all_domains)) == 0)
         except AssertionError as e:
             log.exception(f"{e}")
             self.resolver.intersection_update(all_domains)
             assert(len(self.resolver.difference(all_domains)) == 0)
-            
-
-    def run(self):
-        #print(f"\n{'category' : <15} {'wl_type' : <7} count")
-        # print(f"{g.category : <15} {g.wl_type : <7} files: {len(g.domain_files)}")
-        # for g in self.binder.group_iter():
-        #     g.parse()
-        #     g.deDup()
-        #     if g.wl_type:
-        #         g.set_stats("reduce_wl", True)
- 
-        # self.binder.reduce_wl()
-        # self.update_resolver()
-        # self.compact_resolver()
-        self.resolver.refresh_cache(max_concurrent_tasks=60, batch_size=50)
-         
-        # for g in self.binder.group_iter():
-        #     g.upload()
+
+    def run(self, **kwargs):
+        self.pipeline.run(**kwargs)
+
+    # applies edits of bl_config.json as they are saved, rebuilding only what they touch
+    def watch(self, interval=2.0, stop=None):
+        for _ in self.binder.watch(interval, stop):
+            try:
+                self.run()
+            except Exception as e:
+                log.error(f"rebuild failed, retried on the next change: {e}")
 
 
 def main():
-    global mock_upload
-    mock_upload = True
+    parser = argparse.ArgumentParser(prog="list_manager")
+    parser.add_argument("--force", action="append", default=[], help="rerun a stage even if unchanged")
+    parser.add_argument("--watch", action="store_true", help="keep running and rebuild when bl_config.json changes")
+    parser.add_argument("--sample", action="append", default=[], help="only estimate the dead share of a parsed list (name or url)")
+    parser.add_argument("--sample-size", type=int, default=400)
+    parser.add_argument("--overlap", action="store_true", help="only print the estimated overlaps between parsed blacklists")
+    parser.add_argument("--refresh-seconds", type=float, help="stop refreshing the resolver cache after this long")
+    parser.add_argument("--refresh-queries", type=int, help="stop refreshing the resolver cache after this many domains")
+    args = parser.parse_args()
+
     r = Runner()
-    r.run()
+    r.refresh_budget = {k: v for k, v in (("seconds", args.refresh_seconds), ("queries", args.refresh_queries)) if v is not None}
+    if args.sample:
+        r.sample(args.sample, args.sample_size)
+        return
+    if args.overlap:
+        print(json.dumps(r.overlap(), indent=4))
+        return
+    r.run(force=args.force)
+    if args.watch:
+        r.watch()
 
 if __name__ == "__main__":
     main()
-
-
-
@@ -0,0 +1,163 @@
+import os
+import sys
+import mmap
+import struct
+import shutil
+from array import array
+from pathlib import Path
+from typing import Iterable, Optional
+
+
+# Sorted hostname table, laid out as: header | offsets | values | hostnames.
+# Lookups binary search the (memory mapped) buffer in place, so a table is
+# shared between processes through the page cache instead of being parsed.
+class HostTable:
+    MAGIC = b"LMHT"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHHI")  # magic, version, value size, count
+    OFFSET = struct.Struct("<I")
+    SPAN = struct.Struct("<II")
+    BLOCK = 4096
+
+    def __init__(self, buffer, mapped: Optional[mmap.mmap] = None):
+        magic, version, self.value_size, self.count = self.HEADER.unpack_from(buffer, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise (ValueError(f"not a host table: {magic} v{version}"))
+
+        self.buffer = buffer
+        self.mapped = mapped
+        self.offsets_at = self.HEADER.size
+        self.values_at = self.offsets_at + self.OFFSET.size * (self.count + 1)
+        self.blob_at = self.values_at + self.value_size * self.count
+        # offsets read in place, without unpacking
+        self.offsets = memoryview(buffer)[self.offsets_at:self.values_at].cast("I") if sys.byteorder == "little" else None
+
+    @classmethod
+    def build(cls, entries: Iterable[tuple[str, bytes]], value_size=0) -> bytes:
+        # last value wins for repeated hostnames
+        table = {host.encode("utf-8"): value for host, value in entries}
+        hosts = sorted(table)
+        offsets = array("I", [0])
+        values = bytearray()
+        for host in hosts:
+            offsets.append(offsets[-1] + len(host))
+            value = table[host] or b""
+            if len(value) != value_size:
+                raise (ValueError(f"value of {host} must be {value_size} bytes"))
+            values += value
+
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        return b"".join([
+            cls.HEADER.pack(cls.MAGIC, cls.VERSION, value_size, len(hosts)),
+            offsets.tobytes(),
+            bytes(values),
+            *hosts,
+        ])
+
+    @classmethod
+    def from_hosts(cls, hosts: Iterable[str]) -> bytes:
+        return cls.build((host, b"") for host in hosts)
+
+    # streams hostnames, already sorted and unique, to a table without values;
+    # only the offsets are held in memory
+    @classmethod
+    def write_sorted(cls, path: Path, hosts: Iterable[str]) -> int:
+        offsets = array("I", [0])
+        blob = path.with_suffix(".blob")
+        with blob.open(mode="wb") as fp:
+            for host in hosts:
+                key = host.encode("utf-8")
+                fp.write(key)
+                offsets.append(offsets[-1] + len(key))
+
+        count = len(offsets) - 1
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        tmp = path.with_suffix(".tmp")
+        with tmp.open(mode="wb") as fp, blob.open(mode="rb") as src:
+            fp.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0, count))
+            fp.write(offsets.tobytes())
+            shutil.copyfileobj(src, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        blob.unlink()
+        tmp.rename(path)
+        return count
+
+    @classmethod
+    def write(cls, path: Path, data: bytes) -> None:
+        tmp = path.with_suffix(".tmp")
+        with tmp.open(mode="wb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        tmp.rename(path)
+
+    @classmethod
+    def open(cls, path: Path) -> "HostTable":
+        with path.open(mode="rb") as fp:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(memoryview(mapped), mapped)
+
+    def close(self) -> None:
+        if self.mapped is not None:
+            if self.offsets is not None:
+                self.offsets.release()
+            self.buffer.release()
+            self.mapped.close()
+            self.mapped = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, host: str) -> bool:
+        return self.find(host) is not None
+
+    def _key(self, i: int) -> bytes:
+        if self.offsets is not None:
+            start, end = self.offsets[i], self.offsets[i + 1]
+        else:
+            start, end = self.SPAN.unpack_from(self.buffer, self.offsets_at + self.OFFSET.size * i)
+        return bytes(self.buffer[self.blob_at + start:self.blob_at + end])
+
+    def host(self, i: int) -> str:
+        return self._key(i).decode("utf-8")
+
+    def value(self, i: int) -> bytes:
+        start = self.values_at + self.value_size * i
+        return bytes(self.buffer[start:start + self.value_size])
+
+    # the values of all entries in hostname order, read in place
+    def values(self) -> memoryview:
+        return self.buffer[self.values_at:self.blob_at]
+
+    def find(self, host: str) -> Optional[int]:
+        key = host.encode("utf-8")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = self._key(mid)
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def get(self, host: str) -> Optional[bytes]:
+        i = self.find(host)
+        return None if i is None else self.value(i)
+
+    # in sorted order, decoded a block of hostnames at a time
+    def __iter__(self):
+        if self.offsets is None:
+            for i in range(self.count):
+                yield self.host(i)
+            return
+        for lo in range(0, self.count, self.BLOCK):
+            spans = self.offsets[lo:min(lo + self.BLOCK, self.count) + 1].tolist()
+            base = spans[0]
+            block = bytes(self.buffer[self.blob_at + base:self.blob_at + spans[-1]])
+            yield from [block[start - base:end - base].decode("utf-8") for start, end in zip(spans, spans[1:])]
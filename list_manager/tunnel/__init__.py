@@ -1,2 +1,4 @@
 from .udp_tunnel import SSHUDPTunnel, default_ssh_config as udp_ssh_config
-from .wireguard_tunnel import WireGuardManager, default_ssh_config as ssh_config
\ No newline at end of file
+from .wireguard_tunnel import WireGuardManager, default_ssh_config as ssh_config
+from .mux_tunnel import MuxTunnel
+from .relay import Relay
@@ -0,0 +1,164 @@
+import os
+import asyncio
+import subprocess
+from time import time
+from threading import Lock, Thread, Event
+from typing import Callable, Optional
+from .. import log, Stats
+
+# the canary is a query for a name any resolver can answer, every interval seconds
+PROBE_DOMAIN = os.environ.get("PROBE_DOMAIN", "example.com")
+# a stall is detected within interval + timeout, a fraction of a second
+PROBE_INTERVAL = float(os.environ.get("PROBE_INTERVAL", 0.25))
+PROBE_TIMEOUT = float(os.environ.get("PROBE_TIMEOUT", 0.25))
+
+
+# Up/down signal of a tunnel, shared by threads with their own event loops.
+# Changes are pushed to subscribed callbacks and wake coroutines awaiting
+# wait_up()/wait_down() in whatever loop they run.
+class TunnelHealth:
+    def __init__(self, name="tunnel", up=False):
+        self.name = name
+        self.lock = Lock()
+        self.up = up
+        self.reason = ""
+        self.changed = time()
+        self.callbacks: list[Callable[[bool, str], None]] = []
+        self.waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future, bool]] = []
+        self.stats = Stats()
+
+    @property
+    def is_up(self) -> bool:
+        return self.up
+
+    def set(self, up: bool, reason="") -> None:
+        with self.lock:
+            if up == self.up:
+                return
+            self.up = up
+            self.reason = reason
+            self.changed = time()
+            self.stats["up" if up else "down"] += 1
+            woken = [w for w in self.waiters if w[2] == up]
+            self.waiters = [w for w in self.waiters if w[2] != up]
+            callbacks = list(self.callbacks)
+
+        (log.info if up else log.warning)(f"{self.name} {'up' if up else 'down'}: {reason}")
+        for loop, future, _ in woken:
+            try:
+                loop.call_soon_threadsafe(self.wake, future)
+            except RuntimeError:
+                pass  # loop already closed
+        for callback in callbacks:
+            callback(up, reason)
+
+    def set_up(self, reason="") -> None:
+        self.set(True, reason)
+
+    def set_down(self, reason="") -> None:
+        self.set(False, reason)
+
+    @staticmethod
+    def wake(future: asyncio.Future) -> None:
+        if not future.done():
+            future.set_result(None)
+
+    def subscribe(self, callback: Callable[[bool, str], None]) -> Callable[[], None]:
+        with self.lock:
+            self.callbacks.append(callback)
+
+        def unsubscribe():
+            with self.lock:
+                if callback in self.callbacks:
+                    self.callbacks.remove(callback)
+        return unsubscribe
+
+    async def wait_for(self, up: bool) -> None:
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.up == up:
+                return
+            waiter = (loop, loop.create_future(), up)
+            self.waiters.append(waiter)
+        try:
+            await waiter[1]
+        finally:
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+    async def wait_up(self) -> None:
+        await self.wait_for(True)
+
+    async def wait_down(self) -> None:
+        await self.wait_for(False)
+
+    # down the moment the process exits, no polling
+    def watch_process(self, process: subprocess.Popen, name: str, on_exit: Optional[Callable[[int], None]] = None) -> Thread:
+        def watch():
+            returncode = process.wait()
+            self.set_down(f"{name} exited with code {returncode}")
+            if on_exit:
+                on_exit(returncode)
+
+        watcher = Thread(target=watch, daemon=True)
+        watcher.start()
+        return watcher
+
+
+# In-band check: a DNS query through the tunnel. Any answer, NXDOMAIN included,
+# means it carries traffic. The first timeout already pauses the processors,
+# a lost canary costs one interval, a stall every query sent into it.
+class CanaryProbe:
+    def __init__(self, health: TunnelHealth, nameserver: str, domain=PROBE_DOMAIN,
+                 interval=PROBE_INTERVAL, timeout=PROBE_TIMEOUT, failures=1, source: Optional[str] = None):
+        self.health = health
+        self.nameserver = nameserver
+        self.source = source
+        self.domain = domain
+        self.interval = interval
+        self.timeout = timeout
+        self.failures = failures
+        self.stopping = Event()
+        self.thread = None
+
+    async def probe(self, upstream) -> bool:
+        import dns.exception
+        import dns.resolver
+        from ..resolver.transport import resolve
+        try:
+            await resolve(upstream, self.domain, "A", lifetime=self.timeout)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            pass
+        except (dns.exception.DNSException, ConnectionError, OSError):
+            return False
+        return True
+
+    async def run(self) -> None:
+        from ..resolver.transport import make_upstream
+        upstream = make_upstream(self.nameserver, source=self.source, connections=1)
+        failed = 0
+        try:
+            while not self.stopping.is_set():
+                started = asyncio.get_running_loop().time()
+                if await self.probe(upstream):
+                    failed = 0
+                    self.health.set_up(f"canary answered via {self.nameserver}")
+                else:
+                    failed += 1
+                    if failed >= self.failures:
+                        self.health.set_down(f"{failed} canary queries via {self.nameserver} unanswered")
+                await asyncio.sleep(max(self.interval - (asyncio.get_running_loop().time() - started), 0))
+        finally:
+            await upstream.close()
+
+    def start(self) -> "CanaryProbe":
+        self.stopping.clear()
+        self.thread = Thread(target=asyncio.run, args=(self.run(),), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread and self.thread.is_alive():
+            self.thread.join()
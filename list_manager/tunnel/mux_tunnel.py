@@ -0,0 +1,206 @@
+import atexit
+import shlex
+import asyncio
+from pathlib import Path
+from threading import Thread, Event
+from typing import Optional
+from .health import TunnelHealth, CanaryProbe
+from .relay import frame, read_frame, enlarge_buffers
+from .udp_tunnel import default_ssh_config
+from .. import log, Stats
+
+RELAY_SOURCE = Path(__file__).with_name("relay.py")
+
+
+# DNS over one multiplexed TCP stream instead of a socat process per peer.
+# Datagrams received on the local UDP port get a 16 bit tag that replaces their
+# query id, are framed (length, tag) onto the stream and routed back to their
+# sender by tag. The stream is an ssh local forward to a relay started over the
+# same ssh session, or any running relay when `relay` is given.
+class MuxTunnel:
+    # seconds an unanswered query keeps its tag
+    expire = 10.0
+    # queries are dropped rather than buffered while the stream is this far behind
+    high_water = 1 << 20
+
+    def __init__(self, local_port, remote_port=53, remote_host="localhost",
+                 ssh_config=default_ssh_config, relay: Optional[tuple[str, int]] = None, local_host="127.0.0.1",
+                 canary=True):
+        self.local_address = (local_host, local_port)
+        self.remote_port = remote_port
+        self.remote_host = remote_host
+        self.ssh_config = ssh_config
+        self.spawn = relay is None
+        self.relay = relay or ("127.0.0.1", ssh_config.local_bind_address[1])
+        self.pending: dict[int, tuple] = dict()
+        self.next_tag = 0
+        self.stats = Stats()
+        self.udp = None
+        self.writer = None
+        self.tasks = []
+        self.connected: Optional[asyncio.Event] = None
+        self.stopping: Optional[asyncio.Event] = None
+        self.loop = None
+        self.thread = None
+        self.ready = Event()
+        # down while the stream or ssh is, or the canary query through the tunnel goes unanswered
+        self.health = TunnelHealth("mux tunnel")
+        self.canary = canary
+
+    def ssh_command(self) -> list[str]:
+        relay = shlex.join(["python3", "-c", RELAY_SOURCE.read_text(),
+                            "--port", str(self.ssh_config.remote_bind_address[1]),
+                            "--upstream", f"{self.remote_host}:{self.remote_port}"])
+        return [
+            "ssh",
+            "-o", "ExitOnForwardFailure=yes",
+            "-o", "ServerAliveInterval=5",
+            "-i", self.ssh_config.ssh_pkey,
+            "-L", f"{self.relay[1]}:localhost:{self.ssh_config.remote_bind_address[1]}",
+            f"{self.ssh_config.ssh_username}@{self.ssh_config.ssh_host}",
+            relay,
+        ]
+
+    def allocate(self) -> Optional[int]:
+        if len(self.pending) >= 1 << 16:
+            return None
+        while self.next_tag in self.pending:
+            self.next_tag = (self.next_tag + 1) & 0xFFFF
+        tag = self.next_tag
+        self.next_tag = (tag + 1) & 0xFFFF
+        return tag
+
+    def forward(self, data: bytes, addr) -> None:
+        writer = self.writer
+        if (writer is None or writer.is_closing() or len(data) < 12
+                or writer.transport.get_write_buffer_size() > self.high_water):
+            self.stats["dropped"] += 1
+            return
+        tag = self.allocate()
+        if tag is None:
+            self.stats["dropped"] += 1
+            return
+        self.pending[tag] = (addr, data[:2], asyncio.get_running_loop().time() + self.expire)
+        writer.write(frame(tag, tag.to_bytes(2, "big") + data[2:]))
+        self.stats["sent"] += 1
+
+    def deliver(self, tag: int, payload: bytes) -> None:
+        entry = self.pending.pop(tag, None)
+        if entry is None:
+            self.stats["late"] += 1
+            return
+        addr, qid, _ = entry
+        self.udp.sendto(qid + payload[2:], addr)
+        self.stats["received"] += 1
+
+    # reconnects right away when the stream drops, queries in flight are lost
+    # and left to the client to retry
+    async def stream_loop(self) -> None:
+        backoff = 0.05
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_connection(*self.relay)
+                self.connected.set()
+                self.health.set_up("stream connected")
+                backoff = 0.05
+                log.info(f"tunnel stream connected to {self.relay[0]}:{self.relay[1]}")
+                while True:
+                    self.deliver(*await read_frame(reader))
+            except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+                log.debug(f"tunnel stream to {self.relay[0]}:{self.relay[1]}: {e}")
+            finally:
+                self.connected.clear()
+                self.health.set_down("stream closed")
+                if self.writer:
+                    self.writer.close()
+                    self.writer = None
+                self.stats["lost"] += len(self.pending)
+                self.pending.clear()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 2.0)
+
+    # restarted as soon as it exits, the stream reconnects once the forward is back
+    async def ssh_loop(self) -> None:
+        backoff = 0.5
+        while True:
+            process = await asyncio.create_subprocess_exec(
+                *self.ssh_command(), stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            try:
+                _, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.terminate()
+                await process.wait()
+                raise
+            log.error(f"tunnel ssh exited with code {process.returncode}: {stderr.decode().strip()}")
+            self.health.set_down(f"ssh exited with code {process.returncode}")
+            if self.writer:
+                self.writer.close()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 10.0)
+
+    async def expire_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(1)
+            now = loop.time()
+            expired = [tag for tag, (_, _, deadline) in self.pending.items() if deadline <= now]
+            for tag in expired:
+                del self.pending[tag]
+            self.stats["expired"] += len(expired)
+
+    async def open(self) -> "MuxTunnel":
+        loop = asyncio.get_running_loop()
+        tunnel = self
+        self.connected = asyncio.Event()
+        self.stopping = asyncio.Event()
+
+        class Listener(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                tunnel.forward(data, addr)
+
+        self.udp, _ = await loop.create_datagram_endpoint(Listener, local_addr=self.local_address)
+        enlarge_buffers(self.udp)
+        self.local_address = self.udp.get_extra_info("sockname")
+        self.tasks = [asyncio.create_task(self.stream_loop()), asyncio.create_task(self.expire_loop())]
+        if self.spawn:
+            self.tasks.append(asyncio.create_task(self.ssh_loop()))
+        if self.canary:
+            probe = CanaryProbe(self.health, f"udp://{self.local_address[0]}:{self.local_address[1]}")
+            self.tasks.append(asyncio.create_task(probe.run()))
+        log.info(f"tunnel listening on udp://{self.local_address[0]}:{self.local_address[1]}")
+        return self
+
+    async def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.udp:
+            self.udp.close()
+        self.health.set_down("closed")
+        log.info(f"tunnel closed {dict(self.stats)}")
+
+    async def serve(self) -> None:
+        await self.open()
+        self.ready.set()
+        try:
+            await self.stopping.wait()
+        finally:
+            await self.close()
+
+    # runs the tunnel on its own loop and thread, like the socat tunnel
+    def start(self) -> None:
+        log.info("Starting tunnel...")
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_until_complete, args=(self.serve(),), daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        if self.thread and self.thread.is_alive():
+            log.info("Stopping tunnel...")
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            self.thread.join()
+            self.loop.close()
+
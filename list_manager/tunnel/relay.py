@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Remote end of the multiplexed UDP-over-TCP tunnel (see mux_tunnel.py).
+# Standard library only: it is shipped to the remote host as `python3 -c <source>`.
+import socket
+import struct
+import asyncio
+import argparse
+import logging
+
+# length of the payload, query tag; the payload is a DNS message whose id was
+# rewritten to the tag, so answers carry it back without a lookup table
+FRAME = struct.Struct("!HH")
+SOCKET_BUFFER = 1 << 21
+
+log = logging.getLogger("list_manager.relay")
+
+
+def frame(tag, payload):
+    return FRAME.pack(len(payload), tag) + payload
+
+
+async def read_frame(reader):
+    length, tag = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return tag, await reader.readexactly(length)
+
+
+def enlarge_buffers(transport):
+    sock = transport.get_extra_info("socket")
+    if sock is not None:
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+            except OSError:
+                pass
+
+
+def parse_address(value, port=53):
+    host, _, p = value.rpartition(":")
+    return (host, int(p)) if host else (value, port)
+
+
+# accepts tunnel streams and forwards every framed query as a datagram to the upstream
+class Relay:
+    def __init__(self, upstream=("127.0.0.1", 53), host="127.0.0.1", port=55555):
+        self.upstream = upstream
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        peer = writer.get_extra_info("peername")
+
+        class Upstream(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                if len(data) >= 2 and not writer.is_closing():
+                    writer.write(frame(int.from_bytes(data[:2], "big"), data))
+
+        udp, _ = await loop.create_datagram_endpoint(Upstream, remote_addr=self.upstream)
+        enlarge_buffers(udp)
+        log.info("stream from %s relayed to %s:%s", peer, *self.upstream)
+        try:
+            while True:
+                _, payload = await read_frame(reader)
+                udp.sendto(payload)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            udp.close()
+            writer.close()
+            log.info("stream from %s closed", peer)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    def close(self):
+        self.server.close()
+
+    async def serve(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="relay")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=55555)
+    parser.add_argument("--upstream", default="127.0.0.1:53", help="host:port of the DNS server")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s relay %(message)s")
+    asyncio.run(Relay(parse_address(args.upstream), args.host, args.port).serve())
+
+
+if __name__ == "__main__":
+    main()
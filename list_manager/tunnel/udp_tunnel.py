@@ -1,9 +1,10 @@
 import subprocess
 import time
 import atexit
-from threading import Thread, Event
+from threading import Event
 import shlex
 from addict import Dict
+from .health import TunnelHealth, CanaryProbe
 from .. import log, Utils
 
 default_ssh_config = Dict(
@@ -33,8 +34,9 @@ class SSHUDPTunnel:
         self.remote_socat_command = self.get_remote_command()
         self.local_socat_process = None
         self.remote_socat_process = None
-        self.monitor_thread = None
         self.stop_event = Event()
+        self.health = TunnelHealth("udp tunnel")
+        self.probe = CanaryProbe(self.health, f"udp://127.0.0.1:{local_port}")
         atexit.register(self.stop)
 
     def get_local_command(self):
@@ -68,6 +70,9 @@ class SSHUDPTunnel:
             stderr=subprocess.PIPE,
         )
 
+        self.health.watch_process(self.local_socat_process, "local socat",
+                                  on_exit=self._restarter(self.local_socat_process, self._watch_local_socat))
+
         # Give a moment for socat to initialize
         time.sleep(0.5)  # Adjust the sleep time if necessary
 
@@ -77,6 +82,13 @@ class SSHUDPTunnel:
             self.local_socat_process.wait()
             self.local_socat_process = None
 
+    # restarts a process once it exits, unless it was stopped or already replaced
+    def _restarter(self, process, watch):
+        def on_exit(returncode):
+            if not self.stop_event.is_set() and (process is self.local_socat_process or process is self.remote_socat_process):
+                watch()
+        return on_exit
+
     def _watch_local_socat(self):
         if self.local_socat_process and self.local_socat_process.poll() is not None:
             log.error(
@@ -101,11 +113,14 @@ class SSHUDPTunnel:
             stderr=subprocess.PIPE,
         )
 
+        self.health.watch_process(self.remote_socat_process, "remote socat",
+                                  on_exit=self._restarter(self.remote_socat_process, self._watch_remote_socat))
+
         # Give a moment for socat to initialize
         time.sleep(2)  # Adjust the sleep time if necessary
 
     def _stop_remote_socat(self):
-        if self.remote_socat_process and self.remote_socat_process.poll() is not None:
+        if self.remote_socat_process and self.remote_socat_process.poll() is None:
             self.remote_socat_process.terminate()
             self.remote_socat_process.wait()
             self.remote_socat_process = None
@@ -126,15 +141,6 @@ class SSHUDPTunnel:
             self._stop_remote_socat()
             self._start_remote_socat()
 
-    def _monitor_tunnel(self):
-        while not self.stop_event.is_set():
-            # Monitor the local socat process
-            self._watch_local_socat()
-            # Check if the local socat process has exited
-            self._watch_remote_socat()
-            # Sleep for some time before checking again
-            time.sleep(10)
-
     def start(self):
         log.info("Starting tunnel...")
         self.stop_event.clear()
@@ -142,16 +148,14 @@ class SSHUDPTunnel:
         self._start_remote_socat()
         # Start the local socat
         self._start_local_socat()
-        # Start monitoring the tunnel in a separate thread
-        self.monitor_thread = Thread(target=self._monitor_tunnel)
-        self.monitor_thread.start()
+        # process exits restart them right away, the canary tells when DNS gets through
+        self.probe.start()
         log.info("Tunnel started and being monitored.")
 
     def stop(self):
         log.info("Stopping tunnel...")
-        if self.monitor_thread and self.monitor_thread.is_alive():
-            self.stop_event.set()  # Signal the monitor thread to stop
-            self.monitor_thread.join()  # Wait for the monitor thread to finish
+        self.stop_event.set()  # exits from here on are not restarted
+        self.probe.stop()
         # Stop the local socat process
         self._stop_local_socat()
         # Stop the remote socat process
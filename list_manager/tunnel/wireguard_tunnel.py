@@ -6,8 +6,7 @@ import os
 from pathlib import Path
 from threading import Thread, Event
 from addict import Dict
-import sshtunnel
-import requests
+from .health import TunnelHealth, CanaryProbe
 from .. import log, Utils
 
 
@@ -28,6 +27,8 @@ class WireGuardConfig:
         self.wg_api = f"http://{local_bind_address[0]}:{local_bind_address[1]}"
 
     def config(self, wg_conf: Path, subnet_id=0, dns=1, replace=dict()):
+        import sshtunnel
+        import requests
         with sshtunnel.open_tunnel(**(self.ssh_config)) as tunnel:
             response = requests.get(f"{self.wg_api}/genpeer?grp={subnet_id}&dns={dns}")
             response.raise_for_status()
@@ -48,24 +49,44 @@ class WireGuardConfig:
             yield l
 
 
+# One instance per interface; several can run side by side as separate egress
+# paths (see resolver.egress). Their configs then need `Table = off` and a
+# source address rule each, so that only traffic bound to the interface
+# address uses the tunnel.
 class WireGuardManager():
-    instance = False
-    wireguard_dir = Utils.get_create_dir("wireguard")
-    wireguard_go = wireguard_dir.joinpath("wireguard-go/wireguard-go")
-    wg_conf = wireguard_dir.joinpath("wg0.conf")
     running = Event()
     configurator = None
     run_thread = None
+    interfaces = set()
 
-    def __init__(self, **kwargs):
-        if self.instance:
-            raise ValueError("WireGuardManager is a singleton")
-        
+    def __init__(self, interface="wg0", probe="8.8.8.8", **kwargs):
+        if interface in self.interfaces:
+            raise ValueError(f"WireGuardManager for {interface} exists")
+
+        self.interface = interface
+        self.wireguard_dir = Utils.get_create_dir("wireguard")
+        self.wireguard_go = self.wireguard_dir.joinpath("wireguard-go/wireguard-go")
+        self.wg_conf = self.wireguard_dir.joinpath(f"{interface}.conf")
         self.run_thread = Thread(target=self.thread_loop)
         self.running = Event()
+        self.stopping = Event()
+        # a canary query to the probe nameserver goes through the tunnel
+        self.health = TunnelHealth(f"wireguard {interface}")
+        self.probe = CanaryProbe(self.health, probe) if probe else None
         self.configurator = WireGuardConfig(**kwargs)
         atexit.register(self.stop)
-        self.instance = True
+        self.interfaces.add(interface)
+
+    # local address of the interface, from the Address line of its config
+    @property
+    def address(self):
+        if not self.wg_conf.exists():
+            return None
+        for line in self.wg_conf.read_text().splitlines():
+            key, _, value = line.partition("=")
+            if key.strip() == "Address":
+                return value.split(",")[0].strip().split("/")[0]
+        return None
 
     def thread_loop(self):
         returncode = self.up()
@@ -73,16 +94,17 @@ class WireGuardManager():
             log.error("bailing, wireguard startup returned non-zero code:", returncode)
             return
 
-        cmd = shlex.join(["sudo", "wg", "show"])  # self.wg_conf.stem
-        # Loop to check the tunnel status
-        while self.running.is_set():
-            # Check if the WireGuard interface is up
-            result = subprocess.run(cmd, capture_output=True, shell=True)
-            if result.returncode != 0:
-                # If the interface is not up, break the loop and optionally take action
-                log.info("WireGuard interface is down. Exiting thread.")
-                break
-            time.sleep(5)
+        # the canary reports the tunnel state, nothing to poll here
+        if self.probe:
+            # the config may only have been written by start()
+            self.probe.source = self.address
+            self.probe.start()
+        else:
+            self.health.set_up("wg-quick up")
+        self.stopping.wait()
+        if self.probe:
+            self.probe.stop()
+        self.health.set_down("stopped")
         self.down()
 
     def up(self):
@@ -106,7 +128,7 @@ class WireGuardManager():
 
     def down(self):
         log.info("Stopping wireguard-go ...")
-        cmd = shlex.join(["sudo", "-E", "wg-quick", "down"])
+        cmd = shlex.join(["sudo", "-E", "wg-quick", "down", str(self.wg_conf)])
         result = subprocess.run(
             cmd,
             timeout=60,
@@ -131,11 +153,13 @@ class WireGuardManager():
         if config:
             self.configurator.config(self.wg_conf, **kwargs)
         self.running.set()
+        self.stopping.clear()
         self.run_thread.start()
         log.info("wireguard started")
 
     def stop(self):
         if self.run_thread.is_alive():
-            self.running.clear()  # Signal the monitor thread to stop
+            self.running.clear()
+            self.stopping.set()  # Signal the monitor thread to stop
             self.run_thread.join()  # Wait for the monitor thread to finish
         log.info("wireguard stopped.")
@@ -1,9 +1,15 @@
 import os
 import json
+import hashlib
+import multiprocessing as mp
+from itertools import islice
+from json.encoder import encode_basestring_ascii
 from pathlib import Path
+from typing import Callable
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from enum import IntEnum
 from collections import OrderedDict
-import yaml
 import logging
 from rich.logging import RichHandler
 
@@ -19,6 +25,8 @@ log = logging.getLogger("lm")
 
 
 ROOT_DIR = Path(os.environ.get("ROOT_DIR", Path.cwd().joinpath(".temp"))).absolute()
+# processes serializing the files of a bulk write
+WRITE_WORKERS = int(os.environ.get("WRITE_WORKERS", os.cpu_count() or 1))
 
 class IntEnumDict(OrderedDict):
     def __setitem__(self, key, item) -> None:
@@ -41,9 +49,20 @@ class Stats(IntEnumDict):
         return 0  # if key not found
     
     def __str__(self):
+       import yaml
        return f'\n{yaml.dump(dict(self))}'
     
 class Utils:
+    # distutils.util.strtobool without importing distutils
+    @staticmethod
+    def strtobool(value: str) -> bool:
+        value = value.lower()
+        if value in ("y", "yes", "t", "true", "on", "1"):
+            return True
+        if value in ("n", "no", "f", "false", "off", "0"):
+            return False
+        raise (ValueError(f"invalid truth value {value}"))
+
     @staticmethod
     def with_root(file_path:str) -> Path:
         file_path:Path = Path(file_path)
@@ -90,8 +109,125 @@ class JsonFile:
 
     def write(self, data: dict) -> None:
         with self.file.with_suffix('.tmp').open(mode="w") as fp:
-            json.dump(data, fp, default=list, indent=4)
+            self.encode_json(data, fp.write)
             fp.flush()
             os.fsync(fp.fileno())
             
         self.file.with_suffix('.tmp').rename(self.file)
+
+    # json.dump(data, indent=4) of a dict, except that sets and streamed
+    # collections (tables on disk) are written a chunk of items at a time
+    # instead of being turned into one list first
+    @classmethod
+    def encode_json(cls, data: dict, write: Callable[[str], object]) -> None:
+        write("{")
+        for i, (key, value) in enumerate(data.items()):
+            write(f"{',' if i else ''}\n    {json.dumps(str(key))}: ")
+            if isinstance(value, (set, frozenset)) or getattr(value, "streamed", False):
+                cls.encode_json_items(value, write)
+            else:
+                write(json.dumps(value, default=list, indent=4).replace("\n", "\n    "))
+        write("\n}" if data else "}")
+
+    @staticmethod
+    def encode_json_items(items, write: Callable[[str], object], chunk=4096) -> None:
+        items = iter(items)
+        empty = True
+        for block in iter(lambda: list(islice(items, chunk)), []):
+            write(("[\n        " if empty else ",\n        ") + ",\n        ".join(map(encode_basestring_ascii, block)))
+            empty = False
+        write("[]" if empty else "\n    ]")
+
+    # Writes files as one generation, for storage where every fsync is a round
+    # trip: serialized in parallel processes (json with indent runs in pure
+    # python), one concurrent round of fsyncs, the manifest marked pending, the
+    # renames, one directory fsync and the manifest marked committed. A crash
+    # in between leaves fsynced temp files that recover() rolls forward.
+    # The files are kept in the directory of the manifest.
+    @classmethod
+    def write_many(cls, items: list[tuple["JsonFile", dict]], manifest: "JsonFile", max_workers=WRITE_WORKERS) -> dict:
+        cls.recover(manifest)
+        if not items:
+            return manifest.read() if manifest.exists() else dict()
+        directory = manifest.file.parent
+        tmps = [f.file.with_suffix(".tmp") for f, _ in items]
+        if max_workers > 1 and len(items) > 1:
+            # not forked: the callers run threads (pipeline stages, resolver loops, the daemon)
+            # whose locks a forked child would inherit held
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(items)), mp_context=mp.get_context("forkserver")) as workers:
+                digests = list(workers.map(cls.write_tmp, tmps, [data for _, data in items]))
+        else:
+            digests = [cls.write_tmp(tmp, data) for tmp, (_, data) in zip(tmps, items)]
+        # fsync releases the GIL, the files are flushed concurrently
+        with ThreadPoolExecutor(max_workers=min(len(tmps), 32)) as workers:
+            list(workers.map(cls.fsync, tmps))
+
+        state = manifest.read() if manifest.exists() else dict()
+        generation = state.get("generation", 0) + 1
+        files = state.get("files", dict())
+        for (f, _), (sha256, size) in zip(items, digests):
+            files[str(f.file.relative_to(directory))] = {"generation": generation, "sha256": sha256, "size": size}
+        state = {"generation": generation, "state": "pending", "written": str(datetime.now()), "files": files}
+        cls.commit(manifest.file, state)
+
+        for tmp, (f, _) in zip(tmps, items):
+            tmp.rename(f.file)
+        cls.fsync(directory)
+        state["state"] = "committed"
+        cls.commit(manifest.file, state)
+        return state
+
+    # completes the renames of a generation interrupted after its temp files were synced
+    @classmethod
+    def recover(cls, manifest: "JsonFile") -> None:
+        if not manifest.exists():
+            return
+        state = manifest.read()
+        if state.get("state") != "pending":
+            return
+        directory = manifest.file.parent
+        for name, entry in state["files"].items():
+            tmp = directory.joinpath(name).with_suffix(".tmp")
+            if entry["generation"] != state["generation"] or not tmp.exists():
+                continue
+            if hashlib.sha256(tmp.read_bytes()).hexdigest() == entry["sha256"]:
+                tmp.rename(directory.joinpath(name))
+            else:
+                log.error(f"{tmp} does not match generation {state['generation']}, not restored")
+        cls.fsync(directory)
+        state["state"] = "committed"
+        cls.commit(manifest.file, state)
+        log.info(f"recovered generation {state['generation']} of {manifest.file}")
+
+    # runs in a worker process, syncing is left to the parent. Tables on disk
+    # arrive by path and are streamed, not loaded
+    @classmethod
+    def write_tmp(cls, tmp: Path, data: dict) -> tuple[str, int]:
+        digest = hashlib.sha256()
+        size = 0
+        with tmp.open(mode="wb") as fp:
+            def write(text: str) -> None:
+                nonlocal size
+                chunk = text.encode("utf-8")
+                digest.update(chunk)
+                size += len(chunk)
+                fp.write(chunk)
+            cls.encode_json(data, write)
+        return digest.hexdigest(), size
+
+    @staticmethod
+    def fsync(path: Path) -> None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # small files, replaced durably one at a time
+    @classmethod
+    def commit(cls, path: Path, data: dict) -> None:
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, indent=4), encoding="utf-8")
+        cls.fsync(tmp)
+        tmp.rename(path)
+        cls.fsync(path.parent)
@@ -0,0 +1,29 @@
+import os
+import tempfile
+
+# list_manager reads ROOT_DIR on import, every test then gets its own
+os.environ.setdefault("ROOT_DIR", tempfile.mkdtemp(prefix="list_manager_"))
+
+import pytest
+import list_manager.utils
+
+
+@pytest.fixture(autouse=True)
+def root_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(list_manager.utils, "ROOT_DIR", tmp_path)
+    return tmp_path
+
+
+# a parsed list file from the lines of a source, written nowhere
+@pytest.fixture
+def domains_file(root_dir):
+    from list_manager.domains.files import DomainsFile
+    from list_manager.utils import Stats
+
+    def make(category: str, lines: list[str], idx=0, url=None) -> DomainsFile:
+        d = DomainsFile(idx, category, url or f"https://lists.test/{category}/{idx}.txt", root_dir)
+        d.stats = Stats([("idx", idx), ("category", category), ("url", d.url)])
+        d.fileSet, d.stats["parser"] = d.clean_list(lines)
+        d.compile()
+        return d
+    return make
@@ -0,0 +1,69 @@
+import pickle
+from list_manager.domains.utils import DomainUtils, FileSet
+from list_manager.external import ExternalSet, SortedRuns, merge_difference, merge_intersection, merge_unique
+
+
+def test_merge_helpers():
+    assert list(merge_unique(["a", "c"], ["b", "c"], [])) == ["a", "b", "c"]
+    assert list(merge_intersection(["a", "b", "d"], ["b", "c", "d"])) == ["b", "d"]
+    assert list(merge_difference(["a", "b", "c", "d"], ["b"], ["d", "e"])) == ["a", "c"]
+
+
+def test_sorted_runs_spill(root_dir):
+    runs = SortedRuns(budget=500, directory=root_dir)
+    items = [f"h{i % 50:02d}.com" for i in range(200)]
+    runs.update(items)
+    assert len(runs.runs) > 1
+    assert list(runs) == sorted(set(items))
+    runs.close()
+    assert not list(root_dir.glob("*.run"))
+
+
+def test_external_set_algebra(root_dir):
+    left = ExternalSet.build(root_dir / "left.domains", {"a.com", "b.com", "c.com", "d.com"})
+    right = ExternalSet.build(root_dir / "right.domains", iter(["d.com", "b.com", "e.com", "b.com"]), budget=100)
+    assert list(right) == ["b.com", "d.com", "e.com"]
+    assert len(left) == 4 and "a.com" in left and "e.com" not in left
+    assert left.intersection(right) == {"b.com", "d.com"}
+    assert left.intersection({"a.com", "x.com"}, right) == set()
+    assert left.difference(right, {"a.com"}) == {"c.com"}
+    union = ExternalSet.union(root_dir / "union.domains", [left, right])
+    assert list(union) == ["a.com", "b.com", "c.com", "d.com", "e.com"]
+
+
+def test_external_set_pickles_by_path(root_dir):
+    s = ExternalSet.build(root_dir / "p.domains", {"a.com", "b.com"})
+    data = pickle.dumps(s)
+    assert len(data) < 200 + len(str(s.path))
+    assert list(pickle.loads(data)) == ["a.com", "b.com"]
+
+
+def test_clean_list_into_sorted_runs(root_dir):
+    lines = [f"h{i % 300}.example.com" for i in range(1000)] + ["# comment", "bad"]
+    plain, plain_stats = DomainUtils.clean_list(lines)
+    runs = SortedRuns(budget=2000, directory=root_dir)
+    spilled, stats = DomainUtils.clean_list(lines, runs)
+    assert len(runs.runs) > 1
+    assert stats == plain_stats
+    table = ExternalSet.build(root_dir / "t.domains", spilled[FileSet.domains])
+    # duplicates in different runs are merged, not renamed
+    assert set(table) >= {f"h{i}.example.com" for i in range(300)}
+    assert set(table) <= plain[FileSet.domains]
+    assert not list(root_dir.glob("*.run"))
+
+
+def test_parse_under_memory_budget(domains_file, monkeypatch):
+    import list_manager.domains.files as files
+    import list_manager.external as external
+    monkeypatch.setattr(files, "MEMORY_BUDGET", 2000)
+    monkeypatch.setattr(external, "MEMORY_BUDGET", 2000)
+    body = "\n".join(f"h{i}.example.com" for i in range(500)).encode("utf-8")
+    d = domains_file("ads", [])
+    monkeypatch.setattr(d, "download_list", lambda url, refresh=False: (body, False))
+    d.parse()
+    assert isinstance(d.get_set(FileSet.domains), ExternalSet)
+    assert len(d.get_set(FileSet.domains)) == 500
+    d.write()
+    d.load()
+    assert isinstance(d.get_set(FileSet.domains), ExternalSet)
+    assert set(d.get_set(FileSet.domains)) == {f"h{i}.example.com" for i in range(500)}
@@ -0,0 +1,42 @@
+from list_manager.domains.index import WhitelistIndex
+from list_manager.domains.utils import FileSet
+from list_manager.external import ExternalSet
+
+
+def test_reduce_exact_suffix_and_regex(domains_file):
+    wl = domains_file("wl", ["good.com", "*.cdn.net", "ad*.tracker.org"])
+    bl = domains_file("ads", ["good.com", "img.cdn.net", "a.b.cdn.net", "cdn.net", "ads1.tracker.org", "bad.com"], idx=1)
+    WhitelistIndex([wl]).reduce(bl)
+    assert bl.get_set(FileSet.dup_domains) == {"good.com", "img.cdn.net", "a.b.cdn.net", "ads1.tracker.org"}
+    assert bl.payload_domains() == {"cdn.net", "bad.com"}
+    assert bl.stats["deDup"] == {"wl_0_m": 3, "wl_0_d": 1, "wl_0_p": 0}
+
+
+def test_reduce_equal_patterns(domains_file):
+    wl = domains_file("wl", ["*.cdn.net"])
+    bl = domains_file("ads", ["*.cdn.net", "*.ads.net"], idx=1)
+    WhitelistIndex([wl]).reduce(bl)
+    assert bl.get_set(FileSet.dup_patterns) == {"/.*\\.cdn\\.net/"}
+    assert bl.payload_patterns() == {"/.*\\.ads\\.net/"}
+
+
+def test_reduce_attributes_every_whitelist(domains_file):
+    a = domains_file("wl", ["x.com"])
+    b = domains_file("wl", ["x.com", "*.y.com"], idx=1)
+    bl = domains_file("ads", ["x.com", "a.y.com"], idx=2)
+    WhitelistIndex([a, b]).reduce(bl)
+    assert bl.stats["deDup"] == {"wl_0_m": 0, "wl_0_d": 1, "wl_0_p": 0, "wl_1_m": 1, "wl_1_d": 1, "wl_1_p": 0}
+
+
+def test_reduce_external_whitelist(domains_file, root_dir):
+    wl = domains_file("wl", ["good.com", "fine.org"])
+    wl.fileSet[FileSet.domains] = ExternalSet.build(root_dir / "wl.domains", wl.get_set(FileSet.domains))
+    bl = domains_file("ads", ["good.com", "bad.com", "fine.org"], idx=1)
+    bl.fileSet[FileSet.domains] = ExternalSet.build(root_dir / "bl.domains", bl.get_set(FileSet.domains))
+    WhitelistIndex([wl]).reduce(bl)
+    assert bl.get_set(FileSet.dup_domains) == {"good.com", "fine.org"}
+    assert bl.stats["deDup"]["wl_0_d"] == 2
+
+
+def test_parents_nearest_first():
+    assert list(WhitelistIndex.parents("a.b.example.com")) == ["b.example.com", "example.com", "com"]
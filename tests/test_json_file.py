@@ -0,0 +1,69 @@
+import json
+import hashlib
+import pytest
+from list_manager import JsonFile, DataSet, Stats
+from list_manager.domains.utils import FileSet
+from list_manager.external import ExternalSet
+
+
+@pytest.mark.parametrize("data", [
+    dict(),
+    {"empty": set(), "list": [], "dict": {}},
+    {"stats": Stats([("n", 1), ("nested", {"a": [1, 2], "b": None}), ("text", "é \"q\"\n")])},
+    DataSet([(FileSet.domains, {"a.com", "b.org", "ü.net"}), (FileSet.patterns, frozenset({"/.*\\.x\\.com/"}))]),
+])
+def test_encode_json_matches_json_dump(data):
+    out = []
+    JsonFile.encode_json(data, out.append)
+    assert "".join(out) == json.dumps(data, default=list, indent=4)
+
+
+def test_encode_json_streams_tables(root_dir):
+    table = ExternalSet.build(root_dir / "t.domains", {f"h{i}.com" for i in range(10000)})
+    out = []
+    JsonFile.encode_json({"domains": table}, out.append)
+    assert json.loads("".join(out)) == {"domains": sorted(table)}
+    # written in chunks, never as one list
+    assert max(map(len, out)) < len("".join(out)) / 2
+
+
+def test_write_read(root_dir):
+    f = JsonFile(root_dir / "f.json")
+    f.write({"domains": {"b.com", "a.com"}, "stats": {"n": 2}})
+    assert f.read() == {"domains": {"a.com", "b.com"}, "stats": {"n": 2}}
+    assert not (root_dir / "f.tmp").exists()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_write_many(root_dir, workers):
+    table = ExternalSet.build(root_dir / "t.domains", {"x.com", "y.com"})
+    files = [JsonFile(root_dir / f"f{i}.json") for i in range(3)]
+    items = [(f, {"n": i, "domains": table}) for i, f in enumerate(files)]
+    manifest = JsonFile(root_dir / "manifest.json")
+    state = JsonFile.write_many(items, manifest, max_workers=workers)
+    assert state["state"] == "committed" and state["generation"] == 1
+    for i, f in enumerate(files):
+        entry = state["files"][f.file.name]
+        assert entry["sha256"] == hashlib.sha256(f.file.read_bytes()).hexdigest()
+        assert entry["size"] == f.file.stat().st_size
+        assert f.read() == {"n": i, "domains": {"x.com", "y.com"}}
+    assert JsonFile.write_many(items[:1], manifest, max_workers=workers)["generation"] == 2
+
+
+def test_recover_rolls_forward(root_dir):
+    manifest = JsonFile(root_dir / "manifest.json")
+    good, bad = JsonFile(root_dir / "good.json"), JsonFile(root_dir / "bad.json")
+    JsonFile.write_many([(good, {"v": 1}), (bad, {"v": 1})], manifest, max_workers=1)
+
+    # a crash after the manifest was marked pending, before the renames
+    state = manifest.read()
+    digests = {name: JsonFile.write_tmp(root_dir / name.replace(".json", ".tmp"), {"v": 2}) for name in state["files"]}
+    state = {"generation": 2, "state": "pending", "files": {n: {"generation": 2, "sha256": d[0], "size": d[1]} for n, d in digests.items()}}
+    JsonFile.commit(manifest.file, state)
+    (root_dir / "bad.tmp").write_text("{}")
+
+    JsonFile.recover(manifest)
+    assert manifest.read()["state"] == "committed"
+    assert good.read() == {"v": 2}
+    # a temp file that does not match the generation is left alone
+    assert bad.read() == {"v": 1}
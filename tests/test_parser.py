@@ -0,0 +1,55 @@
+import pytest
+from list_manager.domains.utils import DomainUtils, FileSet
+
+
+@pytest.mark.parametrize("entry, expected", [
+    ("||ads.com^", ("ads.com", True)),
+    ("||ads.com^$important", ("ads.com", True)),
+    ("address=/ads.com/0.0.0.0", ("ads.com", True)),
+    ("address=/ads.com/::", ("ads.com", True)),
+    ("address=/ads.com/#", ("ads.com", True)),
+    ("address=/ads.com/", ("ads.com", True)),
+    ("server=/ads.com/", ("ads.com", True)),
+    ("local=/ads.com/", ("ads.com", True)),
+    # a redirect or a forward, not a block
+    ("address=/ads.com/1.2.3.4", ("address=/ads.com/1.2.3.4", False)),
+    ("server=/ads.com/1.1.1.1", ("server=/ads.com/1.1.1.1", False)),
+    ("ads.com", ("ads.com", False)),
+])
+def test_normalize(entry, expected):
+    assert DomainUtils.normalize(entry) == expected
+
+
+def test_clean_list():
+    lines = [
+        "[Adblock Plus 2.0]",
+        "! comment",
+        "# comment",
+        "",
+        "0.0.0.0 hosts.com",
+        "plain.com # trailing comment",
+        "||adblock.com^",
+        "address=/dnsmasq.com/0.0.0.0",
+        "address=/redirect.com/10.0.0.1",
+        "@@||allowed.com^",
+        "*.wild.net",
+        "localhost",
+    ]
+    sets, stats = DomainUtils.clean_list(lines)
+    assert sets[FileSet.domains] == {"hosts.com", "plain.com", "adblock.com", "dnsmasq.com"}
+    assert sets[FileSet.patterns] == {"/.*\\.wild\\.net/"}
+    assert sets[FileSet.invalid] == {"address=/redirect.com/10.0.0.1", "@@||allowed.com^", "localhost"}
+    assert stats["comments"] == 4
+    assert stats["normalized"] == 2
+    assert stats["processed"] == stats["lines"] == len(lines)
+
+
+def test_bracket_lines_are_not_all_comments():
+    sets, stats = DomainUtils.clean_list(["[adguard]", "[uBlock Origin]", "[not.a.header]"])
+    assert stats["comments"] == 2
+    assert stats["processed"] == 3
+
+
+def test_pattern_suffix():
+    assert DomainUtils.pattern_suffix("/.*\\.example\\.com/") == "example.com"
+    assert DomainUtils.pattern_suffix("/ad.*\\.example\\.com/") is None
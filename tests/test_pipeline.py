@@ -0,0 +1,102 @@
+import pytest
+from list_manager.domains.utils import FileSet
+from list_manager.runner import Pipeline, Stage
+
+
+class Stages:
+    def __init__(self):
+        self.inputs = {"source": 1}
+        self.calls = []
+        self.restored = []
+
+    def stage(self, name, after=(), **kwargs):
+        def run():
+            self.calls.append(name)
+            return {name: self.inputs.get(name, 0)}
+        return Stage(name, run, after=after, **kwargs)
+
+    def pipeline(self, **kwargs):
+        return Pipeline([
+            self.stage("source", always=True),
+            self.stage("parse", after=["source"], restore=lambda: self.restored.append("parse")),
+            self.stage("reduce", after=["parse"]),
+            self.stage("refresh", after=["reduce"], always=True),
+        ], **kwargs)
+
+
+def test_unchanged_stages_skip():
+    s = Stages()
+    s.pipeline().run()
+    assert s.calls == ["source", "parse", "reduce", "refresh"]
+    s.calls.clear()
+    s.pipeline().run()
+    assert s.calls == ["source", "refresh"]
+    # the skipped parse is restored once for the stages after it that run
+    assert s.restored == ["parse"]
+
+
+def test_changed_output_reruns_downstream():
+    s = Stages()
+    s.pipeline().run()
+    s.calls.clear()
+    s.inputs["source"] = 2
+    s.pipeline().run()
+    # parse has the same output as before, reduce is not rerun
+    assert s.calls == ["source", "parse", "refresh"]
+    s.calls.clear()
+    s.inputs["source"], s.inputs["parse"] = 3, 1
+    s.pipeline().run()
+    assert s.calls == ["source", "parse", "reduce", "refresh"]
+
+
+def test_force_reruns_a_stage():
+    s = Stages()
+    s.pipeline().run()
+    s.calls.clear()
+    s.pipeline().run(force=["reduce"])
+    assert s.calls == ["source", "reduce", "refresh"]
+
+
+def test_failed_stage_resumes():
+    s = Stages()
+    pipeline = s.pipeline()
+    pipeline.stages["reduce"].run = lambda: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        pipeline.run()
+    assert "refresh" not in s.calls
+    s.calls.clear()
+    s.pipeline().run()
+    assert s.calls == ["source", "reduce", "refresh"]
+
+
+def test_independent_stages_run_concurrently():
+    s = Stages()
+    pipeline = Pipeline([s.stage("a"), s.stage("b"), s.stage("c", after=["a", "b"])], max_workers=2)
+    pipeline.run()
+    assert sorted(s.calls[:2]) == ["a", "b"] and s.calls[2] == "c"
+
+
+def test_missing_dependency():
+    with pytest.raises(ValueError):
+        Pipeline([Stage("a", dict, after=["missing"])]).run()
+
+
+def test_content_digest(domains_file):
+    a = domains_file("ads", ["a.com", "b.com"])
+    b = domains_file("ads", ["a.com", "c.com"], idx=1)
+    # same counts, different content
+    assert a.stats["parser"] == b.stats["parser"]
+    assert a.digest() != b.digest()
+    assert a.digest() == domains_file("ads", ["b.com", "a.com"], idx=2).digest()
+    a.get_set(FileSet.dup_domains).add("a.com")
+    assert a.digest() != domains_file("ads", ["a.com", "b.com"], idx=3).digest()
+
+
+def test_runner_stages():
+    from list_manager.runner import Runner
+    pipeline = Runner().pipeline
+    stages = pipeline.stages
+    # the cache refresh runs every time, prune and lookup wait for it
+    assert stages["resolve"].always and stages["prune"].always
+    assert "resolve" in {s.name for s in pipeline.upstream(stages["prune"])}
+    assert {"resolve", "prune"} <= {s.name for s in pipeline.upstream(stages["lookup"])}
@@ -0,0 +1,58 @@
+from list_manager.domains.sketch import DomainSketch, HyperLogLog, overlap_report
+
+
+def sketch(domains):
+    return DomainSketch.of(domains, p=10, k=256)
+
+
+def test_merge_without_others_copies_registers():
+    s = sketch(f"a{i}.com" for i in range(100))
+    merged = s.hll.merge()
+    assert merged.registers == s.hll.registers
+    assert merged.registers is not s.hll.registers
+
+
+def test_merge_is_union():
+    a = sketch(f"d{i}.com" for i in range(3000))
+    b = sketch(f"d{i}.com" for i in range(2000, 5000))
+    assert abs(a.hll.merge(b.hll).estimate() - 5000) < 5000 * 0.1
+    assert a.hll.merge(b.hll).registers == HyperLogLog.merge(b.hll, a.hll).registers
+
+
+def test_of_streams_domains():
+    s = DomainSketch.of(f"g{i}.org" for i in range(500))
+    assert s.count == 500
+    assert len(s.minhash.hashes) == 500
+    assert abs(s.hll.estimate() - 500) < 50
+
+
+def test_dump_load_round_trip():
+    s = sketch(f"r{i}.net" for i in range(1000))
+    loaded = DomainSketch.load(s.dump())
+    assert loaded.count == s.count
+    assert loaded.hll.registers == s.hll.registers
+    assert loaded.minhash.hashes == s.minhash.hashes
+
+
+def test_overlap_single_list():
+    report = overlap_report({"x": sketch(["a.com", "b.com"])}, {"x": "ads"})
+    assert report["union"] == 2
+    assert report["pairs"] == {}
+    assert report["unique"] == {"x": 2}
+    assert report["unique_category"] == {"ads": 2}
+
+
+def test_overlap_pairs():
+    sketches = {
+        "x": sketch(f"d{i}.com" for i in range(1000)),
+        "y": sketch(f"d{i}.com" for i in range(500, 1500)),
+    }
+    report = overlap_report(sketches, {"x": "ads", "y": "ads"})
+    pair = report["pairs"]["x"]["y"]
+    assert abs(pair["jaccard"] - 1 / 3) < 0.1
+    assert abs(pair["intersection"] - 500) < 100
+    assert report["unique_category"] == {"ads": report["union"]}
+
+
+def test_overlap_empty():
+    assert overlap_report({}, {})["union"] == 0